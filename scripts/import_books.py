@@ -1,76 +1,344 @@
 # import_books.py
+# Import sách song ngữ (sach.txt) lên backend: tách chương, tokenize tiếng Nhật, gửi lên API.
+#
+#   python import_books.py sach.txt --book-id 67a123456789abcdef123456
+#   python import_books.py sach.txt --batch-size 20 --concurrency 8
+#   python import_books.py stub --port 3999                  # server giả để chạy thử
+#   python import_books.py sach.txt --url http://127.0.0.1:3999
+#
+# File được đọc từng dòng (không load cả sách), tokenize chạy trong pool process,
+# upload qua session keep-alive với số request đồng thời giới hạn, tự retry + backoff.
+# Token được tra nghĩa trong từ điển .jdx (--dict, dựng bằng ja_tokenizer.py build).
+# Chương đã import được ghi vào checkpoint (<file>.import-checkpoint.json);
+# chạy lại sẽ bỏ qua các chương đó.
+# Route admin (server/routes/admin.js) upsert theo bookId + chapterNumber nên gửi
+# lại 1 chương chỉ ghi đè chính nó: lỗi kết nối, timeout, 429/502/503/504 đều retry.
+#
+# Cài đặt: pip install -r requirements.txt
+import os
 import json
-import requests
-from pykakasi import kakasi
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Cài đặt: pip install pykakasi requests
+from ja_tokenizer import Tokenizer
 
-kakasi_instance = kakasi()
-kakasi_instance.setMode("H", "a")  # Hiragana → romanji
-kakasi_instance.setMode("K", "a")  # Katakana → romanji
-kakasi_instance.setMode("J", "a")  # Kanji → romanji
-conv = kakasi_instance.getConverter()
+DEFAULT_URL = "http://localhost:3000"
+DEFAULT_BOOK_ID = "67a123456789abcdef123456"  # thay bằng ID thật
+CHAPTER_PATH = "/api/admin/import-chapter"
+BATCH_PATH = "/api/admin/import-chapters"
+# server upsert theo (bookId, chapterNumber): gửi lại sau khi backend đã ghi vẫn an toàn
+RETRY_STATUS = (429, 502, 503, 504)
+
+# --------- Tokenize ----------
+_tokenizer = None
+
+def init_tokenizer(dict_path=None):
+    """Initializer của pool: mỗi process tạo 1 Tokenizer (memo + từ điển mmap) dùng cho mọi chương."""
+    global _tokenizer
+    _tokenizer = Tokenizer(dict_path)
 
 def simple_tokenize(text):
-    # Cách đơn giản: tách theo dấu cách + dấu câu
-    import re
-    tokens = re.findall(r'[\u4e00-\u9fff]+|[\u3040-\u309f]+|[\u30a0-\u30ff]+|[^ \n]+', text)
-    result = []
-    for t in tokens:
-        if any('\u4e00' <= c <= '\u9fff' for c in t):  # có kanji
-            reading = conv.do(t)
-            result.append({
-                "surface": t,
-                "reading": reading,
-                "base": t,
-                "pos": "unknown",
-                "meaning": "Chưa có nghĩa"  # sau này dùng từ điển
-            })
-        else:
-            result.append({
-                "surface": t,
-                "reading": "",
-                "base": t,
-                "pos": "punctuation",
-                "meaning": ""
-            })
-    return result
-
-# Đọc file sách song ngữ
-with open('sach.txt', 'r', encoding='utf-8') as f:
-    lines = f.readlines()
-
-chapters = []
-current_chapter = None
-
-for line in lines:
-    line = line.strip()
-    if line.startswith("CHƯƠNG"):
-        if current_chapter:
-            chapters.append(current_chapter)
-        current_chapter = {
-            "chapterNumber": len(chapters) + 1,
-            "japaneseText": "",
-            "vietnameseText": ""
-        }
-    elif "「" in line or "」" in line or any(c >= '\u4e00' for c in line):
-        current_chapter["japaneseText"] += line + "\n"
-    else:
-        current_chapter["vietnameseText"] += line + "\n"
-
-if current_chapter:
-    chapters.append(current_chapter)
-
-# Gửi lên backend
-for chap in chapters:
-    tokens = simple_tokenize(chap["japaneseText"])
-    data = {
-        "bookId": "67a123456789abcdef123456",  # thay bằng ID thật
+    if _tokenizer is None:
+        init_tokenizer()
+    return _tokenizer.tokenize(text)
+
+def build_payload(chap, book_id):
+    """
+    Chạy trong process của pool: tokenize 1 chương -> payload gửi API.
+    Mỗi dòng tiếng Nhật thành 1 dòng content {text, ruby, meaning, tokens}
+    (như Chapter.content), meaning là dòng tiếng Việt cùng thứ tự.
+    """
+    ja_lines = [l for l in chap["japaneseText"].splitlines() if l.strip()]
+    vi_lines = [l for l in chap["vietnameseText"].splitlines() if l.strip()]
+    content = []
+    for i, text in enumerate(ja_lines):
+        tokens = simple_tokenize(text)
+        content.append({
+            "text": text,
+            "ruby": "".join(t["reading"] or t["surface"] for t in tokens),
+            "meaning": vi_lines[i] if i < len(vi_lines) else "",
+            "tokens": tokens
+        })
+    return {
+        "bookId": book_id,
         "chapterNumber": chap["chapterNumber"],
-        "japaneseText": chap["japaneseText"].strip(),
-        "vietnameseText": chap["vietnameseText"].strip(),
-        "tokens": tokens
+        "title": f"Chương {chap['chapterNumber']}",
+        "content": content
     }
-    
-    r = requests.post("http://localhost:3000/api/admin/import-chapter", json=data)
-    print(f"Chương {chap['chapterNumber']}:", r.json())
\ No newline at end of file
+
+# --------- Đọc sách ----------
+def iter_chapters(path):
+    """Đọc file từng dòng, yield mỗi chương ngay khi gặp tiêu đề chương tiếp theo."""
+    current_chapter = None
+    number = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("CHƯƠNG"):
+                if current_chapter:
+                    yield current_chapter
+                number += 1
+                current_chapter = {
+                    "chapterNumber": number,
+                    "japaneseText": "",
+                    "vietnameseText": ""
+                }
+            elif current_chapter is None:
+                continue  # phần trước chương đầu tiên (lời nói đầu, dòng trống)
+            elif "「" in line or "」" in line or any(c >= '\u4e00' for c in line):
+                current_chapter["japaneseText"] += line + "\n"
+            else:
+                current_chapter["vietnameseText"] += line + "\n"
+    if current_chapter:
+        yield current_chapter
+
+# --------- Checkpoint ----------
+class Checkpoint:
+    """Danh sách chương đã import thành công, ghi ra file sau mỗi lần upload."""
+    def __init__(self, path, book_id):
+        self.path = path
+        self.book_id = book_id
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("bookId") == book_id:
+                self.done = set(data.get("done", []))
+            else:
+                print(f"⚠ Checkpoint {path} thuộc bookId khác, bỏ qua")
+
+    def mark(self, chapter_numbers):
+        with self._lock:
+            self.done.update(chapter_numbers)
+            if not self.path:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"bookId": self.book_id, "done": sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+# --------- Upload ----------
+class Uploader:
+    """
+    POST JSON qua requests.Session keep-alive (1 session mỗi thread upload).
+    Lỗi kết nối, timeout và status trong RETRY_STATUS được retry với exponential
+    backoff + jitter, tôn trọng header Retry-After nếu server gửi. Retry an toàn
+    vì route import upsert theo (bookId, chapterNumber).
+    """
+    def __init__(self, base_url, token=None, retries=5, backoff=0.5, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        import requests
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            if self.token:
+                session.headers["Authorization"] = f"Bearer {self.token}"
+            self._local.session = session
+        return session
+
+    def post(self, path, payload):
+        import requests
+        url = self.base_url + path
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            try:
+                r = self._session().post(url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if r.status_code not in RETRY_STATUS:
+                    r.raise_for_status()
+                    return r.json() if r.content else {}
+                error = requests.HTTPError(f"{r.status_code} {r.reason}", response=r)
+                retry_after = r.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise error
+
+# --------- Pipeline ----------
+def import_book(path, book_id=DEFAULT_BOOK_ID, base_url=DEFAULT_URL, token=None,
+                workers=None, concurrency=4, batch_size=0, checkpoint_path=None,
+                retries=5, backoff=0.5, timeout=60, dict_path=None):
+    """
+    Đọc -> tokenize (pool process) -> upload (pool thread), chạy gối nhau.
+    batch_size > 0: gửi nhiều chương trong 1 request tới BATCH_PATH
+    ({"bookId", "chapters": [...]}) thay vì từng chương tới CHAPTER_PATH.
+    """
+    checkpoint = Checkpoint(checkpoint_path, book_id)
+    uploader = Uploader(base_url, token=token, retries=retries, backoff=backoff, timeout=timeout)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    prefetch = max(workers * 2, concurrency * max(1, batch_size) * 2)
+
+    stats = {"imported": 0, "skipped": 0, "failed": 0}
+    start = time.perf_counter()
+
+    def upload(payloads):
+        numbers = [p["chapterNumber"] for p in payloads]
+        if batch_size > 0:
+            resp = uploader.post(BATCH_PATH, {"bookId": book_id, "chapters": payloads})
+        else:
+            resp = uploader.post(CHAPTER_PATH, payloads[0])
+        checkpoint.mark(numbers)
+        return numbers, resp
+
+    def finish(done_futures):
+        for fut in done_futures:
+            numbers = uploads.pop(fut)
+            try:
+                _, resp = fut.result()
+                stats["imported"] += len(numbers)
+                print(f"Chương {', '.join(map(str, numbers))}:", resp)
+            except Exception as e:
+                stats["failed"] += len(numbers)
+                print(f"❌ Chương {', '.join(map(str, numbers))}: {e}")
+
+    uploads = {}  # future -> chapter numbers
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_tokenizer,
+                             initargs=(dict_path,)) as pool, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload") as http:
+        pending = deque()
+        chapters = iter_chapters(path)
+        batch = []
+        while True:
+            # giữ tối đa `prefetch` chương đang tokenize để RAM không phình
+            while len(pending) < prefetch:
+                chap = next(chapters, None)
+                if chap is None:
+                    break
+                if chap["chapterNumber"] in checkpoint.done:
+                    stats["skipped"] += 1
+                    continue
+                pending.append((chap["chapterNumber"], pool.submit(build_payload, chap, book_id)))
+            if not pending:
+                break
+
+            number, fut = pending.popleft()
+            try:
+                batch.append(fut.result())
+            except Exception as e:
+                # chương lỗi không vào checkpoint: chạy lại sẽ thử lại, các chương khác vẫn tiếp tục
+                stats["failed"] += 1
+                print(f"❌ Chương {number}: tokenize lỗi: {e}")
+                continue
+            if len(batch) >= max(1, batch_size):
+                # giới hạn số request đang bay
+                while len(uploads) >= concurrency:
+                    finish(wait(uploads, return_when=FIRST_COMPLETED).done)
+                uploads[http.submit(upload, batch)] = [p["chapterNumber"] for p in batch]
+                batch = []
+        if batch:
+            uploads[http.submit(upload, batch)] = [p["chapterNumber"] for p in batch]
+        while uploads:
+            finish(wait(uploads, return_when=FIRST_COMPLETED).done)
+
+    elapsed = time.perf_counter() - start
+    print(f"Xong: {stats['imported']} chương import, {stats['skipped']} bỏ qua (checkpoint), "
+          f"{stats['failed']} lỗi trong {elapsed:.1f}s")
+    return stats
+
+# --------- Stub server ----------
+def serve_stub(port=3999, fail_rate=0.0, delay=0.0):
+    """
+    Server giả nhận CHAPTER_PATH / BATCH_PATH, để thử import mà không cần backend thật.
+    Giống admin.js: ghi đè theo chapterNumber, trả về số chương created / updated.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    received = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if delay:
+                time.sleep(delay)
+            if random.random() < fail_rate:
+                return self._reply(503, {"message": "stub: lỗi giả"}, {"Retry-After": "0"})
+            data = json.loads(body or b"{}")
+            if self.path == CHAPTER_PATH:
+                chapters = [data]
+            elif self.path == BATCH_PATH:
+                chapters = data.get("chapters", [])
+            else:
+                return self._reply(404, {"message": "not found"})
+            if not chapters or any(not isinstance(c.get("content"), list) or not c["content"] for c in chapters):
+                return self._reply(400, {"message": "content (phải là mảng)"})
+            with lock:
+                created = sum(c["chapterNumber"] not in received for c in chapters)
+                for chap in chapters:
+                    received[chap["chapterNumber"]] = sum(len(line.get("tokens", [])) for line in chap["content"])
+                total = len(received)
+            self._reply(201, {"message": "ok", "chapters": [c["chapterNumber"] for c in chapters],
+                              "created": created, "updated": len(chapters) - created, "total": total})
+
+        def _reply(self, status, payload, headers=None):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Stub server: http://127.0.0.1:{port} (fail_rate={fail_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Stub đã nhận {len(received)} chương")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "stub":
+        stub = argparse.ArgumentParser(description="Stub import server")
+        stub.add_argument("--port", type=int, default=3999)
+        stub.add_argument("--fail-rate", type=float, default=0.0, help="tỉ lệ trả 503 để thử retry")
+        stub.add_argument("--delay", type=float, default=0.0, help="giây chờ mỗi request")
+        args = stub.parse_args(sys.argv[2:])
+        serve_stub(args.port, args.fail_rate, args.delay)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Import sách song ngữ lên backend")
+    parser.add_argument("file", nargs="?", default="sach.txt")
+    parser.add_argument("--book-id", default=DEFAULT_BOOK_ID)
+    parser.add_argument("--url", default=DEFAULT_URL, help="backend base URL")
+    parser.add_argument("--token", default=os.environ.get("IMPORT_TOKEN"), help="JWT admin (hoặc IMPORT_TOKEN)")
+    parser.add_argument("--workers", type=int, default=None, help="process tokenize")
+    parser.add_argument("--concurrency", type=int, default=4, help="số request upload đồng thời")
+    parser.add_argument("--batch-size", type=int, default=0, help="số chương mỗi request (0 = từng chương)")
+    parser.add_argument("--checkpoint", default=None, help="mặc định <file>.import-checkpoint.json")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=0.5, help="giây, nhân đôi mỗi lần retry")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--dict", default=os.environ.get("IMPORT_DICT"), help="từ điển .jdx (hoặc IMPORT_DICT)")
+    args = parser.parse_args()
+
+    import_book(args.file, book_id=args.book_id, base_url=args.url, token=args.token,
+                workers=args.workers, concurrency=max(1, args.concurrency), batch_size=max(0, args.batch_size),
+                checkpoint_path=args.checkpoint or args.file + ".import-checkpoint.json",
+                retries=args.retries, backoff=args.backoff, timeout=args.timeout,
+                dict_path=args.dict)
@@ -0,0 +1,222 @@
+# ja_tokenizer.py
+# Tokenize tiếng Nhật cho import_books.py: phân loại token bằng 1 regex biên dịch
+# sẵn, cache surface -> token (sách lặp lại từ vựng rất nhiều nên phần lớn token
+# không phải gọi lại kakasi), tra nghĩa trong từ điển dựng sẵn trên đĩa.
+#
+#   python ja_tokenizer.py build tu_dien.tsv tu_dien.jdx      # dựng index từ TSV
+#   python ja_tokenizer.py lookup tu_dien.jdx 天気 引っ越し
+#   python ja_tokenizer.py tokenize "今日は天気がいい" --dict tu_dien.jdx
+#
+# TSV: mỗi dòng "surface<TAB>reading<TAB>base<TAB>pos<TAB>meaning" (dòng bắt đầu
+# bằng # bị bỏ qua; thiếu cột thì để trống). Surface trùng giữ dòng đầu tiên.
+# Reading (từ điển hay kakasi) luôn trả về bằng hiragana: katakana trong cột
+# reading được đổi sang hiragana khi tra.
+#
+# Định dạng .jdx: b"JDX1" + uint32 số mục + uint32 offset[n + 1] + blob các bản
+# ghi UTF-8 "surface\treading\tbase\tpos\tmeaning" sắp xếp theo surface.
+# File được mmap và tra bằng tìm kiếm nhị phân: mở tức thì, các process trong
+# pool dùng chung page cache thay vì mỗi process load cả từ điển vào dict.
+import os
+import re
+import sys
+import mmap
+import struct
+from array import array
+from functools import lru_cache
+
+MAGIC = b"JDX1"
+PLACEHOLDER_MEANING = "Chưa có nghĩa"
+
+# 1 lần quét: mỗi match thuộc đúng 1 nhóm, lastgroup cho biết loại token.
+# Thứ tự nhánh giữ nguyên như regex cũ nên ranh giới token không đổi.
+TOKEN_RE = re.compile(
+    r'(?P<kanji>[\u4e00-\u9fff]+)|(?P<hira>[\u3040-\u309f]+)|(?P<kata>[\u30a0-\u30ff]+)|(?P<other>[^ \n]+)'
+)
+KANJI_RE = re.compile(r'[\u4e00-\u9fff]')
+# ァ..ヶ -> ぁ..ゖ (cùng thứ tự trong Unicode, lệch 0x60); ー giữ nguyên
+_KATA_TO_HIRA = {c: c - 0x60 for c in range(0x30A1, 0x30F7)}
+
+
+def to_hiragana(reading):
+    """Đổi katakana trong `reading` sang hiragana, để mọi reading cùng 1 bảng chữ."""
+    return reading.translate(_KATA_TO_HIRA)
+
+
+def _make_converter():
+    from pykakasi import kakasi
+    kakasi_instance = kakasi()
+    kakasi_instance.setMode("K", "H")  # Katakana → hiragana
+    kakasi_instance.setMode("J", "H")  # Kanji → hiragana
+    return kakasi_instance.getConverter()
+
+
+# --------- Từ điển ----------
+def build_index(tsv_path, out_path):
+    """Dựng file .jdx từ TSV. Ghi ra file tạm rồi os.replace để không để lại index hỏng."""
+    entries = {}
+    with open(tsv_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("#"):
+                continue
+            cols = (line.split("\t") + [""] * 5)[:5]
+            cols = [c.strip() for c in cols]
+            if cols[0] and cols[0] not in entries:
+                entries[cols[0]] = cols
+
+    # sắp theo bytes UTF-8 để khớp phép so sánh khi tra trên mmap
+    records = sorted(("\t".join(cols).encode("utf-8") for cols in entries.values()),
+                     key=lambda r: r.split(b"\t", 1)[0])
+    offsets = array("I", [0])
+    for rec in records:
+        offsets.append(offsets[-1] + len(rec))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(records)))
+        f.write(offsets.tobytes())
+        for rec in records:
+            f.write(rec)
+    os.replace(tmp, out_path)
+    size = os.path.getsize(out_path)
+    print(f"Từ điển: {len(records)} mục, {size / 1e6:.1f} MB -> {out_path}")
+    return out_path
+
+
+class Dictionary:
+    """
+    Index surface -> (reading, base, pos, meaning) đọc từ file .jdx qua mmap.
+    `get(surface)` trả về tuple hoặc None. Khi pickle sang process khác chỉ gửi
+    đường dẫn, process đó tự mở lại mmap.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:4] != MAGIC:
+            raise ValueError(f"{self.path}: không phải file từ điển .jdx")
+        (self.size,) = struct.unpack_from("<I", self._mm, 4)
+        self._base = 8 + 4 * (self.size + 1)
+        self._offsets = array("I", self._mm[8:self._base])  # n + 1 số, copy nhỏ
+        if sys.byteorder == "big":
+            self._offsets.byteswap()
+
+    def __len__(self):
+        return self.size
+
+    def _record(self, i):
+        start = self._base + self._offsets[i]
+        return self._mm[start:self._base + self._offsets[i + 1]]
+
+    def get(self, surface):
+        key = surface.encode("utf-8")
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rec = self._record(mid)
+            found = rec.split(b"\t", 1)[0]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return tuple(rec.decode("utf-8").split("\t")[1:5])
+        return None
+
+    def __contains__(self, surface):
+        return self.get(surface) is not None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+
+# --------- Tokenizer ----------
+class Tokenizer:
+    """
+    Tách câu tiếng Nhật thành token {"surface", "reading", "base", "pos", "meaning"}.
+    Token có trong từ điển lấy reading/base/pos/meaning từ từ điển (reading trống
+    thì đọc bằng kakasi); token có kanji mà không có trong từ điển giữ cách cũ:
+    reading kakasi + "Chưa có nghĩa"; còn lại là "punctuation".
+    Reading luôn là hiragana, dù lấy từ từ điển hay kakasi.
+    Kết quả từng surface được memo (LRU `cache_size` mục).
+    """
+    def __init__(self, dictionary=None, cache_size=200_000):
+        if isinstance(dictionary, str):
+            dictionary = Dictionary(dictionary)
+        self.dictionary = dictionary
+        self._conv = None
+        self._entry = lru_cache(maxsize=cache_size)(self._build_entry)
+        self.reading = lru_cache(maxsize=cache_size)(self._read)
+
+    def _read(self, surface):
+        if self._conv is None:
+            self._conv = _make_converter()
+        return self._conv.do(surface)
+
+    def _build_entry(self, surface, kind):
+        found = self.dictionary.get(surface) if self.dictionary is not None else None
+        if found is not None:
+            reading, base, pos, meaning = found
+            return (to_hiragana(reading) if reading else self.reading(surface), base or surface, pos or "unknown",
+                    meaning or PLACEHOLDER_MEANING)
+        if kind == "kanji" or (kind == "other" and KANJI_RE.search(surface)):
+            return (self.reading(surface), surface, "unknown", PLACEHOLDER_MEANING)
+        return ("", surface, "punctuation", "")
+
+    def tokenize(self, text):
+        entry = self._entry
+        result = []
+        for m in TOKEN_RE.finditer(text):
+            surface = m.group()
+            reading, base, pos, meaning = entry(surface, m.lastgroup)
+            result.append({"surface": surface, "reading": reading, "base": base,
+                           "pos": pos, "meaning": meaning})
+        return result
+
+    def stats(self):
+        info = self._entry.cache_info()
+        total = info.hits + info.misses
+        return {"tokens": total, "distinct": info.currsize,
+                "hit_rate": info.hits / total if total else 0.0,
+                "kakasi_calls": self.reading.cache_info().misses,
+                "dictionary_size": len(self.dictionary) if self.dictionary is not None else 0}
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tokenizer/từ điển tiếng Nhật cho import sách")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="dựng .jdx từ TSV")
+    p_build.add_argument("tsv")
+    p_build.add_argument("out")
+    p_lookup = sub.add_parser("lookup", help="tra surface trong .jdx")
+    p_lookup.add_argument("index")
+    p_lookup.add_argument("words", nargs="+")
+    p_tok = sub.add_parser("tokenize", help="tokenize 1 câu (hoặc stdin)")
+    p_tok.add_argument("text", nargs="?")
+    p_tok.add_argument("--dict", default=None)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        build_index(args.tsv, args.out)
+    elif args.cmd == "lookup":
+        d = Dictionary(args.index)
+        for w in args.words:
+            print(w, d.get(w))
+    else:
+        tok = Tokenizer(args.dict)
+        text = args.text if args.text is not None else sys.stdin.read()
+        print(json.dumps(tok.tokenize(text), ensure_ascii=False, indent=2))
+        print(tok.stats(), file=sys.stderr)
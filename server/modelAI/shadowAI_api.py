@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 # shadowAI_api.py
 
+import time
+IMPORT_T0 = time.perf_counter()  # đo import-to-ready (tính cả import torch/transformers)
+
 import sys
+import gc
 import os
 import json
+import threading
 import torch
-import librosa
 import pickle
-from shadowModel import ShadowNet
-from transformers import AutoTokenizer, Wav2Vec2Processor
+from shadowAudio import decode_audio, trim_silence
+from shadowMetrics import metrics
+from shadowModel import (ShadowNet, StreamingAudioEncoder, TextEmbeddingCache, ResultCache, file_checksum,
+                         load_quantized_model, load_state, state_layer_counts, truncate_layers,
+                         audio_batch, get_processor, get_tokenizer, snapshot_pretrained)
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 SAMPLE_RATE = 16000
@@ -19,71 +26,278 @@ SAMPLE_RATE = 16000
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.pt")
 LABEL_PATH = os.path.join(BASE_DIR, "error_labels.pkl")
+INT8_MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.int8.pt")
 
-# =======================
-# Load processor & tokenizer
-# =======================
-wav2vec_proc = Wav2Vec2Processor.from_pretrained(
-    "facebook/wav2vec2-base-960h"
-)
-tokenizer = AutoTokenizer.from_pretrained(
-    "cl-tohoku/bert-base-japanese"
-)
+# "fp32" (shadow_model.pt) hoặc "int8" (tạo bằng: python shadowExport.py export)
+MODEL_VARIANT = os.environ.get("SHADOW_MODEL_VARIANT", "fp32").lower()
+
+# Cache embedding câu mẫu (học viên shadow lặp lại cùng 1 bộ câu)
+TEXT_CACHE_SIZE = int(os.environ.get("SHADOW_TEXT_CACHE_SIZE", "4096"))
+TEXT_CACHE_PATH = os.environ.get("SHADOW_TEXT_CACHE_PATH") or None
+
+# Cache kết quả (score, errors) theo nội dung audio + câu, dùng chung giữa các process
+# (server và worker pool). Mặc định tắt: key chỉ gồm nội dung, nên chỉ đúng khi điểm 1 clip
+# không phụ thuộc clip chung batch (pool theo từng clip, `shadowExport.py batch-selfcheck`).
+# Bật: SHADOW_RESULT_CACHE_PATH=result_cache.sqlite3
+RESULT_CACHE_PATH = os.environ.get("SHADOW_RESULT_CACHE_PATH", "")
+if RESULT_CACHE_PATH and not os.path.isabs(RESULT_CACHE_PATH):
+    RESULT_CACHE_PATH = os.path.join(BASE_DIR, RESULT_CACHE_PATH)
+RESULT_CACHE_TTL = float(os.environ.get("SHADOW_RESULT_CACHE_TTL", "86400"))
+RESULT_CACHE_SIZE = int(os.environ.get("SHADOW_RESULT_CACHE_SIZE", "100000"))
+
+# Audio dài hơn N giây chạy wav2vec2 theo cửa sổ chồng lấn (0 = tắt), RAM không tăng theo độ dài
+CHUNK_SECONDS = float(os.environ.get("SHADOW_CHUNK_SECONDS", "20"))
+# Cắt im lặng đầu/cuối (VAD năng lượng) trước khi vào backbone
+TRIM_SILENCE = os.environ.get("SHADOW_TRIM_SILENCE", "1") == "1"
+# Streaming: cửa sổ nhỏ để có điểm tạm thời sớm và điểm cuối chỉ tốn ~1 cửa sổ compute
+STREAM_WINDOW_SECONDS = float(os.environ.get("SHADOW_STREAM_WINDOW_SECONDS", "2.0"))
+STREAM_OVERLAP_SECONDS = float(os.environ.get("SHADOW_STREAM_OVERLAP_SECONDS", "0.5"))
+# Trỏ thẳng tham số model vào trang mmap của shadow_model.pt (CPU): mọi process
+# (worker pool, pre-fork) dùng chung page cache thay vì mỗi process 1 bản copy
+MMAP_WEIGHTS = os.environ.get("SHADOW_MMAP_WEIGHTS", "1") == "1"
+# Dừng wav2vec2 sau layer K (0 = dùng đủ layer của checkpoint). Head nên được
+# train cho đúng K (python shadowDepth.py export); đặt K trên checkpoint đầy đủ
+# chỉ cắt compute, độ chính xác xem bảng của shadowDepth.py sweep
+AUDIO_DEPTH = int(os.environ.get("SHADOW_AUDIO_DEPTH", "0"))
 
 # =======================
-# Load model & labels
+# Model & labels: load lười, 1 lần cho cả process
 # =======================
-with open(LABEL_PATH, "rb") as f:
-    mlb = pickle.load(f)
+model = None
+mlb = None
+text_cache = None
+result_cache = None
+ready_seconds = None  # thời gian từ lúc import tới khi sẵn sàng
+load_error = None  # "Loại: thông báo" của lần load gần nhất bị lỗi (None nếu chưa lỗi)
+_load_lock = threading.Lock()
+
+
+def is_ready() -> bool:
+    return model is not None
+
+
+def load_resources():
+    """
+    Load processor, tokenizer, model, labels (chỉ chạy 1 lần, thread-safe).
+    Lỗi được ném tiếp và ghi vào `load_error` để /ready báo thay vì "đang load" mãi.
+    """
+    global load_error
+    if model is not None:
+        return
+    with _load_lock:
+        if model is not None:
+            return
+        try:
+            _load()
+        except Exception as e:
+            load_error = f"{type(e).__name__}: {e}"
+            raise
+        load_error = None
+
 
-model = ShadowNet(n_error_classes=len(mlb.classes_))
-model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-model.to(DEVICE)
-model.eval()
+def _load():
+    global model, mlb, text_cache, result_cache, DEVICE, ready_seconds
+    t0 = time.perf_counter()
+    get_processor()
+    get_tokenizer()
+
+    if MODEL_VARIANT == "int8":
+        # model int8 chỉ chạy trên CPU
+        DEVICE = "cpu"
+        _model, _mlb = load_quantized_model(INT8_MODEL_PATH, LABEL_PATH)
+        active_path = INT8_MODEL_PATH
+    else:
+        with open(LABEL_PATH, "rb") as f:
+            _mlb = pickle.load(f)
+
+        # backbone lấy từ checkpoint, không tải lại trọng số pretrained
+        # số layer lấy từ checkpoint: student chưng cất (shadowDistill.py) load như model thường
+        state = load_state(MODEL_PATH, map_location=DEVICE)
+        _model = ShadowNet(n_error_classes=len(_mlb.classes_), pretrained=False, **state_layer_counts(state))
+        _model.load_state_dict(state, assign=MMAP_WEIGHTS and DEVICE == "cpu")
+        _model.to(DEVICE)
+        _model.eval()
+        active_path = MODEL_PATH
+
+    if AUDIO_DEPTH:
+        if _model.audio_pooling == "weighted":
+            print("⚠ SHADOW_AUDIO_DEPTH ignored: checkpoint uses weighted audio pooling", file=sys.stderr)
+        else:
+            truncate_layers(_model.wav2vec, AUDIO_DEPTH)
+    _model.chunk_seconds = CHUNK_SECONDS
+    checksum = file_checksum(active_path)
+    text_cache = TextEmbeddingCache(max_size=TEXT_CACHE_SIZE, namespace=checksum, path=TEXT_CACHE_PATH)
+    if RESULT_CACHE_PATH:
+        # cấu hình tiền xử lý cũng đổi kết quả -> nằm trong namespace;
+        # pool=clip: bỏ các dòng ghi trước khi điểm độc lập với batch (còn lẫn padding)
+        result_cache = ResultCache(RESULT_CACHE_PATH, ttl_s=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_SIZE,
+                                   namespace=f"{checksum}|pool=clip|trim={int(TRIM_SILENCE)}|chunk={CHUNK_SECONDS}"
+                                             f"|audio_layers={_model.layer_counts()['audio_layers']}")
+    mlb = _mlb
+    model = _model
+    ready_seconds = time.perf_counter() - IMPORT_T0
+    print(f"Shadow AI ready: load {time.perf_counter() - t0:.2f}s, "
+          f"import-to-ready {ready_seconds:.2f}s", file=sys.stderr)
+
+
+def prepare_fork():
+    """
+    Gọi trong process cha ngay trước khi fork worker (shadowPrefork.py): đóng
+    kết nối SQLite của thread này và freeze GC để refcount/GC không ghi vào
+    (và làm copy) các trang object dùng chung.
+    """
+    if result_cache is not None:
+        result_cache.close()
+    gc.collect()
+    gc.freeze()
 
 
 def load_audio(audio_path: str):
     """Đọc file audio và resample về SAMPLE_RATE"""
-    wav, _ = librosa.load(audio_path, sr=SAMPLE_RATE, mono=True)
-    return wav.astype("float32")
+    wav, _ = decode_audio(audio_path)
+    return wav
+
+
+def predict_batch(wavs, texts, threshold: float = 0.5):
+    """Chạy 1 forward cho cả batch, trả về list [(score, [errors]), ...]"""
+    load_resources()
+    if TRIM_SILENCE:
+        wavs = [trim_silence(w) for w in wavs]
+
+    with metrics.span("feature_extract"):
+        # mỗi clip chuẩn hóa / pool trên phần của riêng nó: điểm không phụ thuộc batch
+        audio_inputs = audio_batch(wavs)
+        for k in audio_inputs:
+            audio_inputs[k] = audio_inputs[k].to(DEVICE)
+
+    # câu đã gặp -> lấy embedding từ cache, chỉ chạy nhánh audio
+    text_emb = text_cache.encode(model, list(texts))
+
+    with torch.no_grad():
+        scores, err_logits = model(audio_inputs, text_emb=text_emb)
+    return _postprocess(scores, err_logits, threshold)
+
+
+def _postprocess(scores, err_logits, threshold: float):
+    with metrics.span("postprocess"):
+        scores = (scores.cpu() * 100.0).tolist()
+        probs = torch.sigmoid(err_logits).cpu().numpy()
+        preds = (probs > threshold).astype(int)
+        labels = mlb.inverse_transform(preds)
+    return [(float(s), list(l)) for s, l in zip(scores, labels)]
+
+
+class StreamSession:
+    """
+    1 lượt nói trực tiếp: nhận audio float32 16 kHz từng đoạn, chạy wav2vec2
+    ngay khi đủ 1 cửa sổ và giữ embedding trung bình cộng dồn.
+    `feed` trả về (score, errors) tạm thời khi có cửa sổ mới được encode;
+    `finish` chỉ encode phần đuôi nên kết quả cuối có ngay sau ~1 cửa sổ.
+    """
+    def __init__(self, text: str, threshold: float = 0.5,
+                 window_s: float = STREAM_WINDOW_SECONDS, overlap_s: float = STREAM_OVERLAP_SECONDS):
+        load_resources()
+        self.threshold = threshold
+        self.text_emb = text_cache.encode(model, [text])
+        self.encoder = StreamingAudioEncoder(model, window_s, overlap_s, normalize=True)
+        self.samples = 0
+
+    @property
+    def seconds(self) -> float:
+        return self.samples / SAMPLE_RATE
+
+    def feed(self, wav):
+        self.samples += len(wav)
+        with torch.no_grad(), metrics.span("stream_chunk"):
+            if not self.encoder.feed(wav):
+                return None
+        return self._result()
+
+    def finish(self):
+        with torch.no_grad(), metrics.span("stream_finish"):
+            if self.encoder.finish() is None:
+                raise ValueError("Không nhận được audio")
+        return self._result()
+
+    def _result(self):
+        with torch.no_grad():
+            scores, err_logits = model.head(self.encoder.pooled(), self.text_emb.to(self.encoder.device))
+        return _postprocess(scores, err_logits, self.threshold)[0]
+
+
+def cached_result(wav, text: str, threshold: float = 0.5):
+    """(cache_key, (score, errors) hoặc None). cache_key là None khi cache tắt."""
+    load_resources()
+    if result_cache is None:
+        return None, None
+    key = result_cache.key(wav, text, threshold)
+    return key, result_cache.get(key)
+
+
+def store_result(key, score: float, errors):
+    if key is not None and result_cache is not None:
+        result_cache.put(key, score, errors)
+
+
+def score_audio(wav, text: str, threshold: float = 0.5):
+    """(score, [errors], cache_hit): trả kết quả cache nếu audio + câu đã được chấm."""
+    key, hit = cached_result(wav, text, threshold)
+    if hit is not None:
+        return hit[0], hit[1], True
+    score, errors = predict_batch([wav], [text], threshold=threshold)[0]
+    store_result(key, score, errors)
+    return score, errors, False
 
 
 def predict(audio_path: str, text: str, threshold: float = 0.5):
     """Chạy model, trả về (score, [errors])"""
-    model.eval()
-
-    wav = load_audio(audio_path)
-
-    audio_inputs = wav2vec_proc(
-        [wav],
-        sampling_rate=SAMPLE_RATE,
-        return_tensors="pt",
-        padding=True,
-    )
-    for k in audio_inputs:
-        audio_inputs[k] = audio_inputs[k].to(DEVICE)
-
-    text_inputs = tokenizer(
-        [text],
-        return_tensors="pt",
-        truncation=True,
-        padding=True,
-        max_length=128,
-    )
-    for k in text_inputs:
-        text_inputs[k] = text_inputs[k].to(DEVICE)
+    score, errors, _ = score_audio(load_audio(audio_path), text, threshold=threshold)
+    return score, errors
 
-    with torch.no_grad():
-        score, err_logits = model(audio_inputs, text_inputs)
-        score = float(score.cpu().item() * 100.0)
-        probs = torch.sigmoid(err_logits).cpu().numpy()[0]
-        preds = (probs > threshold).astype(int).reshape(1, -1)
-        labels = mlb.inverse_transform(preds)[0]
 
-    return score, list(labels)
+def serve_worker(stdin=sys.stdin, stdout=sys.stdout):
+    """
+    Chế độ worker: giữ model trong bộ nhớ, đọc request JSON-lines từ stdin,
+    trả kết quả JSON-lines ra stdout (mỗi request một dòng, cùng "id").
+
+      request:  {"id": 1, "audio_path": "...", "text": "...", "threshold": 0.5}
+      response: {"id": 1, "score": 87.5, "errors": [...], "cache_hit": false}
+                {"id": 1, "error": "..."}  (khi lỗi)
+    """
+    # mọi print/log khác đẩy sang stderr để không làm hỏng giao thức
+    sys.stdout = sys.stderr
+    load_resources()
+    stdout.write(json.dumps({"ready": True}) + "\n")
+    stdout.flush()
+
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        req_id = None
+        try:
+            req = json.loads(line)
+            req_id = req.get("id")
+            score, errors, cache_hit = score_audio(load_audio(req["audio_path"]), req["text"],
+                                                   threshold=float(req.get("threshold", 0.5)))
+            resp = {"id": req_id, "score": score, "errors": errors, "cache_hit": cache_hit}
+        except Exception as e:
+            resp = {"id": req_id, "error": f"{type(e).__name__}: {e}"}
+        stdout.write(json.dumps(resp, ensure_ascii=False) + "\n")
+        stdout.flush()
+
+    text_cache.save()
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        serve_worker()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--snapshot":
+        # tải processor + backbone 1 lần về SHADOW_PRETRAINED_DIR (hoặc thư mục truyền vào) để boot offline
+        snapshot_pretrained(*sys.argv[2:3])
+        sys.exit(0)
+
     audio_path = sys.argv[1]
     text = sys.argv[2]
 
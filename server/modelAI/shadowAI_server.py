@@ -1,27 +1,368 @@
-from fastapi import FastAPI, UploadFile, Form
-from shadowAI_api import predict
-import tempfile
-import shutil
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import shadowAI_api as engine
+from shadowAI_api import BASE_DIR, decode_audio, predict_batch, StreamSession
+from shadowAudio import PcmStream, SAMPLE_RATE
+from shadowBatcher import MicroBatcher, Overloaded
+from shadowJobs import PRIORITIES, ClientLimited, ClientLimiter, Job, JobStore, post_callback
+from shadowMetrics import metrics, process_gauges
+import time
 import os
+import sys
+import json
+import traceback
+import math
+import asyncio
 import uvicorn
+from urllib.parse import urlparse
+
+# Cấu hình micro-batching (chỉnh để cân bằng throughput và p99 latency)
+MAX_BATCH = int(os.environ.get("SHADOW_MAX_BATCH", "8"))
+MAX_WAIT_MS = float(os.environ.get("SHADOW_MAX_WAIT_MS", "20"))
+# Tách batch theo độ dài audio (0 = tắt). Chỉ ảnh hưởng throughput: mỗi clip được
+# chuẩn hóa và pool trên frame của riêng nó (ShadowNet.encode_audio), nên điểm không
+# phụ thuộc tỉ lệ này (kiểm tra: shadowExport.py batch-selfcheck)
+BUCKET_RATIO = float(os.environ.get("SHADOW_BUCKET_RATIO", "2.0"))
+# Thư mục Node ghi file sẵn, cho phép truyền audio_path thay vì upload lại
+SHARED_AUDIO_DIR = os.path.realpath(
+    os.environ.get("SHADOW_SHARED_AUDIO_DIR", os.path.join(BASE_DIR, "..", "uploads"))
+)
+# Trả chi tiết thời gian từng stage trong field "timing" của response
+ECHO_TIMING = os.environ.get("SHADOW_ECHO_TIMING", "1") == "1"
+# Backpressure: hàng đợi tối đa (0 = không giới hạn), số chỗ chỉ dành cho "interactive",
+# request chờ quá N giây bị bỏ (0 = tắt)
+MAX_QUEUE = int(os.environ.get("SHADOW_MAX_QUEUE", "256"))
+BULK_RESERVE = int(os.environ.get("SHADOW_BULK_RESERVE", "64"))
+QUEUE_TIMEOUT_S = float(os.environ.get("SHADOW_QUEUE_TIMEOUT_S", "30"))
+# Số request đang chờ + đang chạy tối đa của 1 client (X-Client-Id / client_id / IP), 0 = tắt
+CLIENT_CONCURRENCY = int(os.environ.get("SHADOW_CLIENT_CONCURRENCY", "8"))
+# Job /jobs: giữ kết quả N giây để poll; host được phép làm callback_url ("*" = mọi host)
+JOB_TTL_S = float(os.environ.get("SHADOW_JOB_TTL_S", "600"))
+CALLBACK_HOSTS = {h.strip() for h in os.environ.get("SHADOW_CALLBACK_HOSTS", "127.0.0.1,localhost").split(",")
+                  if h.strip()}
 
 app = FastAPI(title="Shadow AI Server")
+batcher = MicroBatcher(predict_batch, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS,
+                       bucket_ratio=BUCKET_RATIO, max_queue=MAX_QUEUE, reserve=BULK_RESERVE,
+                       queue_timeout_s=QUEUE_TIMEOUT_S)
+limiter = ClientLimiter(CLIENT_CONCURRENCY)
+jobs = JobStore(ttl_s=JOB_TTL_S)
+
+@app.on_event("startup")
+async def startup():
+    await batcher.start()
+    # load model nền: /health trả lời ngay, /ready báo khi load xong (hoặc lỗi)
+    asyncio.get_running_loop().run_in_executor(None, engine.load_resources).add_done_callback(_loaded)
+
+def _loaded(fut: asyncio.Future):
+    if fut.cancelled() or fut.exception() is None:
+        return
+    e = fut.exception()
+    print("❌ Load model thất bại:", file=sys.stderr)
+    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await batcher.stop()
+    if engine.text_cache is not None:
+        engine.text_cache.save()
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+def _unavailable(status: int, detail: str, retry_after: float):
+    """429/503 kèm Retry-After (giây, làm tròn lên) để client biết khi nào thử lại."""
+    return HTTPException(status_code=status, detail=detail,
+                         headers={"Retry-After": str(max(1, int(math.ceil(retry_after))))})
+
+def _not_ready_detail() -> str:
+    if engine.load_error:
+        return f"Load model thất bại: {engine.load_error}"
+    return "Model đang load"
+
+def _check_ready():
+    if not engine.is_ready():
+        if engine.load_error:
+            # không tự khỏi: cần sửa cấu hình / checkpoint rồi khởi động lại
+            raise HTTPException(status_code=503, detail=_not_ready_detail())
+        raise _unavailable(503, _not_ready_detail(), 5)
+
+@app.get("/ready")
+async def ready():
+    _check_ready()
+    return {"status": "ready", "import_to_ready_s": engine.ready_seconds}
+
+@app.get("/stats")
+async def stats():
+    text_stats = engine.text_cache.stats() if engine.text_cache is not None else {}
+    result_stats = engine.result_cache.stats() if engine.result_cache is not None else {}
+    return {**batcher.stats(), "text_cache": text_stats, "result_cache": result_stats,
+            "clients": limiter.stats(), "jobs": jobs.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_api():
+    batch_stats = batcher.stats()
+    gauges = {
+        **process_gauges(),
+        "shadow_queue_depth": batch_stats["queue_depth"],
+        "shadow_batches_total": batch_stats["total_batches"],
+        "shadow_batched_requests_total": batch_stats["total_requests"],
+        "shadow_model_ready": int(engine.is_ready()),
+        "shadow_model_load_failed": int(engine.load_error is not None),
+        "shadow_queue_retry_after_seconds": batch_stats["retry_after_s"],
+        "shadow_client_active_requests": limiter.stats()["active"],
+        "shadow_jobs_stored": jobs.stats()["jobs"],
+    }
+    if engine.text_cache is not None:
+        for k, v in engine.text_cache.stats().items():
+            gauges[f"shadow_text_cache_{k}"] = v
+    if engine.result_cache is not None:
+        for k, v in engine.result_cache.stats().items():
+            gauges[f"shadow_result_cache_{k}"] = v
+    return metrics.render(gauges)
+
+def _shared_path(audio_path: str) -> str:
+    path = os.path.realpath(audio_path)
+    if os.path.commonpath([path, SHARED_AUDIO_DIR]) != SHARED_AUDIO_DIR:
+        raise HTTPException(status_code=400, detail="audio_path nằm ngoài thư mục cho phép")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=400, detail="Không tìm thấy audio_path")
+    return path
+
+def _priority(name: str) -> int:
+    if name not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority phải là một trong {sorted(PRIORITIES)}")
+    return PRIORITIES[name]
+
+def _client_id(request: Request, client_id: str = None) -> str:
+    return client_id or request.headers.get("x-client-id") or (request.client.host if request.client else "-")
+
+def _admit(client: str, priority: int):
+    """Từ chối sớm (trước khi đọc/giải mã audio): 429 khi client vượt giới hạn, 503 khi hàng đợi đầy."""
+    try:
+        batcher.admit(priority)
+        limiter.acquire(client, retry_after=batcher.retry_after())
+    except Overloaded as e:
+        raise _unavailable(503, str(e), e.retry_after)
+    except ClientLimited as e:
+        raise _unavailable(429, str(e), e.retry_after)
+
+async def _decode_request(file: UploadFile, audio_path: str):
+    # giải mã thẳng từ bytes upload (hoặc file Node đã ghi), không ghi file tạm
+    if file is not None:
+        with metrics.span("upload"):
+            source = await file.read()
+    elif audio_path:
+        source = _shared_path(audio_path)
+    else:
+        raise HTTPException(status_code=400, detail="Thiếu file hoặc audio_path")
+    return await run_in_threadpool(decode_audio, source)
+
 @app.post("/predict")
-async def predict_api(file: UploadFile, text: str = Form(...)):
-    tmp_path = tempfile.mktemp(suffix=".wav")
+async def predict_api(request: Request, file: UploadFile = File(None), text: str = Form(...),
+                      audio_path: str = Form(None), priority: str = Form("interactive"),
+                      client_id: str = Form(None)):
+    _check_ready()
+    t0 = time.perf_counter()
+    client = _client_id(request, client_id)
+    _admit(client, _priority(priority))
     try:
-        with open(tmp_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        score, errors = predict(tmp_path, text)
-        return {"score": score, "errors": errors}
+        wav, timing = await _decode_request(file, audio_path)
+        # upload lặp lại (client retry) -> trả kết quả cũ, không chạy lại 2 backbone
+        key, hit = await run_in_threadpool(engine.cached_result, wav, text)
+        if hit is not None:
+            score, errors = hit
+            metrics.inc("shadow_result_cache_hits_total")
+        else:
+            score, errors = await batcher.submit(wav, text, timing=timing if ECHO_TIMING else None,
+                                                 priority=PRIORITIES[priority])
+            await run_in_threadpool(engine.store_result, key, score, errors)
+    except Overloaded as e:
+        raise _unavailable(503, str(e), e.retry_after)
     finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        limiter.release(client)
+    total = time.perf_counter() - t0
+    metrics.observe("request", total)
+    metrics.inc("shadow_requests_total")
+    timing["total_ms"] = total * 1000.0
+    return {"score": score, "errors": errors, "cache_hit": hit is not None, "timing": timing}
+
+# --------- Job bất đồng bộ ----------
+def _callback_url(url: str) -> str:
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise HTTPException(status_code=400, detail="callback_url phải là URL http(s)")
+    if "*" not in CALLBACK_HOSTS and parsed.hostname not in CALLBACK_HOSTS:
+        raise HTTPException(status_code=400, detail="Host của callback_url không được phép")
+    return url
+
+def _job_response(job: Job, status_code: int = 200):
+    data = job.to_dict()
+    headers = {}
+    if job.status == "queued":
+        # gợi ý thời điểm poll lại
+        data["queue_depth"] = batcher.depth()
+        data["retry_after"] = batcher.retry_after()
+        headers["Retry-After"] = str(max(1, int(data["retry_after"])))
+    if status_code == 202:
+        headers["Location"] = f"/jobs/{job.id}"
+    return JSONResponse(data, status_code=status_code, headers=headers)
+
+async def _finish_job(job: Job):
+    job.finished = time.time()
+    limiter.release(job.client)
+    if job.callback_url:
+        await run_in_threadpool(post_callback, job.callback_url, job.to_dict())
+
+async def _run_job(job: Job, fut, key):
+    try:
+        (score, errors), _, started = await fut
+        job.started = time.time() - (time.perf_counter() - started)
+        await run_in_threadpool(engine.store_result, key, score, errors)
+        job.result = {"score": score, "errors": errors, "cache_hit": False}
+        job.status = "done"
+    except asyncio.CancelledError:
+        job.status = "cancelled"
+    except Exception as e:
+        job.status = "failed"
+        job.error = f"{type(e).__name__}: {e}"
+    await _finish_job(job)
+
+@app.post("/jobs")
+async def submit_job(request: Request, file: UploadFile = File(None), text: str = Form(...),
+                     audio_path: str = Form(None), priority: str = Form("bulk"),
+                     client_id: str = Form(None), callback_url: str = Form(None)):
+    """
+    Nộp 1 bài chấm, trả 202 + job_id ngay; kết quả lấy bằng GET /jobs/{id}
+    hoặc được POST tới callback_url khi xong. Mặc định priority "bulk"
+    (chấm lại hàng loạt) để không chặn /predict "interactive".
+    """
+    _check_ready()
+    prio = _priority(priority)
+    callback = _callback_url(callback_url)
+    client = _client_id(request, client_id)
+    _admit(client, prio)
+    try:
+        wav, _ = await _decode_request(file, audio_path)
+        key, hit = await run_in_threadpool(engine.cached_result, wav, text)
+        job = Job(client, priority, callback)
+        if hit is None:
+            fut = batcher.enqueue(wav, text, prio)
+    except Overloaded as e:
+        limiter.release(client)
+        raise _unavailable(503, str(e), e.retry_after)
+    except BaseException:
+        limiter.release(client)
+        raise
+    jobs.add(job)
+    metrics.inc("shadow_jobs_total")
+    if hit is not None:
+        metrics.inc("shadow_result_cache_hits_total")
+        job.result = {"score": hit[0], "errors": hit[1], "cache_hit": True}
+        job.status = "done"
+        job.task = asyncio.create_task(_finish_job(job))
+        return _job_response(job, 202)
+    job.task = asyncio.create_task(_run_job(job, fut, key))
+    return _job_response(job, 202)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job (hoặc đã hết hạn)")
+    return _job_response(job)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job (hoặc đã hết hạn)")
+    if job.status == "queued" and job.task is not None:
+        job.task.cancel()
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            pass
+    return _job_response(job)
+
+async def _stream_error(ws: WebSocket, detail: str, code: int):
+    # client có thể đã ngắt: gửi lỗi / đóng socket là best-effort
+    try:
+        await ws.send_json({"type": "error", "detail": detail})
+        await ws.close(code=code)
+    except Exception:
+        pass
+
+@app.websocket("/stream")
+async def stream_api(ws: WebSocket):
+    """
+    Chấm điểm trong lúc học viên đang nói.
+      -> {"type": "start", "text": ..., "sample_rate": 16000, "threshold": 0.5, "provisional": true}
+      -> binary: PCM 16-bit little-endian mono, gửi từng đoạn
+      -> {"type": "end"}
+    <- {"type": "provisional", "score", "errors", "seconds"} sau mỗi cửa sổ được encode
+    <- {"type": "final", "score", "errors", "seconds", "finalize_ms"}
+    <- {"type": "error", "detail"} rồi đóng với code 1008 (dữ liệu sai), 1011 (lỗi server), 1013 (model chưa sẵn sàng)
+
+    Mọi việc của model chạy trên thread inference của batcher, không song song với /predict.
+    """
+    await ws.accept()
+    try:
+        if not engine.is_ready():
+            await _stream_error(ws, _not_ready_detail(), 1011 if engine.load_error else 1013)
+            return
+        start = await ws.receive_json()
+        if not isinstance(start, dict) or start.get("type") != "start" or not str(start.get("text", "")).strip():
+            await _stream_error(ws, "Cần gửi {type: start, text} trước", 1008)
+            return
+        try:
+            provisional = bool(start.get("provisional", True))
+            sample_rate = int(start.get("sample_rate", SAMPLE_RATE))
+            threshold = float(start.get("threshold", 0.5))
+            if sample_rate <= 0:
+                raise ValueError(sample_rate)
+        except (TypeError, ValueError):
+            await _stream_error(ws, "sample_rate / threshold không hợp lệ", 1008)
+            return
+
+        pcm = PcmStream(sample_rate)
+        session = await batcher.run(StreamSession, start["text"], threshold)
+        metrics.inc("shadow_streams_total")
+
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                return
+            if msg.get("bytes") is not None:
+                result = await batcher.run(session.feed, pcm.push(msg["bytes"]))
+                if result is not None and provisional:
+                    score, errors = result
+                    await ws.send_json({"type": "provisional", "score": score, "errors": errors,
+                                        "seconds": session.seconds})
+            elif msg.get("text") and json.loads(msg["text"]).get("type") == "end":
+                t0 = time.perf_counter()
+                tail = pcm.push(b"", last=True)
+                if len(tail):
+                    await batcher.run(session.feed, tail)
+                try:
+                    score, errors = await batcher.run(session.finish)
+                except ValueError as e:
+                    await _stream_error(ws, str(e), 1008)
+                    return
+                await ws.send_json({"type": "final", "score": score, "errors": errors,
+                                    "seconds": session.seconds,
+                                    "finalize_ms": (time.perf_counter() - t0) * 1000.0})
+                break
+        await ws.close()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        metrics.inc("shadow_stream_errors_total")
+        await _stream_error(ws, f"Lỗi xử lý stream: {e}", 1011)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
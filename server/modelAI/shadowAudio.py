@@ -0,0 +1,199 @@
+# shadowAudio.py
+# Giải mã + resample audio, không phụ thuộc torch/transformers để các process
+# phụ (decode pool) import nhẹ.
+import io
+import os
+import json
+import time
+import tempfile
+
+import librosa
+import numpy as np
+import soundfile as sf
+import soxr
+
+from shadowMetrics import metrics
+
+SAMPLE_RATE = 16000
+
+
+def decode_audio(source):
+    """
+    Giải mã audio từ bytes (upload trong RAM) hoặc đường dẫn file.
+    Trả về (wav float32 mono SAMPLE_RATE, {"decode_ms", "resample_ms"}).
+
+    WAV/FLAC/OGG đọc thẳng bằng soundfile; nếu đã là 16 kHz mono (Node đã
+    convert bằng ffmpeg) thì bỏ qua resample. Định dạng khác (mp3, webm...)
+    mới rơi về librosa.
+    """
+    t0 = time.perf_counter()
+    try:
+        data = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+        wav, sr = sf.read(data, dtype="float32", always_2d=True)
+        wav = wav.mean(axis=1) if wav.shape[1] > 1 else wav[:, 0]
+    except Exception:
+        wav, sr = _decode_fallback(source)
+    t1 = time.perf_counter()
+
+    if sr != SAMPLE_RATE:
+        wav = soxr.resample(wav, sr, SAMPLE_RATE, quality="HQ")
+    t2 = time.perf_counter()
+
+    metrics.observe("decode", t1 - t0)
+    metrics.observe("resample", t2 - t1)
+    timing = {"decode_ms": (t1 - t0) * 1000.0, "resample_ms": (t2 - t1) * 1000.0}
+    return np.ascontiguousarray(wav, dtype=np.float32), timing
+
+
+def _decode_fallback(source):
+    """librosa/audioread cho định dạng soundfile không đọc được (giữ nguyên sample rate)."""
+    if not isinstance(source, (bytes, bytearray)):
+        wav, sr = librosa.load(source, sr=None, mono=True)
+        return wav, sr
+    with tempfile.NamedTemporaryFile(suffix=".audio", delete=False) as f:
+        f.write(source)
+        tmp_path = f.name
+    try:
+        wav, sr = librosa.load(tmp_path, sr=None, mono=True)
+    finally:
+        os.remove(tmp_path)
+    return wav, sr
+
+
+class PcmStream:
+    """
+    Chuyển từng đoạn PCM 16-bit little-endian mono (đoạn ghi âm trực tiếp) sang
+    float32 SAMPLE_RATE. Resample dùng soxr.ResampleStream nên không bị vỡ ở
+    ranh giới giữa các đoạn.
+    """
+    def __init__(self, sample_rate: int = SAMPLE_RATE):
+        self.sample_rate = int(sample_rate)
+        self._resampler = (soxr.ResampleStream(self.sample_rate, SAMPLE_RATE, 1, dtype="float32", quality="HQ")
+                           if self.sample_rate != SAMPLE_RATE else None)
+        self._odd = b""  # byte lẻ còn lại nếu 1 đoạn bị cắt giữa sample
+
+    def push(self, data: bytes, last: bool = False) -> np.ndarray:
+        data = self._odd + bytes(data)
+        cut = len(data) - len(data) % 2
+        data, self._odd = data[:cut], data[cut:]
+        wav = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+        if self._resampler is not None:
+            wav = self._resampler.resample_chunk(wav, last=last)
+        return wav
+
+
+def trim_silence(wav: np.ndarray, threshold_db: float = -40.0, frame_ms: float = 25.0,
+                 hop_ms: float = 10.0, pad_ms: float = 150.0, min_ms: float = 500.0) -> np.ndarray:
+    """
+    VAD năng lượng đơn giản: cắt im lặng đầu/cuối clip trước khi vào backbone.
+    Frame có RMS thấp hơn đỉnh `threshold_db` dB bị coi là im lặng; giữ thêm
+    `pad_ms` mỗi đầu. Clip ngắn hơn `min_ms` hoặc toàn im lặng giữ nguyên.
+    Trả về view (không copy) của `wav`.
+    """
+    frame = int(SAMPLE_RATE * frame_ms / 1000.0)
+    hop = int(SAMPLE_RATE * hop_ms / 1000.0)
+    if len(wav) < max(frame, int(SAMPLE_RATE * min_ms / 1000.0)):
+        return wav
+    with metrics.span("vad"):
+        n_frames = 1 + (len(wav) - frame) // hop
+        frames = np.lib.stride_tricks.as_strided(
+            wav, shape=(n_frames, frame), strides=(wav.strides[0] * hop, wav.strides[0]), writeable=False)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1) + 1e-12)
+        db = 20.0 * np.log10(rms / rms.max())
+        voiced = np.flatnonzero(db > threshold_db)
+        if voiced.size == 0:
+            return wav
+        pad = int(SAMPLE_RATE * pad_ms / 1000.0)
+        start = max(0, voiced[0] * hop - pad)
+        end = min(len(wav), voiced[-1] * hop + frame + pad)
+        if end - start < int(SAMPLE_RATE * min_ms / 1000.0):
+            return wav
+        return wav[start:end]
+
+
+# --------- Pre-resampled audio pack ----------
+def _pack_decode(audio_path: str):
+    try:
+        wav, _ = decode_audio(audio_path)
+        return wav
+    except Exception as e:
+        print(f"⚠ Corrupt audio: {audio_path} ({e}), skipped")
+        return None
+
+
+def build_audio_pack(audio_folder: str, out_prefix: str, workers: int = None):
+    """
+    Chuyển 1 lần toàn bộ *.wav trong `audio_folder` sang 16 kHz float32,
+    ghi nối tiếp vào `<out_prefix>.f32` kèm index `<out_prefix>.idx.json`
+    ({id: [offset, length]} tính theo sample). Decode chạy trong pool process.
+    """
+    from multiprocessing import get_context
+
+    ids = sorted(name[:-4] for name in os.listdir(audio_folder) if name.lower().endswith(".wav"))
+    paths = [os.path.join(audio_folder, i + ".wav") for i in ids]
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+
+    index = {}
+    offset = 0
+    t0 = time.perf_counter()
+    with open(out_prefix + ".f32", "wb") as f, get_context("spawn").Pool(workers) as pool:
+        # imap giữ đúng thứ tự -> ghi tuần tự, offset liên tục
+        for file_id, wav in zip(ids, pool.imap(_pack_decode, paths, chunksize=8)):
+            if wav is None:
+                continue
+            f.write(wav.tobytes())
+            index[file_id] = [offset, int(len(wav))]
+            offset += len(wav)
+    with open(out_prefix + ".idx.json", "w", encoding="utf-8") as f:
+        json.dump({"sample_rate": SAMPLE_RATE, "items": index}, f)
+    print(f"Packed {len(index)}/{len(ids)} files, {offset / SAMPLE_RATE / 3600:.2f} h audio, "
+          f"{offset * 4 / 1e6:.1f} MB in {time.perf_counter() - t0:.1f}s -> {out_prefix}.f32")
+    return out_prefix
+
+
+class AudioPack:
+    """
+    Đọc pack tạo bởi build_audio_pack qua np.memmap; `get(id)` trả về view
+    (không copy) của đoạn audio. Khi pickle sang DataLoader worker chỉ
+    gửi đường dẫn, worker tự mở lại memmap.
+    """
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        with open(prefix + ".idx.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("sample_rate") != SAMPLE_RATE:
+            raise ValueError(f"{prefix}: pack sample_rate {meta.get('sample_rate')} != {SAMPLE_RATE}")
+        self.index = meta["items"]
+        self._data = None
+
+    @staticmethod
+    def exists(prefix: str) -> bool:
+        return os.path.exists(prefix + ".f32") and os.path.exists(prefix + ".idx.json")
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.prefix + ".f32", dtype=np.float32, mode="r")
+        return self._data
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self.index
+
+    def length(self, file_id: str) -> int:
+        return self.index[file_id][1]
+
+    def get(self, file_id: str) -> np.ndarray:
+        offset, length = self.index[file_id]
+        return self.data[offset:offset + length]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        raise SystemExit("Usage: python shadowAudio.py <audio_folder> <out_prefix>")
+    build_audio_pack(sys.argv[1], sys.argv[2])
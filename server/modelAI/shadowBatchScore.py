@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# shadowBatchScore.py
+# Chấm điểm hàng loạt (regrade / đánh giá model) từ CSV + thư mục WAV.
+#
+#   python shadowBatchScore.py --csv data.csv --audio ../wav --out scores.jsonl
+#
+# CSV cùng schema với ShadowDataset (cần cột id, scrip). Audio được giải mã
+# trong pool process, forward chạy theo batch ở process chính, kết quả ghi
+# dần ra file (.jsonl hoặc .csv). Chạy lại cùng --out sẽ bỏ qua id đã chấm
+# thành công; id lỗi (thiếu file, lỗi giải mã / IO) được thử lại và ghi thêm
+# dòng mới, dòng "ok" là kết quả.
+# Vài clip đầu được chấm lại riêng lẻ (--spot-check) để chắc điểm theo batch
+# trùng với điểm /predict; lệch thì exit 1.
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from collections import deque
+import multiprocessing as mp
+
+from shadowAudio import decode_audio
+
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+
+def _decode_row(args):
+    """Chạy trong process phụ: chỉ import shadowAudio, không load model."""
+    file_id, text, audio_path = args
+    if not os.path.exists(audio_path):
+        return file_id, text, None, "missing audio"
+    try:
+        wav, _ = decode_audio(audio_path)
+        return file_id, text, wav, None
+    except Exception as e:
+        return file_id, text, None, f"{type(e).__name__}: {e}"
+
+
+def _done_ids(out_path: str):
+    """Id đã chấm thành công trong `out_path`; dòng lỗi không tính để được thử lại."""
+    if not os.path.exists(out_path):
+        return set()
+    done = set()
+    with open(out_path, "r", encoding="utf-8") as f:
+        if out_path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                if row.get("status") == "ok":
+                    done.add(row["id"])
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                    if rec.get("status", "ok") == "ok":
+                        done.add(str(rec["id"]))
+                except (ValueError, KeyError, AttributeError):
+                    continue  # dòng ghi dở khi bị dừng giữa chừng
+    return done
+
+
+class ResultWriter:
+    def __init__(self, out_path: str):
+        self.is_csv = out_path.endswith(".csv")
+        new_file = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+        self.f = open(out_path, "a", encoding="utf-8", newline="")
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.f, fieldnames=["id", "score", "errors", "status"])
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, file_id, score=None, errors=None, status="ok"):
+        if self.is_csv:
+            self.writer.writerow({"id": file_id, "score": "" if score is None else f"{score:.4f}",
+                                  "errors": ", ".join(errors or []), "status": status})
+        else:
+            rec = {"id": file_id, "score": score, "errors": errors or []}
+            if status != "ok":
+                rec["status"] = status
+            self.f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def batch_score(csv_path: str, audio_folder: str, out_path: str,
+                workers: int = DEFAULT_WORKERS, batch_size: int = 8, threshold: float = 0.5,
+                bucket_ratio: float = 2.0, spot_check: int = 8, max_spot_diff: float = 0.01) -> dict:
+    # import nặng (torch, model) chỉ ở process chính
+    from shadowModel import read_csv_auto, clean_text
+    from shadowAI_api import predict_batch
+    from shadowBatcher import length_buckets
+
+    df = read_csv_auto(csv_path)
+    if "id" not in df.columns:
+        raise ValueError("CSV must contain 'id' column")
+    texts = df["scrip"].apply(clean_text) if "scrip" in df.columns else [""] * len(df)
+
+    done = _done_ids(out_path)
+    rows = [(str(file_id), text, os.path.join(audio_folder, f"{file_id}.wav"))
+            for file_id, text in zip(df["id"], texts) if str(file_id) not in done]
+    print(f"{len(rows)} to score ({len(done)} already in {out_path})")
+    if not rows:
+        return {"scored": 0, "spot_checked": 0, "spot_max_diff": 0.0, "ok": True}
+
+    writer = ResultWriter(out_path)
+    scored = 0
+    spot_diffs = []
+    start = time.perf_counter()
+
+    def flush_batch(batch):
+        nonlocal scored
+        results = predict_batch([b[2] for b in batch], [b[1] for b in batch], threshold=threshold)
+        for (file_id, _, _), (score, errors) in zip(batch, results):
+            writer.write(file_id, score, errors)
+        writer.flush()
+        # chấm lại riêng từng clip như /predict: điểm không được phụ thuộc clip chung batch
+        for (_, text, wav), (score, _) in zip(batch, results):
+            if len(spot_diffs) >= spot_check:
+                break
+            spot_diffs.append(abs(score - predict_batch([wav], [text], threshold=threshold)[0][0]))
+        scored += len(batch)
+        rate = scored / (time.perf_counter() - start)
+        print(f"  {scored}/{len(rows)} scored, {rate:.2f} utt/s")
+
+    def flush_window(window):
+        # gom theo độ dài trên cả cửa sổ đã giải mã (không chỉ trong 1 batch) để giảm padding
+        for group in length_buckets(window, lambda item: len(item[2]), bucket_ratio, batch_size):
+            flush_batch(group)
+
+    prefetch = max(batch_size * 4, workers * 2)
+    # spawn: process phụ không kế thừa torch/model từ process chính
+    with mp.get_context("spawn").Pool(processes=workers) as pool:
+        pending = deque()
+        it = iter(rows)
+        window = []
+        while True:
+            # giữ tối đa `prefetch` file đang giải mã để RAM không phình
+            while len(pending) < prefetch:
+                row = next(it, None)
+                if row is None:
+                    break
+                pending.append(pool.apply_async(_decode_row, (row,)))
+            if not pending:
+                break
+
+            file_id, text, wav, err = pending.popleft().get()
+            if err is not None:
+                writer.write(file_id, status=err)
+                continue
+            window.append((file_id, text, wav))
+            if len(window) >= batch_size * 4:
+                flush_window(window)
+                window = []
+        if window:
+            flush_window(window)
+
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"Done: {scored} utterances in {elapsed:.1f}s ({scored / max(elapsed, 1e-9):.2f} utt/s)")
+    spot_max = max(spot_diffs, default=0.0)
+    ok = spot_max <= max_spot_diff
+    if spot_diffs:
+        print(f"Spot check: {len(spot_diffs)} clips re-scored alone, max |Δscore| {spot_max:.4f}"
+              + ("" if ok else f" ❌ > {max_spot_diff}"))
+    return {"scored": scored, "spot_checked": len(spot_diffs), "spot_max_diff": spot_max, "ok": ok}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch-score shadowing recordings")
+    parser.add_argument("--csv", required=True, help="CSV with id, scrip columns")
+    parser.add_argument("--audio", required=True, help="folder containing <id>.wav")
+    parser.add_argument("--out", required=True, help="output .jsonl or .csv (appended / resumed)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--bucket-ratio", type=float, default=2.0,
+                        help="max longest/shortest clip length within one batch")
+    parser.add_argument("--spot-check", type=int, default=8,
+                        help="re-score this many clips one at a time and compare (0 = off)")
+    parser.add_argument("--max-spot-diff", type=float, default=0.01,
+                        help="exit 1 if a spot-checked score differs by more than this (0-100 scale)")
+    args = parser.parse_args()
+
+    result = batch_score(args.csv, args.audio, args.out, workers=args.workers,
+                         batch_size=args.batch, threshold=args.threshold, bucket_ratio=args.bucket_ratio,
+                         spot_check=args.spot_check, max_spot_diff=args.max_spot_diff)
+    if not result["ok"]:
+        sys.exit(1)
@@ -0,0 +1,279 @@
+# shadowBatcher.py
+# Gom các request /predict đồng thời thành 1 batch forward duy nhất.
+import asyncio
+import itertools
+import math
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from shadowMetrics import metrics
+from shadowModel import padding_ratio
+
+
+class Overloaded(Exception):
+    """Hàng đợi đầy (hoặc request chờ quá lâu): trả 503 kèm Retry-After `retry_after` giây."""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def length_buckets(items: list, length: Callable, ratio: float, max_size: int = 0) -> List[list]:
+    """
+    Sắp `items` theo `length(item)` rồi tách thành các nhóm có
+    max_len / min_len <= `ratio` (và tối đa `max_size` phần tử nếu > 0).
+    """
+    items = sorted(items, key=length)
+    if not items:
+        return []
+    groups = [[items[0]]]
+    for item in items[1:]:
+        shortest = max(1, length(groups[-1][0]))
+        if length(item) / shortest > ratio or (max_size and len(groups[-1]) >= max_size):
+            groups.append([item])
+        else:
+            groups[-1].append(item)
+    return groups
+
+
+@dataclass(order=True)
+class _Request:
+    # so sánh theo (priority, seq): priority nhỏ đi trước, cùng priority thì FIFO
+    priority: int
+    seq: int
+    wav: np.ndarray = field(compare=False)
+    text: str = field(compare=False)
+    enqueued: float = field(compare=False)
+    fut: asyncio.Future = field(compare=False)
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching cho inference.
+
+    Request được đẩy vào hàng đợi; vòng lặp nền lấy request đầu tiên rồi chờ
+    thêm tối đa `max_wait_ms` (hoặc tới khi đủ `max_batch`) trước khi gọi
+    `batch_fn(wavs, texts)` trong thread riêng, để event loop không bị chặn.
+    Kết quả từng item được trả về đúng future của caller.
+
+    Nếu `bucket_ratio` được đặt, batch được sắp theo độ dài audio và tách thành
+    các nhóm có max_len / min_len <= bucket_ratio, để 1 clip dài không bắt
+    cả batch phải pad tới độ dài của nó. Đây chỉ là chuyện throughput, không
+    phải độ đúng: frame padding không vào embedding (ShadowNet.encode_audio),
+    nên `padding_ratio` trong stats là phần compute bị phí (checkpoint
+    layer-norm) hoặc số forward tách thêm theo độ dài (group-norm), không phải
+    sai số điểm.
+
+    Hàng đợi có ưu tiên (0 = cao nhất) và giới hạn `max_queue` (0 = không giới
+    hạn): request priority > 0 chỉ được nhận khi còn hơn `reserve` chỗ trống,
+    phần đó để dành cho priority 0. Khi không nhận, `enqueue` ném Overloaded
+    ngay với retry_after ước lượng từ độ sâu hàng đợi và thời gian 1 batch.
+    Request chờ quá `queue_timeout_s` bị bỏ (Overloaded) thay vì chạy cho
+    client đã timeout.
+    """
+    def __init__(self, batch_fn: Callable[[List[np.ndarray], List[str]], List[Tuple[float, list]]],
+                 max_batch: int = 8, max_wait_ms: float = 20.0, bucket_ratio: float = 2.0,
+                 stats_window: int = 1000, max_queue: int = 0, reserve: int = 0,
+                 queue_timeout_s: float = 0.0):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.bucket_ratio = bucket_ratio
+        self.max_queue = max(0, int(max_queue))
+        self.reserve = min(max(0, int(reserve)), self.max_queue)
+        self.queue_timeout = max(0.0, float(queue_timeout_s))
+        self._queue: asyncio.PriorityQueue = None
+        self._seq = itertools.count()
+        self._worker: asyncio.Task = None
+        # 1 thread: model chỉ chạy 1 forward tại 1 thời điểm
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow-infer")
+
+        # stats
+        self.batch_sizes = Counter()
+        self.wait_ms = deque(maxlen=stats_window)
+        self.infer_ms = deque(maxlen=stats_window)
+        self.padding = deque(maxlen=stats_window)
+        self.total_requests = 0
+        self.total_batches = 0
+        self.rejected = Counter()
+        self.depth_by_priority = Counter()
+
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.PriorityQueue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def service_seconds(self) -> float:
+        """Thời gian trung bình 1 batch gần đây (giây); 1s khi chưa có số đo."""
+        recent = list(self.infer_ms)[-50:]
+        return float(np.mean(recent)) / 1000.0 if recent else 1.0
+
+    def retry_after(self, depth: int = None) -> float:
+        """Ước lượng giây để hàng đợi hiện tại chạy xong: (số batch đang chờ + 1) * thời gian 1 batch."""
+        depth = self.depth() if depth is None else depth
+        return math.ceil((depth / self.max_batch + 1) * self.service_seconds())
+
+    def admit(self, priority: int = 0):
+        """Ném Overloaded nếu request `priority` không còn chỗ trong hàng đợi lúc này."""
+        if not self.max_queue:
+            return
+        depth = self.depth()
+        limit = self.max_queue if priority <= 0 else self.max_queue - self.reserve
+        if depth >= limit:
+            self.rejected["queue_full"] += 1
+            metrics.inc("shadow_rejected_queue_full_total")
+            raise Overloaded(f"Hàng đợi đầy ({depth}/{self.max_queue})", self.retry_after(depth))
+
+    def enqueue(self, wav: np.ndarray, text: str, priority: int = 0) -> asyncio.Future:
+        """
+        Đưa 1 utterance vào hàng đợi (không chờ), trả về future của
+        (result, batch_timing, started). Ném Overloaded nếu không còn chỗ.
+        Phải gọi trong event loop sau start().
+        """
+        self.admit(priority)
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Request(priority, next(self._seq), wav, text, time.perf_counter(), fut))
+        self.depth_by_priority[priority] += 1
+        return fut
+
+    async def submit(self, wav: np.ndarray, text: str, timing: dict = None, priority: int = 0):
+        """
+        Đưa 1 utterance vào hàng đợi, chờ (score, errors).
+        Nếu truyền `timing`, thời gian chờ queue và từng stage của batch được ghi vào đó (ms).
+        """
+        if self._worker is None:
+            await self.start()
+        fut = self.enqueue(wav, text, priority)
+        enqueued = time.perf_counter()
+        result, batch_timing, started = await fut
+        if timing is not None:
+            timing["queue_wait_ms"] = (started - enqueued) * 1000.0
+            timing.update(batch_timing)
+        return result
+
+    async def run(self, fn: Callable, *args):
+        """
+        Chạy `fn(*args)` (việc model không gom batch được, vd. /stream) trên
+        cùng thread inference với các batch, để không có 2 forward chạy song song.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _get(self) -> _Request:
+        item = await self._queue.get()
+        self.depth_by_priority[item.priority] -= 1
+        return item
+
+    async def _collect(self):
+        first = await self._get()
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _expired(self, item: _Request, now: float) -> bool:
+        if not self.queue_timeout or now - item.enqueued <= self.queue_timeout:
+            return False
+        self.rejected["queue_timeout"] += 1
+        metrics.inc("shadow_rejected_queue_timeout_total")
+        item.fut.set_exception(Overloaded(f"Chờ quá {self.queue_timeout:.0f}s trong hàng đợi",
+                                          self.retry_after()))
+        return True
+
+    def _buckets(self, batch):
+        if not self.bucket_ratio:
+            return [batch]
+        return length_buckets(batch, lambda item: len(item.wav), self.bucket_ratio)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            batch = [item for item in batch if not item.fut.done() and not self._expired(item, start)]
+            if not batch:
+                continue
+
+            for item in batch:
+                self.wait_ms.append((start - item.enqueued) * 1000.0)
+                metrics.observe("queue_wait", start - item.enqueued)
+
+            for group in self._buckets(batch):
+                await self._forward(group)
+
+    async def _forward(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.padding.append(padding_ratio([len(item.wav) for item in batch]))
+
+        wavs = [item.wav for item in batch]
+        texts = [item.text for item in batch]
+        try:
+            results, batch_timing = await loop.run_in_executor(self._executor, self._call_timed, wavs, texts)
+        except Exception as e:
+            for item in batch:
+                if not item.fut.done():
+                    item.fut.set_exception(e)
+            return
+        finally:
+            self.infer_ms.append((time.perf_counter() - start) * 1000.0)
+            self.batch_sizes[len(batch)] += 1
+            self.total_batches += 1
+            self.total_requests += len(batch)
+
+        batch_timing["batch_size"] = len(batch)
+        for item, res in zip(batch, results):
+            if not item.fut.done():
+                item.fut.set_result((res, batch_timing, start))
+
+    def _call_timed(self, wavs, texts):
+        # chạy trong thread inference: gom thời gian các stage của batch này
+        with metrics.record() as rec:
+            results = self.batch_fn(wavs, texts)
+        return results, rec
+
+    def stats(self) -> dict:
+        def _pct(values, q):
+            return float(np.percentile(list(values), q)) if values else 0.0
+
+        return {
+            "queue_depth": self.depth(),
+            "queue_depth_by_priority": {str(k): v for k, v in sorted(self.depth_by_priority.items()) if v},
+            "max_queue": self.max_queue,
+            "reserve": self.reserve,
+            "queue_timeout_s": self.queue_timeout,
+            "rejected": dict(self.rejected),
+            "retry_after_s": self.retry_after(),
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "total_requests": self.total_requests,
+            "total_batches": self.total_batches,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            "wait_ms": {"p50": _pct(self.wait_ms, 50), "p99": _pct(self.wait_ms, 99),
+                        "max": max(self.wait_ms, default=0.0)},
+            "infer_ms": {"p50": _pct(self.infer_ms, 50), "p99": _pct(self.infer_ms, 99)},
+            "bucket_ratio": self.bucket_ratio,
+            "padding_ratio_mean": float(np.mean(self.padding)) if self.padding else 0.0,
+        }
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# shadowBench.py
+# Benchmark inference + training của ShadowNet, chạy offline hoàn toàn.
+#
+#   python shadowBench.py --out bench.json
+#   python shadowBench.py --shape tiny --quick      # smoke test vài giây
+#
+# Backbone được khởi tạo ngẫu nhiên từ config cùng kích thước với
+# wav2vec2-base / bert-base-japanese (không tải weights từ hub), audio và CSV
+# được sinh tổng hợp với seed cố định. Kết quả là 1 file JSON để so sánh giữa
+# các commit. Log tiến trình in ra stderr; stdout chỉ chứa JSON khi không có --out.
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import subprocess
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import torch
+import transformers
+from transformers import (Wav2Vec2Config, BertConfig, Wav2Vec2FeatureExtractor, BertTokenizerFast)
+
+import shadowModel
+from shadowModel import (ShadowNet, ShadowDataset, SAMPLE_RATE, collate_fn, predict,
+                         train_model, use_resources, set_seed)
+from shadowMetrics import process_rss_bytes
+
+ERROR_LABELS = ["発音", "イントネーション", "リズム", "脱落", "挿入", "速さ"]
+DURATIONS = (1, 5, 10, 30)
+BATCH_SIZES = (1, 2, 4, 8)
+
+# cùng kiến trúc với facebook/wav2vec2-base-960h và cl-tohoku/bert-base-japanese
+SHAPES = {
+    "base": {
+        "audio": {},
+        "text": {"vocab_size": 32000},
+    },
+    # để chạy thử nhanh trên CI / laptop
+    "tiny": {
+        "audio": {"hidden_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2,
+                  "intermediate_size": 128, "conv_dim": (64,) * 7,
+                  "num_conv_pos_embeddings": 16, "num_conv_pos_embedding_groups": 2},
+        "text": {"vocab_size": 2000, "hidden_size": 64, "num_hidden_layers": 2,
+                 "num_attention_heads": 2, "intermediate_size": 128},
+    },
+}
+
+
+# --------- Synthetic inputs ----------
+def synth_wav(seconds: float, rng: np.random.Generator) -> np.ndarray:
+    """Tín hiệu giống giọng nói: vài harmonic có điều biến biên độ + nhiễu nền, 16 kHz float32."""
+    t = np.arange(int(seconds * SAMPLE_RATE), dtype=np.float32) / SAMPLE_RATE
+    f0 = rng.uniform(100.0, 220.0)
+    wav = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 5))
+    envelope = 0.5 * (1.0 + np.sin(2 * np.pi * rng.uniform(2.0, 5.0) * t))  # ~ nhịp âm tiết
+    wav = 0.3 * wav * envelope + 0.01 * rng.standard_normal(t.shape[0])
+    return wav.astype(np.float32)
+
+
+def synth_text(rng: np.random.Generator, min_len: int = 10, max_len: int = 60) -> str:
+    kana = [chr(c) for c in range(0x3042, 0x3094)]
+    return "".join(rng.choice(kana, size=int(rng.integers(min_len, max_len))))
+
+
+def offline_resources(vocab_size: int, workdir: str):
+    """Feature extractor giống wav2vec2-base-960h và tokenizer theo ký tự (vocab sinh sẵn)."""
+    specials = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    chars = [chr(c) for c in range(0x3041, 0x30ff)] + [chr(c) for c in range(0x4e00, 0x9fff)]
+    vocab_path = os.path.join(workdir, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(specials + chars[:vocab_size - len(specials)]))
+    processor = Wav2Vec2FeatureExtractor(feature_size=1, sampling_rate=SAMPLE_RATE, padding_value=0.0,
+                                         do_normalize=True, return_attention_mask=False)
+    tokenizer = BertTokenizerFast(vocab_file=vocab_path, tokenize_chinese_chars=True)
+    return processor, tokenizer
+
+
+def build_model(shape: str, freeze_pretrained: bool = True) -> ShadowNet:
+    cfg = SHAPES[shape]
+    set_seed()
+    return ShadowNet(n_error_classes=len(ERROR_LABELS), freeze_pretrained=freeze_pretrained,
+                     audio_config=Wav2Vec2Config(**cfg["audio"]), text_config=BertConfig(**cfg["text"]))
+
+
+def write_dataset(workdir: str, n_rows: int, n_audio: int, seconds, rng: np.random.Generator) -> str:
+    """CSV cùng schema ShadowDataset; id lặp vòng trên `n_audio` file WAV thật."""
+    audio_dir = os.path.join(workdir, "wav")
+    os.makedirs(audio_dir, exist_ok=True)
+    for i in range(n_audio):
+        sf.write(os.path.join(audio_dir, f"utt{i}.wav"), synth_wav(seconds[i % len(seconds)], rng),
+                 SAMPLE_RATE, subtype="PCM_16")
+    rows = []
+    for i in range(n_rows):
+        k = int(rng.integers(0, 3))
+        errors = list(rng.choice(ERROR_LABELS, size=k, replace=False))
+        if i < len(ERROR_LABELS):
+            errors = [ERROR_LABELS[i]]  # mọi nhãn đều xuất hiện -> số lớp khớp build_model
+        rows.append({
+            "id": f"utt{i % n_audio}",
+            "scrip": synth_text(rng),
+            "score": int(rng.integers(0, 101)),
+            "error": ", ".join(errors),
+        })
+    csv_path = os.path.join(workdir, f"bench_{n_rows}.csv")
+    pd.DataFrame(rows).to_csv(csv_path, index=False, encoding="utf-8")
+    return csv_path
+
+
+# --------- Measurements ----------
+def _pct(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def _peak_rss_mb() -> float:
+    """Peak RSS cả đời process (ru_maxrss chỉ tăng, không tách được theo phần)."""
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # Linux: KiB
+    except ImportError:
+        return process_rss_bytes() / 1e6
+
+
+def _hwm_mb():
+    """VmHWM (peak RSS từ lần reset gần nhất) trong /proc/self/status, None nếu không có."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0  # KiB
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak() -> bool:
+    """Đặt VmHWM về RSS hiện tại (Linux >= 4.0: ghi "5" vào /proc/self/clear_refs)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _hwm_mb() is not None
+    except OSError:
+        return False
+
+
+@contextmanager
+def _memory(into: dict, prefix: str = ""):
+    """
+    Ghi bộ nhớ của riêng khối lệnh vào `into`: `rss_delta_mb` (RSS sau - trước)
+    và `peak_rss_mb` (peak trong khối, None nếu không reset được VmHWM).
+    Không lồng nhau: khối trong reset peak của khối ngoài.
+    """
+    before = process_rss_bytes()
+    reset = _reset_peak()
+    yield
+    into[prefix + "rss_delta_mb"] = (process_rss_bytes() - before) / 1e6
+    into[prefix + "peak_rss_mb"] = _hwm_mb() if reset else None
+
+
+def _log(msg: str):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def bench_latency(model, mlb, workdir, rng, durations=DURATIONS, repeats=20, warmup=2):
+    """Latency 1 request qua predict() (đọc file, feature extract, tokenize, forward) theo độ dài audio."""
+    results = {}
+    for seconds in durations:
+        path = os.path.join(workdir, f"latency_{seconds}s.wav")
+        sf.write(path, synth_wav(seconds, rng), SAMPLE_RATE, subtype="PCM_16")
+        text = synth_text(rng)
+        for _ in range(warmup):
+            predict(model, mlb, path, text)
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            predict(model, mlb, path, text)
+            times.append((time.perf_counter() - t0) * 1000.0)
+        results[f"{seconds}s"] = {"p50_ms": _pct(times, 50), "p99_ms": _pct(times, 99),
+                                  "mean_ms": float(np.mean(times)), "n": repeats}
+        _log(f"  latency {seconds:>3}s: p50 {results[f'{seconds}s']['p50_ms']:.1f} ms")
+    return results
+
+
+def bench_throughput(model, rng, seconds=5, batch_sizes=BATCH_SIZES, repeats=5):
+    """Utterance/s của collate + forward theo batch size (clip cùng độ dài, không padding)."""
+    results = {}
+    model.eval()
+    for bs in batch_sizes:
+        batch = [(synth_wav(seconds, rng), synth_text(rng), np.float32(0.0),
+                  np.zeros(len(ERROR_LABELS), dtype=np.float32)) for _ in range(bs)]
+        with torch.no_grad():
+            audio_inputs, text_inputs, _, _ = collate_fn(batch)
+            model(audio_inputs, text_inputs)  # warmup
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                audio_inputs, text_inputs, _, _ = collate_fn(batch)
+                model(audio_inputs, text_inputs)
+            elapsed = time.perf_counter() - t0
+        results[str(bs)] = {"utt_per_s": bs * repeats / elapsed,
+                            "batch_ms": elapsed / repeats * 1000.0}
+        _log(f"  throughput batch {bs}: {results[str(bs)]['utt_per_s']:.2f} utt/s")
+    return {"clip_seconds": seconds, "by_batch_size": results}
+
+
+def bench_training(shape, csv_path, audio_dir, workdir, epochs=1, batch_size=4):
+    """Steps/s của train_model với backbone frozen và unfrozen (không embedding cache)."""
+    results = {}
+    for frozen in (True, False):
+        model = build_model(shape, freeze_pretrained=frozen)
+        n_rows = len(pd.read_csv(csv_path))
+        steps = epochs * -(-n_rows // batch_size)
+        mem = {}
+        t0 = time.perf_counter()
+        with _memory(mem):
+            train_model(csv_path, audio_dir,
+                        save_model=os.path.join(workdir, "bench_model.pt"),
+                        save_label=os.path.join(workdir, "bench_labels.pkl"),
+                        epochs=epochs, batch_size=batch_size, freeze_pretrained=frozen,
+                        num_workers=0, cache_dir=None, audio_pack=None, model=model)
+        elapsed = time.perf_counter() - t0
+        key = "frozen" if frozen else "unfrozen"
+        trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        results[key] = {"steps": steps, "seconds": elapsed, "steps_per_s": steps / elapsed,
+                        "trainable_params": trainable, **mem}
+        _log(f"  train {key}: {results[key]['steps_per_s']:.3f} steps/s")
+        del model
+    return {"batch_size": batch_size, "epochs": epochs, **results}
+
+
+def bench_dataset(csv_path, audio_dir, n_items=200):
+    """
+    Thời gian khởi tạo ShadowDataset: lần đầu (compile manifest từ CSV) và các
+    lần sau (mở manifest đã có), cộng audio_lengths và __getitem__.
+    """
+    t0 = time.perf_counter()
+    ShadowDataset(csv_path, audio_dir)
+    compile_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    dataset = ShadowDataset(csv_path, audio_dir)
+    init_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    dataset.audio_lengths()
+    lengths_s = time.perf_counter() - t0
+
+    n_items = min(n_items, len(dataset))
+    t0 = time.perf_counter()
+    for i in range(n_items):
+        dataset[i]
+    getitem_s = time.perf_counter() - t0
+    result = {"rows": len(dataset), "compile_s": compile_s, "init_s": init_s, "audio_lengths_s": lengths_s,
+              "getitem_ms": getitem_s / max(1, n_items) * 1000.0}
+    _log(f"  dataset {len(dataset)} rows: compile {compile_s:.3f}s, init {init_s:.3f}s")
+    return result
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(shape: str = "base", quick: bool = False, threads: int = None, seed: int = shadowModel.SEED,
+        dataset_rows: int = 5000, sections=("latency", "throughput", "training", "dataset")):
+    if threads:
+        torch.set_num_threads(threads)
+    rng = np.random.default_rng(seed)
+    durations = (1, 5) if quick else DURATIONS
+    repeats = 3 if quick else 20
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "shape": shape,
+            "quick": quick,
+            "seed": seed,
+            "device": shadowModel.DEVICE,
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+    }
+
+    with tempfile.TemporaryDirectory(prefix="shadow_bench_") as workdir:
+        processor, tokenizer = offline_resources(SHAPES[shape]["text"]["vocab_size"], workdir)
+        use_resources(processor=processor, tokenizer=tokenizer)
+
+        if "latency" in sections or "throughput" in sections:
+            with _memory(report, "inference_"):
+                model = build_model(shape).to(shadowModel.DEVICE).eval()
+                report["meta"]["params"] = sum(p.numel() for p in model.parameters())
+                from sklearn.preprocessing import MultiLabelBinarizer
+                mlb = MultiLabelBinarizer().fit([ERROR_LABELS])
+                if "latency" in sections:
+                    _log("latency")
+                    report["latency"] = bench_latency(model, mlb, workdir, rng, durations, repeats)
+                if "throughput" in sections:
+                    _log("throughput")
+                    report["throughput"] = bench_throughput(model, rng, repeats=max(2, repeats // 4),
+                                                            batch_sizes=BATCH_SIZES[:3] if quick else BATCH_SIZES)
+            del model
+
+        if "training" in sections:
+            _log("training")
+            train_rows = 8 if quick else 32
+            csv_path = write_dataset(os.path.join(workdir, "train"), train_rows, train_rows, (2, 4, 6), rng)
+            report["training"] = bench_training(shape, csv_path, os.path.join(workdir, "train", "wav"), workdir)
+
+        if "dataset" in sections:
+            _log("dataset")
+            rows = 500 if quick else dataset_rows
+            csv_path = write_dataset(os.path.join(workdir, "dataset"), rows, 16, (1, 3, 5), rng)
+            mem = {}
+            with _memory(mem):
+                report["dataset"] = bench_dataset(csv_path, os.path.join(workdir, "dataset", "wav"))
+            report["dataset"].update(mem)
+
+    # VmHWM bị reset theo từng phần: peak cả lần chạy = max các peak đã đo
+    peaks = [report.get("inference_peak_rss_mb"), report.get("dataset", {}).get("peak_rss_mb"),
+             *(report.get("training", {}).get(k, {}).get("peak_rss_mb") for k in ("frozen", "unfrozen")),
+             _peak_rss_mb()]
+    report["peak_rss_mb"] = max(p for p in peaks if p is not None)
+    if torch.cuda.is_available():
+        report["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 1e6
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline ShadowNet benchmark (random-init backbones)")
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="base")
+    parser.add_argument("--quick", action="store_true", help="fewer durations / repeats / rows")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads")
+    parser.add_argument("--seed", type=int, default=shadowModel.SEED)
+    parser.add_argument("--dataset-rows", type=int, default=5000)
+    parser.add_argument("--only", nargs="+", choices=["latency", "throughput", "training", "dataset"],
+                        default=["latency", "throughput", "training", "dataset"])
+    parser.add_argument("--out", default=None, help="write JSON here (default: stdout)")
+    args = parser.parse_args()
+
+    # log của train_model / read_csv_auto không được lẫn vào JSON trên stdout
+    with redirect_stdout(sys.stderr):
+        result = run(args.shape, quick=args.quick, threads=args.threads, seed=args.seed,
+                     dataset_rows=args.dataset_rows, sections=args.only)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        _log(f"Saved: {args.out}")
+    else:
+        print(text)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# shadowDepth.py
+# Chọn độ sâu audio encoder: chấm điểm từ layer trung gian của wav2vec2.
+#
+#   python shadowDepth.py sweep --csv datasetraining2.csv --audio ../wav --depths 2 4 6 8 10 12 --out depth.json
+#   python shadowDepth.py export --csv datasetraining2.csv --audio ../wav --depth 6 --pooling weighted \
+#       --out shadow_model.depth6.pt
+#
+# 1 lượt wav2vec2 đầy đủ trên mỗi clip (batch 1, giống /predict) lưu mean-pool
+# của mọi hidden state (output embedding + từng layer) cùng embedding BERT.
+# Mean-pool là tuyến tính nên pooling "weighted" (tổng có trọng số các layer
+# rồi pool) bằng tổng có trọng số của các vector đã pool: mỗi cặp (K, pooling)
+# chỉ train lại proj + head trên feature này, không chạy lại backbone.
+# Pooling "checkpoint" là head có sẵn của checkpoint đặt lên layer K, không
+# train lại (tương đương chỉ đặt SHADOW_AUDIO_DEPTH=K).
+# Latency audio encoder theo K đo bằng hook cuối mỗi layer trong 1 lượt forward.
+#
+# export: checkpoint chỉ giữ K layer wav2vec2 đầu + head train cho K, cùng định
+# dạng shadow_model.pt (K và pooling suy ra từ key), dùng với error_labels.pkl hiện có.
+import os
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from sklearn.metrics import f1_score
+
+from shadowModel import (ShadowDataset, collate_fn, load_model, set_seed, truncate_layers,
+                         DEVICE, SAMPLE_RATE, SEED)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.pt")
+LABEL_PATH = os.path.join(BASE_DIR, "error_labels.pkl")
+POOLINGS = ("checkpoint", "last", "weighted")
+
+
+class _DepthHead(nn.Module):
+    """
+    proj + score_head + error_head (copy từ model, cùng tên tham số với
+    ShadowNet) đặt trên hidden state đã pool của layer `depth`.
+    """
+    def __init__(self, model: nn.Module, depth: int, pooling: str):
+        super().__init__()
+        self.depth = depth
+        self.pooling = pooling
+        if pooling == "weighted":
+            self.audio_layer_weights = nn.Parameter(torch.zeros(depth + 1))
+        self.proj = copy.deepcopy(model.proj)
+        self.score_head = copy.deepcopy(model.score_head)
+        self.error_head = copy.deepcopy(model.error_head)
+        for p in self.parameters():
+            p.requires_grad = True
+
+    def forward(self, layers, text_emb):
+        """`layers`: (batch, n_states, audio_hidden), state 0 = output embedding trước layer 1."""
+        if self.pooling == "weighted":
+            w = torch.softmax(self.audio_layer_weights, dim=0)
+            audio_emb = (layers[:, :self.depth + 1] * w.view(1, -1, 1)).sum(dim=1)
+        else:
+            audio_emb = layers[:, self.depth]
+        x = self.proj(torch.cat([audio_emb, text_emb], dim=1))
+        return self.score_head(x).squeeze(1), self.error_head(x)
+
+
+@torch.no_grad()
+def layer_features(model: nn.Module, dataset: ShadowDataset, rows):
+    """
+    Mean-pool của mọi hidden state wav2vec2, shape (N, n_states, audio_hidden),
+    và embedding BERT (N, text_hidden). Batch 1 nên không có padding; clip dài
+    chạy 1 lượt (không cắt cửa sổ như encode_audio).
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    audio, text = [], []
+    t0 = time.perf_counter()
+    for n, i in enumerate(rows):
+        audio_inputs, text_inputs, _, _ = collate_fn([dataset[i]])
+        out = model.wav2vec(audio_inputs["input_values"].to(device), output_hidden_states=True, return_dict=True)
+        audio.append(torch.stack([h.mean(dim=1)[0] for h in out.hidden_states]).float().cpu())
+        text.append(model.encode_text(text_inputs)[0].float().cpu())
+        if (n + 1) % 50 == 0 or n + 1 == len(rows):
+            print(f"  encoded {n + 1}/{len(rows)} ({time.perf_counter() - t0:.1f}s)")
+    return torch.stack(audio), torch.stack(text)
+
+
+@torch.no_grad()
+def layer_latency(model: nn.Module, seconds: float = 5.0, repeats: int = 5) -> np.ndarray:
+    """
+    ms từ đầu forward wav2vec2 tới hết layer k (k = 0: CNN feature encoder +
+    positional conv), clip `seconds` giây, batch 1; median của `repeats` lượt.
+    """
+    layers = model.wav2vec.encoder.layers
+    marks = []
+    hooks = [layers[0].register_forward_pre_hook(lambda *_: marks.append(time.perf_counter()))]
+    hooks += [layer.register_forward_hook(lambda *_: marks.append(time.perf_counter())) for layer in layers]
+    x = torch.randn(1, int(seconds * SAMPLE_RATE), device=next(model.parameters()).device)
+    runs = []
+    try:
+        model.eval()
+        for r in range(repeats + 1):
+            marks.clear()
+            t0 = time.perf_counter()
+            model.wav2vec(x, return_dict=True)
+            if r:  # lượt đầu là warmup
+                runs.append([(m - t0) * 1000.0 for m in marks])
+    finally:
+        for h in hooks:
+            h.remove()
+    return np.median(np.asarray(runs), axis=0)
+
+
+def _targets(dataset: ShadowDataset, classes):
+    """score (0..1), nhãn lỗi theo thứ tự lớp của error_labels.pkl, pos_weight tương ứng."""
+    own = list(dataset.mlb.classes_)
+    cols = [own.index(c) if c in own else -1 for c in classes]
+    matrix = dataset.manifest.label_matrix().astype(np.float32)
+    errors = np.stack([matrix[:, c] if c >= 0 else np.zeros(len(matrix), np.float32) for c in cols], axis=1)
+    pos_w = [float(dataset.class_pos_weight[c]) if c >= 0 else 1.0 for c in cols]
+    scores = np.asarray(dataset.manifest.arrays["scores"], dtype=np.float32) / 100.0
+    return torch.from_numpy(scores), torch.from_numpy(errors), torch.tensor(pos_w)
+
+
+def fit_head(model: nn.Module, depth: int, pooling: str, audio, text, scores, errors, pos_weight, rows,
+             epochs: int = 30, lr: float = 1e-3, batch_size: int = 32) -> _DepthHead:
+    """Train proj + head (+ trọng số layer) từ head của checkpoint; backbone không chạy."""
+    set_seed(SEED)
+    head = _DepthHead(model, depth, pooling).to(DEVICE)
+    if pooling == "checkpoint":
+        return head.eval()
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=1e-6)
+    loss_error = nn.BCEWithLogitsLoss(pos_weight=pos_weight.to(DEVICE))
+    rows = torch.as_tensor(rows, dtype=torch.long)
+    g = torch.Generator().manual_seed(SEED)
+    head.train()
+    for _ in range(epochs):
+        order = rows[torch.randperm(len(rows), generator=g)]
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            pred_score, pred_logits = head(audio[idx].to(DEVICE), text[idx].to(DEVICE))
+            loss = F.mse_loss(pred_score, scores[idx].to(DEVICE)) + loss_error(pred_logits, errors[idx].to(DEVICE))
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(head.parameters(), max_norm=1.0)
+            optimizer.step()
+    return head.eval()
+
+
+@torch.no_grad()
+def evaluate_head(head: _DepthHead, audio, text, scores, errors, rows, threshold: float = 0.5) -> dict:
+    pred_score, pred_logits = head(audio[rows].to(DEVICE), text[rows].to(DEVICE))
+    preds = (torch.sigmoid(pred_logits) > threshold).int().cpu().numpy()
+    return {"score_mae": float((pred_score.cpu() - scores[rows]).abs().mean() * 100.0),
+            "f1_micro": float(f1_score(errors[rows].int().numpy(), preds, average="micro", zero_division=0.0))}
+
+
+def _load(csv_path, audio_folder, model_path, label_path, limit=None):
+    model, mlb = load_model(model_path, label_path)
+    for p in model.parameters():
+        p.requires_grad = False
+    dataset = ShadowDataset(csv_path, audio_folder)
+    rows = list(range(min(limit, len(dataset)) if limit else len(dataset)))
+    return model, mlb, dataset, rows
+
+
+def sweep(csv_path: str, audio_folder: str, model_path: str = MODEL_PATH, label_path: str = LABEL_PATH,
+          depths=None, poolings=POOLINGS, epochs: int = 30, lr: float = 1e-3, batch_size: int = 32,
+          val_fraction: float = 0.2, limit: int = None, seconds: float = 5.0) -> dict:
+    """
+    Bảng độ chính xác / compute theo K: MAE score, micro-F1 lỗi trên phần
+    validation (`val_fraction` dòng giữ lại, cùng cách chia với shadowDistill),
+    ms audio encoder cho clip `seconds` giây và tỉ lệ so với đủ layer.
+    """
+    model, mlb, dataset, rows = _load(csv_path, audio_folder, model_path, label_path, limit)
+    n_layers = model.layer_counts()["audio_layers"]
+    depths = sorted({d for d in (depths or range(1, n_layers + 1)) if 1 <= d <= n_layers})
+    if model.audio_pooling == "weighted" and "checkpoint" in poolings:
+        print("⚠ Checkpoint uses weighted pooling: its head is not evaluated per layer")
+        poolings = [p for p in poolings if p != "checkpoint"]
+
+    order = np.random.default_rng(SEED).permutation(rows)
+    n_val = int(round(len(order) * val_fraction)) if len(order) > 1 else 0
+    val_rows, train_rows = sorted(order[:n_val].tolist()), sorted(order[n_val:].tolist())
+    if not val_rows:
+        print("⚠ No validation rows: metrics are measured on the training rows")
+        val_rows = train_rows
+
+    print(f"Encoding {len(rows)} clips through all {n_layers} wav2vec2 layers")
+    audio, text = layer_features(model, dataset, rows)
+    scores, errors, pos_weight = _targets(dataset, mlb.classes_)
+    scores, errors = scores[rows], errors[rows]
+    latency = layer_latency(model, seconds=seconds)
+
+    results = []
+    for depth in depths:
+        for pooling in poolings:
+            head = fit_head(model, depth, pooling, audio, text, scores, errors, pos_weight, train_rows,
+                            epochs=epochs, lr=lr, batch_size=batch_size)
+            row = {"depth": depth, "pooling": pooling,
+                   "audio_ms": float(latency[depth]),
+                   "audio_compute": float(latency[depth] / latency[n_layers]),
+                   "audio_speedup": float(latency[n_layers] / max(latency[depth], 1e-9)),
+                   **evaluate_head(head, audio, text, scores, errors, val_rows)}
+            if pooling == "weighted":
+                row["layer_weights"] = torch.softmax(head.audio_layer_weights, 0).tolist()
+            results.append(row)
+
+    print(f"\nSamples: {len(train_rows)} train / {len(val_rows)} val, clip {seconds:.1f}s, "
+          f"full audio encoder {latency[n_layers]:.1f} ms")
+    print(f"{'K':>3s} {'pooling':>10s} {'audio ms':>9s} {'compute':>8s} {'speedup':>8s} {'MAE':>7s} {'F1':>6s}")
+    for r in results:
+        print(f"{r['depth']:3d} {r['pooling']:>10s} {r['audio_ms']:9.1f} {r['audio_compute']:8.1%} "
+              f"{r['audio_speedup']:7.2f}x {r['score_mae']:7.2f} {r['f1_micro']:6.3f}")
+    return {"model": os.path.basename(model_path), "audio_layers": n_layers, "clip_seconds": seconds,
+            "train_samples": len(train_rows), "val_samples": len(val_rows), "results": results}
+
+
+def export(csv_path: str, audio_folder: str, depth: int, pooling: str = "last", save_model: str = None,
+           model_path: str = MODEL_PATH, label_path: str = LABEL_PATH, epochs: int = 30, lr: float = 1e-3,
+           batch_size: int = 32, limit: int = None) -> str:
+    """
+    Train head cho K = `depth` trên mọi dòng rồi ghi checkpoint chỉ còn K
+    layer wav2vec2 đầu (load_model / shadowAI_api tự nhận K và pooling).
+    """
+    if pooling not in ("last", "weighted"):
+        raise ValueError(f"pooling must be 'last' or 'weighted', got {pooling!r}")
+    model, mlb, dataset, rows = _load(csv_path, audio_folder, model_path, label_path, limit)
+    if model.audio_pooling == "weighted":
+        raise ValueError("Export from a checkpoint with 'last' pooling (full or distilled model)")
+    truncate_layers(model.wav2vec, depth)  # feature chỉ cần tới layer K
+    depth = model.layer_counts()["audio_layers"]
+
+    print(f"Encoding {len(rows)} clips through {depth} wav2vec2 layers")
+    audio, text = layer_features(model, dataset, rows)
+    scores, errors, pos_weight = _targets(dataset, mlb.classes_)
+    head = fit_head(model, depth, pooling, audio, text, scores[rows], errors[rows], pos_weight,
+                    list(range(len(rows))), epochs=epochs, lr=lr, batch_size=batch_size)
+    print("Train fit:", evaluate_head(head, audio, text, scores[rows], errors[rows], list(range(len(rows)))))
+
+    state = model.state_dict()
+    state.update({k: v.detach().cpu() for k, v in head.state_dict().items()})
+    save_model = save_model or os.path.join(BASE_DIR, f"shadow_model.depth{depth}.pt")
+    torch.save(state, save_model)
+    print("Saved:", save_model, f"(audio layers {depth}, pooling {pooling}, labels: {label_path})")
+    return save_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shadow AI adaptive-depth audio encoder")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name in ("sweep", "export"):
+        p = sub.add_parser(name)
+        p.add_argument("--csv", required=True)
+        p.add_argument("--audio", required=True)
+        p.add_argument("--model", default=MODEL_PATH)
+        p.add_argument("--labels", default=LABEL_PATH)
+        p.add_argument("--epochs", type=int, default=30, help="epoch train head trên feature đã cache")
+        p.add_argument("--lr", type=float, default=1e-3)
+        p.add_argument("--batch-size", type=int, default=32)
+        p.add_argument("--limit", type=int, default=None)
+
+    p_sweep = sub.choices["sweep"]
+    p_sweep.add_argument("--depths", type=int, nargs="+", default=None, help="mặc định: 1..số layer")
+    p_sweep.add_argument("--pooling", nargs="+", choices=POOLINGS, default=list(POOLINGS))
+    p_sweep.add_argument("--val-fraction", type=float, default=0.2)
+    p_sweep.add_argument("--seconds", type=float, default=5.0, help="độ dài clip đo latency")
+    p_sweep.add_argument("--out", default=None, help="ghi bảng ra JSON")
+    p_export = sub.choices["export"]
+    p_export.add_argument("--depth", type=int, required=True)
+    p_export.add_argument("--pooling", choices=["last", "weighted"], default="last")
+    p_export.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    if args.cmd == "export":
+        export(args.csv, args.audio, args.depth, args.pooling, args.out, args.model, args.labels,
+               epochs=args.epochs, lr=args.lr, batch_size=args.batch_size, limit=args.limit)
+    else:
+        result = sweep(args.csv, args.audio, args.model, args.labels, depths=args.depths, poolings=args.pooling,
+                       epochs=args.epochs, lr=args.lr, batch_size=args.batch_size,
+                       val_fraction=args.val_fraction, limit=args.limit, seconds=args.seconds)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2, ensure_ascii=False)
+            print("Saved:", args.out)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# shadowDistill.py
+# Chưng cất ShadowNet hiện tại (teacher) sang student ít layer hơn cho CPU.
+#
+#   python shadowDistill.py train --csv datasetraining2.csv --audio ../wav --audio-layers 4 --text-layers 4
+#   python shadowDistill.py compare --csv datasetraining2.csv --audio ../wav \
+#       --student shadow_model.student.pt --out tradeoff.json
+#
+# Student là bản copy của teacher chỉ giữ N layer transformer cách đều của
+# wav2vec2 / BERT (cùng hidden size nên proj + head dùng lại được), rồi được
+# fine-tune theo score + error logits của teacher, embedding của teacher và
+# nhãn thật. Checkpoint là state_dict thường, cùng lớp với error_labels.pkl:
+# chép đè lên shadow_model.pt là chạy (số layer suy ra từ key của state_dict).
+import os
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Subset
+from sklearn.metrics import f1_score
+
+from shadowModel import (ShadowDataset, LengthBucketSampler, collate_fn, load_model, set_seed,
+                         select_layers, DEFAULT_BATCH, DEFAULT_EPOCHS, DEVICE, SEED)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.pt")
+LABEL_PATH = os.path.join(BASE_DIR, "error_labels.pkl")
+STUDENT_PATH = os.path.join(BASE_DIR, "shadow_model.student.pt")
+
+
+class _Indexed(Dataset):
+    """ShadowDataset + chỉ số dòng, để tra target của teacher đã tính sẵn."""
+    def __init__(self, dataset: ShadowDataset, classes):
+        self.dataset = dataset
+        # cột nhãn của dataset -> thứ tự lớp của error_labels.pkl (lớp thiếu = 0)
+        own = list(dataset.mlb.classes_)
+        self.columns = [own.index(c) if c in own else -1 for c in classes]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        wav, text, score, errors = self.dataset[idx]
+        errors = np.array([errors[c] if c >= 0 else 0.0 for c in self.columns], dtype=np.float32)
+        return wav, text, score, errors, idx
+
+
+def _collate(batch):
+    return (*collate_fn([b[:4] for b in batch]), torch.tensor([b[4] for b in batch], dtype=torch.long))
+
+
+def _loader(data, rows, lengths, batch_size, num_workers, shuffle):
+    # cả lượt teacher (shuffle=False) cũng gom theo độ dài: kết quả trả kèm idx nên thứ tự không quan trọng
+    sampler = LengthBucketSampler([lengths[i] for i in rows], batch_size, shuffle=shuffle)
+    return DataLoader(Subset(data, rows), batch_sampler=sampler, collate_fn=_collate, num_workers=num_workers)
+
+
+def make_student(teacher: nn.Module, audio_layers: int, text_layers: int) -> nn.Module:
+    """Copy của teacher giữ `audio_layers` / `text_layers` layer cách đều; CNN feature encoder giữ frozen."""
+    student = copy.deepcopy(teacher)
+    select_layers(student.wav2vec, audio_layers)
+    select_layers(student.text_model, text_layers)
+    for p in student.parameters():
+        p.requires_grad = True
+    student.wav2vec.freeze_feature_encoder()
+    return student
+
+
+@torch.no_grad()
+def teacher_targets(teacher: nn.Module, loader: DataLoader, n_rows: int) -> dict:
+    """
+    1 lượt teacher trên mọi dòng: score, error logits, embedding audio/text (dùng lại qua các epoch).
+    Target của mỗi dòng bằng kết quả teacher chạy riêng dòng đó (encode_audio không pool padding).
+    """
+    teacher.eval()
+    out = {}
+    for audio_inputs, text_inputs, _, _, idx in loader:
+        audio_emb = teacher.encode_audio(audio_inputs)
+        text_emb = teacher.encode_text(text_inputs)
+        score, logits = teacher.head(audio_emb, text_emb)
+        for name, value in (("score", score), ("logits", logits), ("audio", audio_emb), ("text", text_emb)):
+            if name not in out:
+                out[name] = torch.zeros((n_rows,) + value.shape[1:], dtype=torch.float32)
+            out[name][idx] = value.float().cpu()
+    return out
+
+
+def distill_model(csv_path: str, audio_folder: str,
+                  teacher_path: str = MODEL_PATH,
+                  label_path: str = LABEL_PATH,
+                  save_model: str = STUDENT_PATH,
+                  audio_layers: int = 4,
+                  text_layers: int = 4,
+                  epochs: int = DEFAULT_EPOCHS,
+                  batch_size: int = DEFAULT_BATCH,
+                  lr: float = 5e-5,
+                  alpha: float = 0.7,
+                  temperature: float = 2.0,
+                  feature_weight: float = 1.0,
+                  val_fraction: float = 0.1,
+                  num_workers: int = 0,
+                  audio_pack: str = None):
+    """
+    Loss = alpha * (MSE score teacher + BCE logits teacher làm mềm bởi
+    `temperature`) + (1 - alpha) * (MSE score thật + BCE nhãn thật, pos_weight)
+    + feature_weight * (1 - cosine) giữa embedding student và teacher.
+    `val_fraction` dòng được giữ lại để đo tradeoff (compare) sau khi train.
+    Trả về (student, mlb, report).
+    """
+    set_seed(SEED)
+    teacher, mlb = load_model(teacher_path, label_path)
+    teacher.to(DEVICE).eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+
+    dataset = ShadowDataset(csv_path, audio_folder, audio_pack=audio_pack)
+    data = _Indexed(dataset, mlb.classes_)
+    lengths = dataset.audio_lengths()
+    order = np.random.default_rng(SEED).permutation(len(dataset))
+    n_val = int(round(len(order) * val_fraction)) if len(order) > 1 else 0
+    val_rows, train_rows = sorted(order[:n_val].tolist()), sorted(order[n_val:].tolist())
+
+    t0 = time.perf_counter()
+    targets = teacher_targets(teacher, _loader(data, list(range(len(dataset))), lengths, batch_size,
+                                               num_workers, shuffle=False), len(dataset))
+    print(f"Teacher targets: {len(dataset)} rows in {time.perf_counter() - t0:.1f}s")
+
+    student = make_student(teacher, audio_layers, text_layers).to(DEVICE)
+    student.train()
+    print(f"Student: {student.layer_counts()} (teacher {teacher.layer_counts()}), "
+          f"{_params(student) / 1e6:.1f}M / {_params(teacher) / 1e6:.1f}M params")
+
+    own = list(dataset.mlb.classes_)
+    pos_w = torch.tensor([float(dataset.class_pos_weight[own.index(c)]) if c in own else 1.0
+                          for c in mlb.classes_], device=DEVICE)
+    loss_error = nn.BCEWithLogitsLoss(pos_weight=pos_w)
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, student.parameters()),
+                                  lr=lr, weight_decay=1e-6)
+    loader = _loader(data, train_rows, lengths, batch_size, num_workers, shuffle=True)
+    T = temperature
+
+    for epoch in range(epochs):
+        epoch_loss = 0.0
+        for batch_idx, (audio_inputs, text_inputs, scores, errors, idx) in enumerate(loader):
+            scores, errors = scores.to(DEVICE), errors.to(DEVICE)
+            t_score, t_logits = targets["score"][idx].to(DEVICE), targets["logits"][idx].to(DEVICE)
+            t_audio, t_text = targets["audio"][idx].to(DEVICE), targets["text"][idx].to(DEVICE)
+
+            optimizer.zero_grad()
+            audio_emb = student.encode_audio(audio_inputs)
+            text_emb = student.encode_text(text_inputs)
+            pred_score, pred_logits = student.head(audio_emb, text_emb)
+
+            l_kd = (F.mse_loss(pred_score, t_score)
+                    + F.binary_cross_entropy_with_logits(pred_logits / T, torch.sigmoid(t_logits / T)) * T * T)
+            l_true = F.mse_loss(pred_score, scores) + loss_error(pred_logits, errors)
+            l_feat = ((1 - F.cosine_similarity(audio_emb, t_audio)).mean()
+                      + (1 - F.cosine_similarity(text_emb, t_text)).mean())
+            loss = alpha * l_kd + (1 - alpha) * l_true + feature_weight * l_feat
+            if torch.isnan(loss):
+                print(f"⚠ NaN loss detected at epoch {epoch+1}, batch {batch_idx+1}")
+                continue
+
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), max_norm=1.0)
+            optimizer.step()
+            epoch_loss += loss.item()
+
+            if (batch_idx + 1) % 20 == 0 or (batch_idx == 0 and epoch == 0):
+                print(f"[Epoch {epoch+1}/{epochs}] Batch {batch_idx+1}/{len(loader)} loss={loss.item():.4f} "
+                      f"kd={l_kd.item():.4f} true={l_true.item():.4f} feat={l_feat.item():.4f}")
+        print(f"Epoch {epoch+1} finished. Avg loss: {epoch_loss / max(1, len(loader)):.4f}")
+
+    student.eval()
+    torch.save(student.state_dict(), save_model)
+    print("Saved:", save_model, f"(labels: {label_path})")
+
+    report = None
+    if val_rows:
+        report = compare_models({"teacher": teacher, "student": student}, dataset, val_rows, mlb)
+    return student, mlb, report
+
+
+def _params(model: nn.Module) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
+@torch.no_grad()
+def _run(model: nn.Module, data: _Indexed, rows, warmup: int = 2):
+    """Batch 1 từng clip (giống /predict); trả về score, logits, latency (giây) từng clip."""
+    model.eval()
+    loader = DataLoader(Subset(data, rows), batch_size=1, shuffle=False, collate_fn=_collate)
+    scores, logits, latency = [], [], []
+    for i, (audio_inputs, text_inputs, _, _, _) in enumerate(loader):
+        t0 = time.perf_counter()
+        s, l = model(audio_inputs, text_inputs)
+        if i >= warmup or len(rows) <= warmup:
+            latency.append(time.perf_counter() - t0)
+        scores.append(s.cpu().numpy() * 100.0)
+        logits.append(l.cpu().numpy())
+    return np.concatenate(scores), np.concatenate(logits), np.asarray(latency)
+
+
+def compare_models(models: dict, dataset: ShadowDataset, rows, mlb, threshold: float = 0.5) -> dict:
+    """
+    Bảng latency / độ chính xác: params, p50 / mean latency batch 1, MAE score
+    và micro-F1 lỗi so với nhãn thật và so với model đầu tiên (teacher).
+    """
+    data = _Indexed(dataset, mlb.classes_)
+    truth = np.stack([data[i][3] for i in rows]).astype(int)
+    true_scores = np.asarray(dataset.manifest.arrays["scores"], dtype=float)[rows]
+
+    results, ref = {}, None
+    for name, model in models.items():
+        model = model.to(DEVICE)
+        scores, logits, latency = _run(model, data, rows)
+        preds = (1 / (1 + np.exp(-logits)) > threshold).astype(int)
+        if ref is None:
+            ref = (scores, preds)
+        results[name] = {
+            **model.layer_counts(),
+            "params_m": _params(model) / 1e6,
+            "latency_p50_ms": float(np.percentile(latency, 50) * 1000.0),
+            "latency_mean_ms": float(latency.mean() * 1000.0),
+            "score_mae": float(np.abs(scores - true_scores).mean()),
+            "f1_micro": float(f1_score(truth, preds, average="micro", zero_division=0.0)),
+            "score_mae_vs_teacher": float(np.abs(scores - ref[0]).mean()),
+            "f1_micro_vs_teacher": float(f1_score(ref[1], preds, average="micro", zero_division=1.0)),
+        }
+
+    base = results[next(iter(results))]["latency_mean_ms"]
+    print(f"\nSamples: {len(rows)}")
+    print(f"{'model':24s} {'layers a/t':>10s} {'params':>8s} {'p50 ms':>8s} {'speedup':>8s} "
+          f"{'MAE':>7s} {'F1':>6s} {'MAE~T':>7s} {'F1~T':>6s}")
+    for name, r in results.items():
+        r["speedup"] = base / max(r["latency_mean_ms"], 1e-9)
+        print(f"{name[:24]:24s} {r['audio_layers']:>4d}/{r['text_layers']:<5d} {r['params_m']:7.1f}M "
+              f"{r['latency_p50_ms']:8.1f} {r['speedup']:7.2f}x {r['score_mae']:7.2f} {r['f1_micro']:6.3f} "
+              f"{r['score_mae_vs_teacher']:7.2f} {r['f1_micro_vs_teacher']:6.3f}")
+    return {"samples": len(rows), "models": results}
+
+
+def compare(csv_path: str, audio_folder: str, students, teacher_path: str = MODEL_PATH,
+            label_path: str = LABEL_PATH, limit: int = None) -> dict:
+    teacher, mlb = load_model(teacher_path, label_path)
+    models = {"teacher": teacher}
+    for path in students:
+        models[os.path.basename(path)], _ = load_model(path, label_path)
+    dataset = ShadowDataset(csv_path, audio_folder)
+    rows = list(range(min(limit, len(dataset)) if limit else len(dataset)))
+    return compare_models(models, dataset, rows, mlb)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shadow AI knowledge distillation")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_train = sub.add_parser("train", help="distill shadow_model.pt into a smaller student")
+    p_train.add_argument("--csv", required=True)
+    p_train.add_argument("--audio", required=True)
+    p_train.add_argument("--teacher", default=MODEL_PATH)
+    p_train.add_argument("--labels", default=LABEL_PATH)
+    p_train.add_argument("--out", default=STUDENT_PATH)
+    p_train.add_argument("--audio-layers", type=int, default=4)
+    p_train.add_argument("--text-layers", type=int, default=4)
+    p_train.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS)
+    p_train.add_argument("--batch-size", type=int, default=DEFAULT_BATCH)
+    p_train.add_argument("--lr", type=float, default=5e-5)
+    p_train.add_argument("--alpha", type=float, default=0.7, help="weight of teacher targets vs labels")
+    p_train.add_argument("--temperature", type=float, default=2.0)
+    p_train.add_argument("--feature-weight", type=float, default=1.0)
+    p_train.add_argument("--val-fraction", type=float, default=0.1)
+    p_train.add_argument("--audio-pack", default=None)
+    p_train.add_argument("--report", default=None, help="write the tradeoff table as JSON")
+
+    p_cmp = sub.add_parser("compare", help="latency vs accuracy of teacher and students")
+    p_cmp.add_argument("--csv", required=True)
+    p_cmp.add_argument("--audio", required=True)
+    p_cmp.add_argument("--teacher", default=MODEL_PATH)
+    p_cmp.add_argument("--labels", default=LABEL_PATH)
+    p_cmp.add_argument("--student", nargs="+", default=[STUDENT_PATH])
+    p_cmp.add_argument("--limit", type=int, default=None)
+    p_cmp.add_argument("--out", default=None, help="write the tradeoff table as JSON")
+
+    args = parser.parse_args()
+    if args.cmd == "train":
+        _, _, result = distill_model(args.csv, args.audio, args.teacher, args.labels, args.out,
+                                     audio_layers=args.audio_layers, text_layers=args.text_layers,
+                                     epochs=args.epochs, batch_size=args.batch_size, lr=args.lr,
+                                     alpha=args.alpha, temperature=args.temperature,
+                                     feature_weight=args.feature_weight, val_fraction=args.val_fraction,
+                                     audio_pack=args.audio_pack)
+        out = args.report
+    else:
+        result = compare(args.csv, args.audio, args.student, args.teacher, args.labels, limit=args.limit)
+        out = args.out
+    if out and result is not None:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print("Saved:", out)
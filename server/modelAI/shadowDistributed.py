@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# shadowDistributed.py
+# Train ShadowNet với backbone mở khóa trên nhiều process CPU
+# (DistributedDataParallel, backend gloo).
+#
+#   python shadowDistributed.py train --csv datasetraining2.csv --audio ../wav --procs 4 --threads 2 \
+#       --accum 4 --bf16 --grad-checkpointing --checkpoint-dir ddp_ckpt --checkpoint-every 200 --resume
+#   python shadowDistributed.py scaling --csv datasetraining2.csv --audio ../wav --procs 4 --steps 20
+#
+# Mỗi process lấy 1 phần batch (DistributedBucketSampler, vẫn gom theo độ dài),
+# gradient được all-reduce sau mỗi `accum` micro-batch (các micro-batch giữa
+# chạy trong no_sync). CNN feature encoder của wav2vec2 giữ frozen như
+# fine-tune wav2vec2 thông thường. Checkpoint (model + optimizer + vị trí
+# trong epoch) ghi định kỳ bởi rank 0, --resume chạy tiếp đúng batch kế tiếp.
+# Kết quả cuối cùng cùng định dạng với train_model (shadow_model.pt + error_labels.pkl).
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import argparse
+import tempfile
+from contextlib import nullcontext
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader
+
+from shadowModel import (ShadowNet, ShadowDataset, DatasetManifest, DistributedBucketSampler, AudioPack,
+                         build_audio_pack, collate_fn, set_seed, _loader_kwargs, DEFAULT_BATCH, DEFAULT_EPOCHS, DEFAULT_LR, SEED)
+
+CHECKPOINT_NAME = "last.pt"
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _log(rank: int, msg: str):
+    if rank == 0:
+        print(msg, flush=True)
+
+
+def _save_checkpoint(path: str, model: nn.Module, optimizer, epoch: int, batch: int, step: int):
+    """Ghi ra file tạm rồi os.replace: process bị kill giữa chừng không làm hỏng checkpoint cũ."""
+    tmp = path + ".tmp"
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                "epoch": epoch, "batch": batch, "step": step}, tmp)
+    os.replace(tmp, path)
+
+
+def _worker(rank: int, cfg: dict):
+    world = cfg["world_size"]
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(cfg["port"])
+    dist.init_process_group("gloo", rank=rank, world_size=world)
+    torch.set_num_threads(cfg["threads"])
+    try:
+        _train(rank, world, cfg)
+    finally:
+        dist.destroy_process_group()
+
+
+def _train(rank: int, world: int, cfg: dict):
+    set_seed(SEED)  # cùng khởi tạo trên mọi rank (DDP cũng broadcast từ rank 0)
+    dataset = ShadowDataset(cfg["csv_path"], cfg["audio_folder"], audio_pack=cfg["audio_pack"])
+    model = ShadowNet(n_error_classes=len(dataset.mlb.classes_), freeze_pretrained=cfg["freeze_pretrained"])
+    if not cfg["freeze_pretrained"]:
+        model.wav2vec.freeze_feature_encoder()
+    if cfg["grad_checkpointing"]:
+        # recompute activation của từng layer transformer khi backward thay vì giữ lại
+        for backbone in (model.wav2vec, model.text_model):
+            backbone.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    optimizer = optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()),
+                            lr=cfg["lr"], weight_decay=1e-6)
+    start_epoch, start_batch, step = 0, 0, 0
+    ckpt_path = os.path.join(cfg["checkpoint_dir"], CHECKPOINT_NAME) if cfg["checkpoint_dir"] else None
+    if cfg["resume"] and ckpt_path and os.path.exists(ckpt_path):
+        state = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        start_epoch, start_batch, step = state["epoch"], state["batch"], state["step"]
+        _log(rank, f"Resumed from {ckpt_path}: epoch {start_epoch + 1}, batch {start_batch}, step {step}")
+
+    model.train()
+    # layerdrop của wav2vec2 bỏ ngẫu nhiên layer khi train -> có tham số không nhận gradient ở 1 số step
+    find_unused = cfg["find_unused_parameters"] or (
+        not cfg["freeze_pretrained"] and getattr(model.wav2vec.config, "layerdrop", 0.0) > 0)
+    ddp = DDP(model, find_unused_parameters=find_unused)
+    set_seed(SEED + rank)  # dropout / spec-augment khác nhau giữa các rank
+
+    sampler = DistributedBucketSampler(dataset.audio_lengths(), cfg["batch_size"], rank, world, seed=SEED)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn, **_loader_kwargs(cfg["num_workers"]))
+    loss_score = nn.MSELoss()
+    loss_error = nn.BCEWithLogitsLoss(pos_weight=dataset.class_pos_weight)
+    accum = max(1, cfg["accum_steps"])
+    autocast = (lambda: torch.autocast("cpu", dtype=torch.bfloat16)) if cfg["bf16"] else nullcontext
+
+    samples, timed_samples, t_timed = 0, 0, None
+    t0 = time.perf_counter()
+    done = False
+    for epoch in range(start_epoch, cfg["epochs"]):
+        sampler.set_epoch(epoch)
+        sampler.skip = start_batch if epoch == start_epoch else 0
+        n_batches = sampler.skip + len(sampler)
+        epoch_loss, epoch_batches = 0.0, 0
+        for batch_idx, (audio_inputs, text_inputs, scores, errors) in enumerate(loader, start=sampler.skip):
+            sync = (batch_idx + 1) % accum == 0 or batch_idx + 1 == n_batches
+            with (nullcontext() if sync else ddp.no_sync()):
+                with autocast():
+                    pred_score, pred_error_logits = ddp(audio_inputs, text_inputs)
+                loss = loss_score(pred_score.float(), scores) + loss_error(pred_error_logits.float(), errors)
+                # NaN vẫn phải backward: rank nào bỏ qua all-reduce thì cả nhóm bị treo
+                (loss / accum).backward()
+            samples += len(scores)
+            if t_timed is not None:
+                timed_samples += len(scores)
+            epoch_loss += loss.item()
+            epoch_batches += 1
+            if not sync:
+                continue
+
+            # gradient đã all-reduce giống nhau trên mọi rank -> mọi rank cùng quyết định bỏ step
+            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+            if torch.isfinite(norm):
+                optimizer.step()
+            else:
+                _log(rank, f"⚠ Non-finite gradient at epoch {epoch+1}, batch {batch_idx+1}, step skipped")
+            optimizer.zero_grad(set_to_none=True)
+            step += 1
+            if step == cfg["warmup_steps"]:
+                t_timed = time.perf_counter()
+
+            if step % 20 == 0 or step == 1:
+                _log(rank, f"[Epoch {epoch+1}/{cfg['epochs']}] Batch {batch_idx+1}/{n_batches} step {step} "
+                           f"loss={loss.item():.4f}")
+            if ckpt_path and cfg["checkpoint_every"] and step % cfg["checkpoint_every"] == 0 and rank == 0:
+                _save_checkpoint(ckpt_path, model, optimizer, epoch, batch_idx + 1, step)
+            if cfg["max_steps"] and step >= cfg["max_steps"]:
+                done = True
+                break
+
+        stats = torch.tensor([epoch_loss, epoch_batches], dtype=torch.float64)
+        dist.all_reduce(stats)
+        _log(rank, f"Epoch {epoch+1} finished. Avg loss: {stats[0].item() / max(1.0, stats[1].item()):.4f}")
+        if ckpt_path and rank == 0 and not done:
+            _save_checkpoint(ckpt_path, model, optimizer, epoch + 1, 0, step)
+        dist.barrier()
+        if done:
+            break
+
+    # throughput toàn nhóm: tổng sample / thời gian của rank chậm nhất
+    elapsed = time.perf_counter() - (t_timed if t_timed is not None else t0)
+    totals = torch.tensor([timed_samples if t_timed is not None else samples, elapsed], dtype=torch.float64)
+    dist.all_reduce(totals[:1], op=dist.ReduceOp.SUM)
+    dist.all_reduce(totals[1:], op=dist.ReduceOp.MAX)
+    total_samples, seconds = totals[0].item(), totals[1].item()
+
+    if rank == 0:
+        if cfg["save_model"]:
+            torch.save(model.state_dict(), cfg["save_model"])
+            with open(cfg["save_label"], "wb") as f:
+                pickle.dump(dataset.mlb, f)
+            print("Saved:", cfg["save_model"], cfg["save_label"])
+        result = {"world_size": world, "threads": cfg["threads"], "steps": step,
+                  "samples": int(total_samples), "seconds": seconds,
+                  "samples_per_s": total_samples / max(seconds, 1e-9)}
+        print(f"Throughput: {result['samples_per_s']:.2f} samples/s ({world} x {cfg['threads']} threads)")
+        if cfg["result_path"]:
+            with open(cfg["result_path"], "w", encoding="utf-8") as f:
+                json.dump(result, f)
+
+
+def train_distributed(csv_path: str, audio_folder: str,
+                      world_size: int = 2,
+                      threads: int = None,
+                      save_model: str = "shadow_model.pt",
+                      save_label: str = "error_labels.pkl",
+                      epochs: int = DEFAULT_EPOCHS,
+                      batch_size: int = DEFAULT_BATCH,
+                      lr: float = DEFAULT_LR,
+                      accum_steps: int = 1,
+                      bf16: bool = False,
+                      grad_checkpointing: bool = False,
+                      freeze_pretrained: bool = False,
+                      checkpoint_dir: str = None,
+                      checkpoint_every: int = 0,
+                      resume: bool = False,
+                      num_workers: int = 0,
+                      audio_pack: str = None,
+                      max_steps: int = 0,
+                      warmup_steps: int = 0,
+                      find_unused_parameters: bool = False,
+                      result_path: str = None):
+    """
+    `batch_size` là batch mỗi process; batch hiệu dụng = batch_size * world_size * accum_steps.
+    `threads` mặc định chia đều số core cho các process. `max_steps` / `warmup_steps`
+    dùng cho đo scaling (throughput chỉ tính sau warmup).
+    """
+    world_size = max(1, int(world_size))
+    threads = threads or max(1, (os.cpu_count() or 1) // world_size)
+    # compile manifest / audio pack 1 lần ở process cha, các rank chỉ đọc
+    if audio_pack and not AudioPack.exists(audio_pack):
+        build_audio_pack(audio_folder, audio_pack)
+    DatasetManifest.for_csv(csv_path)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    cfg = {"csv_path": csv_path, "audio_folder": audio_folder, "audio_pack": audio_pack,
+           "world_size": world_size, "threads": threads, "port": _free_port(),
+           "save_model": save_model, "save_label": save_label, "epochs": epochs, "batch_size": batch_size,
+           "lr": lr, "accum_steps": accum_steps, "bf16": bf16, "grad_checkpointing": grad_checkpointing,
+           "freeze_pretrained": freeze_pretrained, "checkpoint_dir": checkpoint_dir,
+           "checkpoint_every": checkpoint_every, "resume": resume, "num_workers": num_workers,
+           "max_steps": max_steps, "warmup_steps": warmup_steps,
+           "find_unused_parameters": find_unused_parameters, "result_path": result_path}
+    if world_size == 1:
+        _worker(0, cfg)
+    else:
+        mp.spawn(_worker, args=(cfg,), nprocs=world_size, join=True)
+
+
+def scaling(csv_path: str, audio_folder: str, max_procs: int, steps: int = 20, warmup_steps: int = 3,
+            threads: int = None, **kwargs) -> dict:
+    """
+    Chạy `steps` optimizer step với 1..max_procs process, báo samples/s,
+    speedup và hiệu suất scaling (speedup / số process). Batch mỗi process
+    cố định (weak scaling). `threads` cố định giữ số thread mỗi process
+    không đổi; để None thì chia đều số core.
+    """
+    rows = []
+    for n in range(1, max_procs + 1):
+        with tempfile.TemporaryDirectory(prefix="shadow_ddp_") as tmp:
+            result_path = os.path.join(tmp, "result.json")
+            train_distributed(csv_path, audio_folder, world_size=n, threads=threads, save_model=None,
+                              epochs=10 ** 6, max_steps=warmup_steps + steps, warmup_steps=warmup_steps,
+                              result_path=result_path, **kwargs)
+            with open(result_path, "r", encoding="utf-8") as f:
+                rows.append(json.load(f))
+    base = rows[0]["samples_per_s"]
+    for r in rows:
+        r["speedup"] = r["samples_per_s"] / max(base, 1e-9)
+        r["efficiency"] = r["speedup"] / r["world_size"]
+
+    print(f"\n{'procs':>5s} {'threads':>7s} {'samples/s':>10s} {'speedup':>8s} {'efficiency':>10s}")
+    for r in rows:
+        print(f"{r['world_size']:5d} {r['threads']:7d} {r['samples_per_s']:10.2f} {r['speedup']:7.2f}x "
+              f"{r['efficiency']:10.1%}")
+    return {"cpu_count": os.cpu_count(), "steps": steps, "warmup_steps": warmup_steps, "runs": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed (DDP/gloo) CPU training for ShadowNet")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name in ("train", "scaling"):
+        p = sub.add_parser(name)
+        p.add_argument("--csv", required=True)
+        p.add_argument("--audio", required=True)
+        p.add_argument("--procs", type=int, default=2, help="số process (scaling: tối đa)")
+        p.add_argument("--threads", type=int, default=None, help="torch threads mỗi process")
+        p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH, help="batch mỗi process")
+        p.add_argument("--lr", type=float, default=DEFAULT_LR)
+        p.add_argument("--accum", type=int, default=1, help="micro-batch mỗi optimizer step")
+        p.add_argument("--bf16", action="store_true", help="autocast bfloat16 cho forward")
+        p.add_argument("--grad-checkpointing", action="store_true")
+        p.add_argument("--freeze", action="store_true", help="giữ backbone frozen (chỉ train head)")
+        p.add_argument("--num-workers", type=int, default=0, help="DataLoader worker mỗi process")
+        p.add_argument("--audio-pack", default=None)
+        p.add_argument("--find-unused-parameters", action="store_true")
+    p_train = sub.choices["train"]
+    p_train.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS)
+    p_train.add_argument("--out", default="shadow_model.pt")
+    p_train.add_argument("--labels", default="error_labels.pkl")
+    p_train.add_argument("--checkpoint-dir", default=None)
+    p_train.add_argument("--checkpoint-every", type=int, default=0, help="optimizer steps (0 = chỉ cuối epoch)")
+    p_train.add_argument("--resume", action="store_true")
+    p_scaling = sub.choices["scaling"]
+    p_scaling.add_argument("--steps", type=int, default=20)
+    p_scaling.add_argument("--warmup-steps", type=int, default=3)
+    p_scaling.add_argument("--out", default=None, help="ghi JSON")
+    args = parser.parse_args()
+
+    common = dict(batch_size=args.batch_size, lr=args.lr, accum_steps=args.accum, bf16=args.bf16,
+                  grad_checkpointing=args.grad_checkpointing, freeze_pretrained=args.freeze,
+                  num_workers=args.num_workers, audio_pack=args.audio_pack,
+                  find_unused_parameters=args.find_unused_parameters)
+    if args.cmd == "train":
+        train_distributed(args.csv, args.audio, world_size=args.procs, threads=args.threads,
+                          save_model=args.out, save_label=args.labels, epochs=args.epochs,
+                          checkpoint_dir=args.checkpoint_dir, checkpoint_every=args.checkpoint_every,
+                          resume=args.resume, **common)
+        sys.exit(0)
+    result = scaling(args.csv, args.audio, max(1, args.procs), steps=args.steps,
+                     warmup_steps=args.warmup_steps, threads=args.threads, **common)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print("Saved:", args.out)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# shadowExport.py
+# Xuất model int8 cho CPU và kiểm tra độ lệch so với model fp32.
+#
+#   python shadowExport.py export
+#   python shadowExport.py parity --csv datasetraining2.csv --audio ../wav
+#   python shadowExport.py chunk-parity --csv datasetraining2.csv --audio ../wav
+#   python shadowExport.py chunk-selfcheck     # không cần checkpoint (npm run check:ai)
+#   python shadowExport.py batch-selfcheck     # điểm trong batch == điểm chạy riêng (npm run check:ai)
+#
+# Bật model int8 cho shadowAI_api: SHADOW_MODEL_VARIANT=int8
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from sklearn.metrics import f1_score
+
+from shadowModel import (ShadowDataset, collate_fn, load_model, load_quantized_model,
+                         quantize_int8, get_processor, get_tokenizer, StreamingAudioEncoder, ShadowNet,
+                         audio_batch, set_seed, DEFAULT_BATCH, SAMPLE_RATE, SEED)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.pt")
+LABEL_PATH = os.path.join(BASE_DIR, "error_labels.pkl")
+INT8_MODEL_PATH = os.path.join(BASE_DIR, "shadow_model.int8.pt")
+
+
+def export_int8(model_path: str = MODEL_PATH, label_path: str = LABEL_PATH,
+                out_path: str = INT8_MODEL_PATH):
+    model, _ = load_model(model_path, label_path)
+    qmodel = quantize_int8(model)
+    torch.save(qmodel.state_dict(), out_path)
+    fp32_mb = os.path.getsize(model_path) / 1e6
+    int8_mb = os.path.getsize(out_path) / 1e6
+    print(f"Saved: {out_path} ({fp32_mb:.1f} MB -> {int8_mb:.1f} MB)")
+    return out_path
+
+
+def _run(model, dataloader):
+    scores, logits, elapsed = [], [], 0.0
+    with torch.no_grad():
+        for audio_inputs, text_inputs, _, _ in dataloader:
+            t0 = time.perf_counter()
+            s, l = model(audio_inputs, text_inputs)
+            elapsed += time.perf_counter() - t0
+            scores.append(s.cpu().numpy() * 100.0)
+            logits.append(l.cpu().numpy())
+    return np.concatenate(scores), np.concatenate(logits), elapsed
+
+
+def parity_check(csv_path: str, audio_folder: str,
+                 model_path: str = MODEL_PATH, label_path: str = LABEL_PATH,
+                 int8_path: str = INT8_MODEL_PATH, threshold: float = 0.5,
+                 batch_size: int = DEFAULT_BATCH, limit: int = None):
+    """
+    So sánh fp32 và int8 trên cùng dữ liệu (schema CSV của ShadowDataset).
+    Báo cáo MAE của score, F1 từng nhãn (int8 so với fp32 và so với nhãn thật)
+    và tốc độ forward.
+    """
+    fp32, mlb = load_model(model_path, label_path)
+    fp32 = fp32.to("cpu")
+    int8, _ = load_quantized_model(int8_path, label_path)
+
+    dataset = ShadowDataset(csv_path, audio_folder)
+    data = Subset(dataset, range(min(limit, len(dataset)))) if limit else dataset
+    loader = DataLoader(data, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+
+    s32, l32, t32 = _run(fp32, loader)
+    s8, l8, t8 = _run(int8, loader)
+
+    p32 = (1 / (1 + np.exp(-l32)) > threshold).astype(int)
+    p8 = (1 / (1 + np.exp(-l8)) > threshold).astype(int)
+
+    # nhãn thật theo thứ tự lớp của error_labels.pkl
+    rows = list(data.indices) if isinstance(data, Subset) else list(range(len(dataset)))
+    truth = mlb.transform([dataset.manifest.error_list(i) for i in rows])
+    true_scores = np.asarray(dataset.manifest.arrays["scores"], dtype=float)[rows]
+
+    f1_vs_fp32 = f1_score(p32, p8, average=None, zero_division=1.0)
+    f1_fp32 = f1_score(truth, p32, average=None, zero_division=0.0)
+    f1_int8 = f1_score(truth, p8, average=None, zero_division=0.0)
+
+    print(f"\nSamples: {len(rows)}")
+    print(f"Score MAE int8 vs fp32 : {np.abs(s8 - s32).mean():.3f}")
+    print(f"Score MAE fp32 vs truth: {np.abs(s32 - true_scores).mean():.3f}")
+    print(f"Score MAE int8 vs truth: {np.abs(s8 - true_scores).mean():.3f}")
+    print(f"Forward time fp32 {t32:.2f}s, int8 {t8:.2f}s (x{t32 / max(t8, 1e-9):.2f})")
+    print(f"\n{'label':40s} {'int8~fp32':>10s} {'F1 fp32':>8s} {'F1 int8':>8s}")
+    for name, a, b, c in zip(mlb.classes_, f1_vs_fp32, f1_fp32, f1_int8):
+        print(f"{name[:40]:40s} {a:10.3f} {b:8.3f} {c:8.3f}")
+
+    return {
+        "score_mae_int8_vs_fp32": float(np.abs(s8 - s32).mean()),
+        "f1_int8_vs_fp32": dict(zip(mlb.classes_, map(float, f1_vs_fp32))),
+        "speedup": t32 / max(t8, 1e-9),
+    }
+
+
+def chunk_parity(csv_path: str, audio_folder: str,
+                 model_path: str = MODEL_PATH, label_path: str = LABEL_PATH,
+                 window_s: float = 2.0, overlap_s: float = 0.5, limit: int = None):
+    """
+    So sánh embedding wav2vec2 chạy 1 lượt với chế độ cửa sổ (long-audio) trên
+    clip ngắn, ép cửa sổ nhỏ để clip nào cũng bị cắt nhiều đoạn. Báo cáo cosine
+    similarity, sai số L2 tương đối của embedding và MAE của score.
+    """
+    model, _ = load_model(model_path, label_path)
+    dataset = ShadowDataset(csv_path, audio_folder)
+    n = min(limit, len(dataset)) if limit else len(dataset)
+
+    cos, rel, score_diff = [], [], []
+    with torch.no_grad():
+        for i in range(n):
+            wav, text, _, _ = dataset[i]
+            audio_inputs = get_processor()([wav], sampling_rate=SAMPLE_RATE, return_tensors="pt")
+            input_values = audio_inputs["input_values"].to(next(model.parameters()).device)
+            full = model.audio_hidden_states(input_values).mean(dim=1)
+            chunked = model.encode_audio_chunked(input_values, window_s=window_s, overlap_s=overlap_s)
+
+            text_emb = model.encode_text(get_tokenizer()([text], return_tensors="pt", truncation=True,
+                                                         max_length=128))
+            s_full, _ = model.head(full, text_emb)
+            s_chunk, _ = model.head(chunked, text_emb)
+
+            cos.append(float(torch.nn.functional.cosine_similarity(full, chunked).item()))
+            rel.append(float((torch.linalg.norm(full - chunked) / torch.linalg.norm(full)).item()))
+            score_diff.append(abs(float(s_full.item() - s_chunk.item())) * 100.0)
+
+    print(f"\nSamples: {n} (window {window_s}s, overlap {overlap_s}s)")
+    print(f"Embedding cosine  min {min(cos):.4f}  mean {np.mean(cos):.4f}")
+    print(f"Embedding rel. L2 max {max(rel):.4f}  mean {np.mean(rel):.4f}")
+    print(f"Score MAE chunked vs full: {np.mean(score_diff):.3f}")
+    return {"cosine_min": min(cos), "cosine_mean": float(np.mean(cos)),
+            "rel_l2_max": max(rel), "score_mae": float(np.mean(score_diff))}
+
+
+def chunk_selfcheck(window_s: float = 1.0, overlap_s: float = 0.25, durations=(0.6, 2.3, 4.1, 7.7),
+                    min_cos: float = 0.99) -> dict:
+    """
+    Như chunk_parity nhưng không cần checkpoint / dataset: ShadowNet tiny khởi
+    tạo ngẫu nhiên (shadowBench --shape tiny) trên audio tổng hợp. Kiểm tra
+    encode_audio_chunked và StreamingAudioEncoder (audio gửi từng mảnh lẻ) đếm
+    đúng số frame của 1 lượt đầy đủ và cosine với embedding đầy đủ >= `min_cos`.
+    """
+    from shadowBench import build_model, synth_wav
+
+    model = build_model("tiny").eval()
+    rng = np.random.default_rng(SEED)
+    rows = []
+    with torch.no_grad():
+        for seconds in durations:
+            wav = torch.from_numpy(synth_wav(seconds, rng))
+            input_values = ((wav - wav.mean()) / (wav.std() + 1e-7)).unsqueeze(0)
+            full = model.audio_hidden_states(input_values).mean(dim=1)
+            frames = int(model.wav2vec._get_feat_extract_output_lengths(input_values.shape[1]))
+            chunked = model.encode_audio_chunked(input_values, window_s=window_s, overlap_s=overlap_s)
+
+            stream = StreamingAudioEncoder(model, window_s, overlap_s)
+            for start in range(0, input_values.shape[1], 1237):
+                stream.feed(input_values[0, start:start + 1237])
+            streamed = stream.finish()
+
+            rows.append({"seconds": seconds, "frames": frames, "stream_frames": stream.count,
+                         "cos_chunked": float(torch.nn.functional.cosine_similarity(full, chunked).item()),
+                         "cos_stream": float(torch.nn.functional.cosine_similarity(full, streamed).item())})
+
+    ok = all(r["frames"] == r["stream_frames"] and min(r["cos_chunked"], r["cos_stream"]) >= min_cos for r in rows)
+    print(f"\nTiny random-init model, window {window_s}s, overlap {overlap_s}s")
+    print(f"{'seconds':>7s} {'frames':>6s} {'stream':>6s} {'cos chunked':>11s} {'cos stream':>10s}")
+    for r in rows:
+        print(f"{r['seconds']:7.1f} {r['frames']:6d} {r['stream_frames']:6d} {r['cos_chunked']:11.4f} "
+              f"{r['cos_stream']:10.4f}")
+    print("OK" if ok else f"❌ frame count mismatch or cosine < {min_cos}")
+    return {"ok": ok, "min_cos": min_cos, "rows": rows}
+
+
+def batch_selfcheck(durations=(0.6, 1.0, 1.0, 1.9, 3.2), min_cos: float = 0.9999,
+                    max_score_diff: float = 0.01) -> dict:
+    """
+    Điểm của 1 clip không được phụ thuộc các clip chung batch (padding). Với
+    ShadowNet tiny khởi tạo ngẫu nhiên, cả conv group-norm (wav2vec2-base) lẫn
+    layer-norm (wav2vec2-large-lv60), so sánh embedding / score khi encode cả
+    batch độ dài khác nhau với khi encode từng clip riêng.
+    """
+    import tempfile
+    from transformers import Wav2Vec2Config, BertConfig
+    from shadowBench import ERROR_LABELS, SHAPES, offline_resources, synth_wav
+
+    with tempfile.TemporaryDirectory() as workdir:
+        processor, _ = offline_resources(SHAPES["tiny"]["text"]["vocab_size"], workdir)
+    rng = np.random.default_rng(SEED)
+    wavs = [synth_wav(seconds, rng) for seconds in durations]
+    rows = []
+    for norm in ("group", "layer"):
+        set_seed()
+        audio_cfg = Wav2Vec2Config(**SHAPES["tiny"]["audio"], feat_extract_norm=norm,
+                                   do_stable_layer_norm=norm == "layer")
+        model = ShadowNet(len(ERROR_LABELS), audio_config=audio_cfg,
+                          text_config=BertConfig(**SHAPES["tiny"]["text"])).eval()
+        text_emb = torch.randn(1, model.text_model.config.hidden_size)
+        with torch.no_grad():
+            batched = model.encode_audio(audio_batch(wavs, processor))
+            scores, _ = model.head(batched, text_emb.expand(len(wavs), -1))
+            for i, wav in enumerate(wavs):
+                single = model.encode_audio(audio_batch([wav], processor))
+                score, _ = model.head(single, text_emb)
+                rows.append({"norm": norm, "seconds": durations[i],
+                             "cos": float(torch.nn.functional.cosine_similarity(single, batched[i:i + 1]).item()),
+                             "score_diff": abs(float(score.item() - scores[i].item())) * 100.0})
+
+    ok = all(r["cos"] >= min_cos and r["score_diff"] <= max_score_diff for r in rows)
+    print(f"\nTiny random-init model, batch of {len(wavs)} clips vs one clip at a time")
+    print(f"{'conv':>5s} {'seconds':>7s} {'cosine':>8s} {'|Δscore|':>9s}")
+    for r in rows:
+        print(f"{r['norm']:>5s} {r['seconds']:7.1f} {r['cos']:8.5f} {r['score_diff']:9.5f}")
+    print("OK" if ok else f"❌ cosine < {min_cos} or score diff > {max_score_diff}")
+    return {"ok": ok, "min_cos": min_cos, "max_score_diff": max_score_diff, "rows": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shadow AI CPU export")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_export = sub.add_parser("export", help="quantize shadow_model.pt -> shadow_model.int8.pt")
+    p_export.add_argument("--model", default=MODEL_PATH)
+    p_export.add_argument("--labels", default=LABEL_PATH)
+    p_export.add_argument("--out", default=INT8_MODEL_PATH)
+
+    p_parity = sub.add_parser("parity", help="compare int8 against fp32")
+    p_parity.add_argument("--csv", required=True)
+    p_parity.add_argument("--audio", required=True)
+    p_parity.add_argument("--model", default=MODEL_PATH)
+    p_parity.add_argument("--labels", default=LABEL_PATH)
+    p_parity.add_argument("--int8", default=INT8_MODEL_PATH)
+    p_parity.add_argument("--limit", type=int, default=None)
+    p_parity.add_argument("--max-mae", type=float, default=None,
+                          help="exit 1 if int8 vs fp32 score MAE exceeds this")
+
+    p_chunk = sub.add_parser("chunk-parity", help="compare chunked long-audio encoding against a full pass")
+    p_chunk.add_argument("--csv", required=True)
+    p_chunk.add_argument("--audio", required=True)
+    p_chunk.add_argument("--model", default=MODEL_PATH)
+    p_chunk.add_argument("--labels", default=LABEL_PATH)
+    p_chunk.add_argument("--window", type=float, default=2.0, help="window seconds (small on purpose)")
+    p_chunk.add_argument("--overlap", type=float, default=0.5)
+    p_chunk.add_argument("--limit", type=int, default=None)
+    p_chunk.add_argument("--min-cos", type=float, default=None,
+                         help="exit 1 if any embedding cosine similarity is below this")
+
+    p_self = sub.add_parser("chunk-selfcheck",
+                            help="chunked vs full encoding on a tiny random model (no checkpoint needed)")
+    p_self.add_argument("--window", type=float, default=1.0)
+    p_self.add_argument("--overlap", type=float, default=0.25)
+    p_self.add_argument("--min-cos", type=float, default=0.99)
+
+    p_batch = sub.add_parser("batch-selfcheck",
+                             help="batched vs one-at-a-time scores on a tiny random model (no checkpoint needed)")
+    p_batch.add_argument("--min-cos", type=float, default=0.9999)
+    p_batch.add_argument("--max-score-diff", type=float, default=0.01, help="score points (0-100 scale)")
+
+    args = parser.parse_args()
+    if args.cmd == "chunk-selfcheck":
+        if not chunk_selfcheck(args.window, args.overlap, min_cos=args.min_cos)["ok"]:
+            sys.exit(1)
+    elif args.cmd == "batch-selfcheck":
+        if not batch_selfcheck(min_cos=args.min_cos, max_score_diff=args.max_score_diff)["ok"]:
+            sys.exit(1)
+    elif args.cmd == "export":
+        export_int8(args.model, args.labels, args.out)
+    elif args.cmd == "chunk-parity":
+        result = chunk_parity(args.csv, args.audio, args.model, args.labels,
+                              window_s=args.window, overlap_s=args.overlap, limit=args.limit)
+        if args.min_cos is not None and result["cosine_min"] < args.min_cos:
+            print(f"❌ cosine {result['cosine_min']:.4f} < {args.min_cos}")
+            sys.exit(1)
+    else:
+        result = parity_check(args.csv, args.audio, args.model, args.labels, args.int8, limit=args.limit)
+        if args.max_mae is not None and result["score_mae_int8_vs_fp32"] > args.max_mae:
+            print(f"❌ MAE {result['score_mae_int8_vs_fp32']:.3f} > {args.max_mae}")
+            sys.exit(1)
@@ -0,0 +1,123 @@
+# shadowJobs.py
+# Job bất đồng bộ cho /jobs (submit rồi poll hoặc callback) và giới hạn số
+# request đồng thời của từng client.
+import json
+import time
+import uuid
+import urllib.request
+from collections import Counter, OrderedDict
+from typing import Optional
+
+from shadowMetrics import metrics
+
+# tên priority trong API -> priority của MicroBatcher (nhỏ hơn chạy trước)
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+
+class ClientLimited(Exception):
+    """Client đã có đủ `limit` request đang chờ/chạy: trả 429."""
+    def __init__(self, client: str, limit: int, retry_after: float):
+        super().__init__(f"Client {client} đã có {limit} request đang xử lý")
+        self.retry_after = retry_after
+
+
+class ClientLimiter:
+    """Đếm request đang chờ + đang chạy theo client; `acquire` ném ClientLimited khi vượt `limit` (0 = tắt)."""
+    def __init__(self, limit: int):
+        self.limit = max(0, int(limit))
+        self.active = Counter()
+        self.rejected = 0
+
+    def acquire(self, client: str, retry_after: float = 1.0):
+        if self.limit and self.active[client] >= self.limit:
+            self.rejected += 1
+            metrics.inc("shadow_rejected_client_limit_total")
+            raise ClientLimited(client, self.limit, retry_after)
+        self.active[client] += 1
+
+    def release(self, client: str):
+        self.active[client] -= 1
+        if self.active[client] <= 0:
+            del self.active[client]
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "clients": len(self.active),
+                "active": sum(self.active.values()), "rejected": self.rejected}
+
+
+class Job:
+    __slots__ = ("id", "client", "priority", "status", "created", "started", "finished",
+                 "result", "error", "callback_url", "task")
+
+    def __init__(self, client: str, priority: str, callback_url: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.priority = priority
+        self.status = "queued"  # queued -> done | failed | cancelled
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.callback_url = callback_url
+        self.task = None
+
+    def to_dict(self) -> dict:
+        data = {"job_id": self.id, "status": self.status, "priority": self.priority, "created": self.created}
+        if self.started is not None:
+            data["started"] = self.started
+        if self.finished is not None:
+            data["finished"] = self.finished
+        if self.result is not None:
+            data.update(self.result)
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobStore:
+    """
+    Job trong RAM của process. Job đã xong được giữ `ttl_s` giây để client
+    poll; quá `max_jobs` thì bỏ job cũ nhất đã xong.
+    """
+    def __init__(self, ttl_s: float = 600.0, max_jobs: int = 10000):
+        self.ttl_s = float(ttl_s)
+        self.max_jobs = max(1, int(max_jobs))
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def add(self, job: Job) -> Job:
+        self.prune()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def prune(self):
+        now = time.time()
+        expired = [k for k, j in self._jobs.items() if j.finished is not None and now - j.finished > self.ttl_s]
+        for k in expired:
+            del self._jobs[k]
+        if len(self._jobs) >= self.max_jobs:
+            for k in [k for k, j in self._jobs.items() if j.finished is not None][:len(self._jobs) - self.max_jobs + 1]:
+                del self._jobs[k]
+
+    def stats(self) -> dict:
+        return {"jobs": len(self._jobs), **Counter(j.status for j in self._jobs.values())}
+
+
+def post_callback(url: str, payload: dict, timeout: float = 5.0, retries: int = 1) -> bool:
+    """POST kết quả job tới callback_url (chạy trong threadpool). Trả về True nếu server nhận 2xx."""
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    for attempt in range(retries + 1):
+        try:
+            req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                if 200 <= resp.status < 300:
+                    return True
+        except Exception as e:
+            print(f"⚠ Job callback {url} failed: {e}")
+        if attempt < retries:
+            time.sleep(0.5 * (attempt + 1))
+    metrics.inc("shadow_job_callback_failures_total")
+    return False
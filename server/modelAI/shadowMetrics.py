@@ -0,0 +1,141 @@
+# shadowMetrics.py
+# Đo thời gian từng stage của pipeline chấm điểm, xuất dạng Prometheus text.
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# giây; đủ rộng cho cả feature extract (ms) lẫn forward clip dài (s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # + Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Histogram theo stage + counter đơn giản, an toàn giữa các thread."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self._local = threading.local()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.observe(seconds)
+        rec = getattr(self._local, "record", None)
+        if rec is not None:
+            rec[stage + "_ms"] = rec.get(stage + "_ms", 0.0) + seconds * 1000.0
+
+    def inc(self, name: str, value: float = 1.0):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0.0) + value
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    @contextmanager
+    def record(self):
+        """Gom thời gian các stage chạy trong thread hiện tại vào 1 dict (ms)."""
+        prev = getattr(self._local, "record", None)
+        rec = {}
+        self._local.record = rec
+        try:
+            yield rec
+        finally:
+            self._local.record = prev
+
+    def render(self, gauges: dict = None) -> str:
+        lines = [
+            "# HELP shadow_stage_seconds Time spent per scoring stage",
+            "# TYPE shadow_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for upper, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append(f'shadow_stage_seconds_bucket{{stage="{stage}",le="{upper}"}} {cumulative}')
+                lines.append(f'shadow_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'shadow_stage_seconds_sum{{stage="{stage}"}} {hist.sum:.6f}')
+                lines.append(f'shadow_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def process_rss_bytes() -> int:
+    """RSS hiện tại của process (Linux /proc, fallback ru_maxrss)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            return 0
+
+
+def process_memory(pid="self") -> dict:
+    """
+    {"rss", "pss", "uss"} bytes của 1 process từ /proc/<pid>/smaps_rollup.
+    PSS chia đều trang dùng chung (weights sau fork) cho các process đang map
+    nó, nên cộng PSS các worker mới ra tổng RAM thật; cộng RSS sẽ đếm trùng.
+    """
+    mem = {"rss": 0, "pss": 0, "uss": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                    kb = int(rest.split()[0]) * 1024
+                    if key.startswith("Private"):
+                        mem["uss"] += kb
+                    else:
+                        mem[key.lower()] = kb
+    except (OSError, ValueError):
+        if pid == "self":
+            mem["rss"] = mem["pss"] = mem["uss"] = process_rss_bytes()
+    return mem
+
+
+def process_gauges() -> dict:
+    import torch
+    mem = process_memory()
+    return {
+        "shadow_process_resident_memory_bytes": mem["rss"],
+        "shadow_process_proportional_memory_bytes": mem["pss"],
+        "shadow_torch_num_threads": torch.get_num_threads(),
+        "shadow_torch_num_interop_threads": torch.get_num_interop_threads(),
+    }
+
+
+metrics = Registry()
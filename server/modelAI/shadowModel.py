@@ -1,7 +1,15 @@
 # shadow_simple.py
+import io
 import os
+import json
 import random
 import pickle
+import sqlite3
+import shutil
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from typing import List
 
 import numpy as np
@@ -10,16 +18,23 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import librosa
-from torch.utils.data import Dataset, DataLoader
+import soundfile as sf
+from torch.utils.data import Dataset, DataLoader, Sampler
 
 from sklearn.preprocessing import MultiLabelBinarizer
-from transformers import Wav2Vec2Processor, Wav2Vec2Model, AutoTokenizer, AutoModel
+from shadowAudio import AudioPack, build_audio_pack, decode_audio, trim_silence
+from shadowMetrics import metrics
+from transformers import Wav2Vec2Processor, Wav2Vec2Model, AutoTokenizer, AutoModel, AutoConfig
 import unicodedata
 
 # --------- Config ----------
 WAV2VEC_MODEL = "facebook/wav2vec2-base-960h"
 TEXT_MODEL = "cl-tohoku/bert-base-japanese"
 SAMPLE_RATE = 16000
+# Local consolidated snapshot (see snapshot_pretrained, `python shadowAI_api.py --snapshot`);
+# falls back to the hub ids
+PRETRAINED_DIR = os.environ.get(
+    "SHADOW_PRETRAINED_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pretrained"))
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 SEED = 42
@@ -29,138 +44,569 @@ DEFAULT_EPOCHS = 10
 DEFAULT_BATCH = 4
 DEFAULT_LR = 1e-5
 FREEZE_PRETRAINED = True
-NUM_WORKERS = 0
+# DataLoader decode workers: 0 = decode in the main process (default). Opt in with
+# SHADOW_NUM_WORKERS=N or num_workers=N; each worker loads its own processor/tokenizer
+# and on Windows / spawn re-imports this module, min(4, cpu_count - 1) is a good start.
+NUM_WORKERS = max(0, int(os.environ.get("SHADOW_NUM_WORKERS", "0")))
+PREFETCH_FACTOR = 4      # batches prefetched per worker
+BUCKET_BY_LENGTH = True  # group clips of similar duration to cut padding
+EMBED_CACHE_DIR = None   # e.g. "embed_cache": train heads from cached frozen embeddings
+AUDIO_PACK = None        # e.g. "wav_pack": pre-resampled float32 memmap of the audio folder
 
-# reproducibility
-torch.manual_seed(SEED)
-np.random.seed(SEED)
-random.seed(SEED)
+# Long-audio inference: clips longer than CHUNK_SECONDS are encoded in overlapping windows
+CHUNK_SECONDS = 20.0
+CHUNK_OVERLAP_SECONDS = 1.0
 
-# --------- Dataset ----------
-class ShadowDataset(Dataset):
+def set_seed(seed: int = SEED):
+    """Seed python / numpy / torch RNGs (called by train_model, not at import)."""
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+# --------- Text helpers ----------
+def clean_text(text):
+    """Normalize Unicode (NFC) and replace non-printable characters with spaces."""
+    if pd.isna(text):
+        return ""
+    # chuẩn hóa Unicode
+    text = unicodedata.normalize("NFC", str(text))
+    # loại bỏ ký tự lạ không in được
+    text = "".join([c if unicodedata.category(c)[0] != "C" else " " for c in text])
+    return text.strip()
+
+def file_checksum(path: str) -> str:
+    """SHA-1 of a file's bytes, used to namespace caches by model version."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def state_checksum(*modules: nn.Module) -> str:
+    """SHA-1 of the parameters and buffers of `modules`, for caches keyed by in-memory weights."""
+    h = hashlib.sha1()
+    for module in modules:
+        for name, t in module.state_dict().items():
+            h.update(f"{name}|{t.dtype}|{tuple(t.shape)}|".encode("utf-8"))
+            h.update(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+def clean_text_series(series: pd.Series) -> pd.Series:
+    """Vectorized clean_text over a whole column."""
+    out = series.astype(object).where(series.notna(), "").astype(str).str.normalize("NFC")
+    # classify each distinct character once instead of every character of every row
+    controls = {c: " " for c in set("".join(out)) if unicodedata.category(c)[0] == "C"}
+    if controls:
+        out = out.str.translate(str.maketrans(controls))
+    return out.str.strip()
+
+def read_csv_auto(csv_path: str) -> pd.DataFrame:
+    # tự động detect encoding: utf-8-sig / shift_jis / cp1252
+    # (decode thử trên bytes, chỉ parse CSV 1 lần)
+    with open(csv_path, "rb") as f:
+        raw = f.read()
+    for enc in ["utf-8-sig", "shift_jis", "cp1252"]:
+        try:
+            text = raw.decode(enc)
+        except UnicodeDecodeError:
+            print(f"  Trying {enc}... failed")
+            continue
+        try:
+            df = pd.read_csv(io.StringIO(text), sep=",")
+        except Exception as e:
+            print(f"❌ CSV load error: {e}")
+            print(f"❌ File path: {os.path.abspath(csv_path)}")
+            raise ValueError(f"Failed to read CSV at {csv_path}")
+        print(f"✅ CSV loaded with encoding: {enc}")
+        return df
+    print(f"❌ File path: {os.path.abspath(csv_path)}")
+    raise ValueError(f"Failed to read CSV at {csv_path}: unknown encoding")
+
+# --------- Dataset manifest ----------
+def _pack_strings(values) -> tuple:
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+class DatasetManifest:
     """
-    Expects CSV with columns:
-      - id (base filename without .wav)
-      - scrip (text transcription)
-      - score or scord (numeric score)
-      - error (comma-separated error labels, can be empty)
+    Columnar compile of a ShadowDataset CSV, built once and memory-mapped.
+
+    Text normalization, error splitting, label binarization and pos_weight
+    are computed vectorized at build time, so per-sample access is plain
+    array indexing. Layout in `manifest_dir`:
+      meta.json                      - {"version", "source_checksum", "rows", "classes"}
+      ids.npy / ids_offsets.npy      - UTF-8 bytes of every id + (N+1) byte offsets
+      texts.npy / texts_offsets.npy  - cleaned scrip, same encoding
+      scores.npy                     - float32 (N,) raw score (0-100)
+      labels.npy                     - uint8 (N, ceil(C/8)) multi-hot matrix, np.packbits
+      pos_weight.npy                 - float32 (C,) negatives / positives, clipped to [0.1, 100]
     """
-    def __init__(self, csv_path: str, audio_folder: str):
-        # tự động detect encoding: utf-8-sig / shift_jis / cp1252
-        encodings = ["utf-8-sig", "shift_jis", "cp1252"]
-        for enc in encodings:
-            try:
-                self.df = pd.read_csv(csv_path, sep=",", encoding=enc)
-                print(f"✅ CSV loaded with encoding: {enc}")
-                break
-            except Exception:
-                print(f"  Trying {enc}... failed")
-                continue
-        else:
-            # fallback: try without sep parameter
-            try:
-                self.df = pd.read_csv(csv_path, encoding='utf-8-sig')
-                print(f"✅ CSV loaded (default separator)")
-            except Exception as e:
-                print(f"❌ CSV load error: {e}")
-                print(f"❌ File path: {os.path.abspath(csv_path)}")
-                raise ValueError(f"Failed to read CSV at {csv_path}")
+    VERSION = 1
+    ARRAYS = ("ids", "ids_offsets", "texts", "texts_offsets", "scores", "labels", "pos_weight")
+
+    def __init__(self, manifest_dir: str):
+        self.manifest_dir = manifest_dir
+        with open(os.path.join(manifest_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.classes = list(self.meta["classes"])
+        self._arrays = None
+
+    @classmethod
+    def for_csv(cls, csv_path: str, manifest_dir: str = None) -> "DatasetManifest":
+        """Open the manifest of `csv_path`, compiling it first if missing or stale."""
+        manifest_dir = manifest_dir or csv_path + ".manifest"
+        checksum = file_checksum(csv_path)
+        try:
+            manifest = cls(manifest_dir)
+            if manifest.meta.get("version") == cls.VERSION and manifest.meta.get("source_checksum") == checksum:
+                return manifest
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls.build(csv_path, manifest_dir, checksum)
+
+    @classmethod
+    def build(cls, csv_path: str, manifest_dir: str, checksum: str = None) -> "DatasetManifest":
+        df = read_csv_auto(csv_path).reset_index(drop=True)
 
         # unify column names
-        if "score" not in self.df.columns and "scord" in self.df.columns:
-            self.df = self.df.rename(columns={"scord": "score"})
-        if "score" not in self.df.columns:
+        if "score" not in df.columns and "scord" in df.columns:
+            df = df.rename(columns={"scord": "score"})
+        if "score" not in df.columns:
             raise ValueError("CSV must contain 'score' or 'scord' column")
+        if "id" not in df.columns:
+            raise ValueError("CSV must contain 'id' column")
 
         # fill missing columns
-        if "error" not in self.df.columns:
-            self.df["error"] = ""
-        if "scrip" not in self.df.columns:
-            self.df["scrip"] = ""
+        if "error" not in df.columns:
+            df["error"] = ""
+        if "scrip" not in df.columns:
+            df["scrip"] = ""
 
         # normalize Unicode, remove invalid characters
-        def clean_text(text):
-            if pd.isna(text):
-                return ""
-            # chuẩn hóa Unicode
-            text = unicodedata.normalize("NFC", str(text))
-            # loại bỏ ký tự lạ không in được
-            text = "".join([c if unicodedata.category(c)[0] != "C" else " " for c in text])
-            return text.strip()
-
-        self.df["scrip"] = self.df["scrip"].apply(clean_text)
-        self.df["error"] = self.df["error"].apply(clean_text)
-
-        # split error column -> list of strings
-        def _split_errors(x):
-            if pd.isna(x) or str(x).strip() == "":
-                return []
-            parts = [p.strip() for p in str(x).replace(";", ",").split(",") if p.strip() != ""]
-            return parts
-
-        self.df["error_list"] = self.df["error"].apply(_split_errors)
-        self.audio_folder = audio_folder
+        texts = clean_text_series(df["scrip"])
+        errors = clean_text_series(df["error"])
 
-        # fit MultiLabelBinarizer on whole dataset
-        self.mlb = MultiLabelBinarizer(sparse_output=False)
-        self.mlb.fit(self.df["error_list"].tolist())
-        # build error matrix and store as list per row
-        error_matrix = self.mlb.transform(self.df["error_list"].tolist())
-        self.df["error_vec"] = error_matrix.tolist()
+        # error column -> (row, label) pairs -> multi-hot matrix
+        parts = errors.str.replace(";", ",", regex=False).str.split(",").explode().str.strip()
+        parts = parts[parts.notna() & (parts != "")]
+        classes = sorted(parts.unique())
+        matrix = np.zeros((len(df), len(classes)), dtype=np.uint8)
+        matrix[parts.index.to_numpy(), pd.Categorical(parts, categories=classes).codes] = 1
 
         # compute pos_weight for each class: ratio of negatives / positives
-        pos_counts = error_matrix.sum(axis=0).astype(float)  # positives per class
-        neg_counts = max(1.0, len(self.df)) - pos_counts
-        # avoid zeros
+        pos_counts = matrix.sum(axis=0).astype(float)
+        neg_counts = max(1.0, len(df)) - pos_counts
         pos_counts_safe = np.where(pos_counts > 0, pos_counts, 1.0)
-        pos_weight = neg_counts / pos_counts_safe
-        # clamp extreme values
-        pos_weight = np.clip(pos_weight, 0.1, 100.0)
-        self.class_pos_weight = torch.tensor(pos_weight, dtype=torch.float32)
+        pos_weight = np.clip(neg_counts / pos_counts_safe, 0.1, 100.0)
+
+        ids, ids_offsets = _pack_strings(df["id"].astype(str))
+        text_bytes, texts_offsets = _pack_strings(texts)
+        arrays = {
+            "ids": ids, "ids_offsets": ids_offsets,
+            "texts": text_bytes, "texts_offsets": texts_offsets,
+            "scores": pd.to_numeric(df["score"]).to_numpy(dtype=np.float32),
+            "labels": np.packbits(matrix, axis=1),
+            "pos_weight": pos_weight.astype(np.float32),
+        }
+
+        # write next to the final dir, then swap, so readers never see half a manifest
+        tmp_dir = manifest_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), arr)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": cls.VERSION, "source_checksum": checksum or file_checksum(csv_path),
+                       "rows": len(df), "classes": classes}, f, ensure_ascii=False)
+        shutil.rmtree(manifest_dir, ignore_errors=True)
+        os.replace(tmp_dir, manifest_dir)
+        print(f"Compiled manifest: {len(df)} rows, {len(classes)} labels -> {manifest_dir}")
+        return cls(manifest_dir)
+
+    @property
+    def arrays(self) -> dict:
+        if self._arrays is None:
+            self._arrays = {name: np.load(os.path.join(self.manifest_dir, name + ".npy"), mmap_mode="r")
+                            for name in self.ARRAYS}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None  # DataLoader workers reopen the memmaps
+        return state
+
+    def __len__(self):
+        return int(self.meta["rows"])
+
+    def _string(self, name: str, idx: int) -> str:
+        offsets = self.arrays[name + "_offsets"]
+        return self.arrays[name][offsets[idx]:offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def id(self, idx: int) -> str:
+        return self._string("ids", idx)
+
+    def ids(self) -> List[str]:
+        return [self.id(i) for i in range(len(self))]
+
+    def text(self, idx: int) -> str:
+        return self._string("texts", idx)
+
+    def score(self, idx: int) -> float:
+        return float(self.arrays["scores"][idx])
+
+    def labels(self, idx: int) -> np.ndarray:
+        """Multi-hot float32 vector (n_classes,) of one row."""
+        return np.unpackbits(self.arrays["labels"][idx], count=len(self.classes)).astype(np.float32)
+
+    def label_matrix(self) -> np.ndarray:
+        return np.unpackbits(self.arrays["labels"], axis=1, count=len(self.classes))
+
+    def error_list(self, idx: int) -> List[str]:
+        return [self.classes[j] for j in np.flatnonzero(self.labels(idx))]
+
+# --------- Dataset ----------
+class ShadowDataset(Dataset):
+    """
+    Expects CSV with columns:
+      - id (base filename without .wav)
+      - scrip (text transcription)
+      - score or scord (numeric score)
+      - error (comma-separated error labels, can be empty)
+
+    The CSV is compiled once into a DatasetManifest (`<csv>.manifest/` unless
+    `manifest_dir` is given) and recompiled only when the file changes.
+    """
+    def __init__(self, csv_path: str, audio_folder: str, audio_pack: str = None, manifest_dir: str = None):
+        self.manifest = DatasetManifest.for_csv(csv_path, manifest_dir)
+        self.audio_folder = audio_folder
+        # optional pre-resampled pack (see shadowAudio.build_audio_pack)
+        self.audio_pack = AudioPack(audio_pack) if audio_pack else None
+
+        # label order = manifest classes (sorted, as MultiLabelBinarizer.fit would give)
+        self.mlb = MultiLabelBinarizer(sparse_output=False)
+        self.mlb.fit([self.manifest.classes])
+        self.class_pos_weight = torch.tensor(np.asarray(self.manifest.arrays["pos_weight"]), dtype=torch.float32)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.manifest)
+
+    def audio_lengths(self) -> List[int]:
+        """Length (in samples at SAMPLE_RATE) of every clip, read from file headers only."""
+        if getattr(self, "_audio_lengths", None) is None:
+            lengths = []
+            for file_id in self.manifest.ids():
+                if self.audio_pack is not None and file_id in self.audio_pack:
+                    lengths.append(self.audio_pack.length(file_id))
+                    continue
+                audio_path = os.path.join(self.audio_folder, file_id + ".wav")
+                try:
+                    lengths.append(int(sf.info(audio_path).duration * SAMPLE_RATE))
+                except Exception:
+                    lengths.append(int(0.5 * SAMPLE_RATE))  # silent buffer in __getitem__
+            self._audio_lengths = lengths
+        return self._audio_lengths
 
     def __getitem__(self, idx):
-        row = self.df.iloc[idx]
-        file_id = str(row["id"])
-        audio_path = os.path.join(self.audio_folder, file_id + ".wav")
+        file_id = self.manifest.id(idx)
 
-        if not os.path.exists(audio_path):
-            print(f"⚠ Missing audio: {audio_path}, using silent buffer")
-            wav = np.zeros(int(0.5 * SAMPLE_RATE), dtype="float32")
+        if self.audio_pack is not None and file_id in self.audio_pack:
+            wav = self.audio_pack.get(file_id)  # zero-copy view into the memmap
         else:
+            audio_path = os.path.join(self.audio_folder, file_id + ".wav")
             try:
-                wav, sr = librosa.load(audio_path, sr=SAMPLE_RATE, mono=True)
-                wav = wav.astype("float32")
+                wav, _ = decode_audio(audio_path)
+            except FileNotFoundError:
+                print(f"⚠ Missing audio: {audio_path}, using silent buffer")
+                wav = np.zeros(int(0.5 * SAMPLE_RATE), dtype="float32")
             except Exception:
                 print(f"⚠ Corrupt audio: {audio_path}, using silent buffer")
                 wav = np.zeros(int(0.5 * SAMPLE_RATE), dtype="float32")
 
-        text = str(row.get("scrip", "") or "")
-        score = float(row["score"]) / 100.0
-        error_vec = np.array(row["error_vec"], dtype=np.float32)
-        return wav, text, np.float32(score), error_vec
+        score = self.manifest.score(idx) / 100.0
+        return wav, self.manifest.text(idx), np.float32(score), self.manifest.labels(idx)
+
+# --------- Length bucketing ----------
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups clips of similar duration.
+
+    Indices are shuffled, split into pools of `batch_size * bucket_multiplier`,
+    each pool is sorted by length and cut into batches, then the batches are
+    shuffled. Batches stay random across epochs but padding inside a batch is small.
+    """
+    def __init__(self, lengths: List[int], batch_size: int, bucket_multiplier: int = 50,
+                 shuffle: bool = True, drop_last: bool = False):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * max(1, bucket_multiplier)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        return iter(self._batches(random))
+
+    def _batches(self, rng) -> List[List[int]]:
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            for b in range(0, len(pool), self.batch_size):
+                batch = pool[b:b + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class DistributedBucketSampler(LengthBucketSampler):
+    """
+    LengthBucketSampler split across DistributedDataParallel ranks.
+
+    Every rank builds the same batch list from `seed + epoch`, pads it by
+    repeating batches to a multiple of `world_size` and keeps every
+    world_size-th batch, so all ranks run the same number of steps (gloo
+    all-reduce would hang otherwise). `skip` drops that many of this rank's
+    batches from the start, for resuming mid-epoch.
+    """
+    def __init__(self, lengths: List[int], batch_size: int, rank: int, world_size: int,
+                 seed: int = SEED, **kwargs):
+        super().__init__(lengths, batch_size, **kwargs)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
 
-# --------- Processors (pretrained) ----------
-wav2vec_proc = Wav2Vec2Processor.from_pretrained(WAV2VEC_MODEL)
-tokenizer = AutoTokenizer.from_pretrained(TEXT_MODEL)
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _rank_batches(self) -> List[List[int]]:
+        batches = self._batches(random.Random(self.seed + self.epoch))
+        if batches and len(batches) % self.world_size:
+            batches += (batches * self.world_size)[:self.world_size - len(batches) % self.world_size]
+        return batches[self.rank::self.world_size]
+
+    def __iter__(self):
+        return iter(self._rank_batches()[self.skip:])
+
+    def __len__(self):
+        return max(0, len(self._rank_batches()) - self.skip)
+
+
+def padding_ratio(lengths) -> float:
+    """
+    Fraction of a padded batch that is padding (0 = no waste). Compute only:
+    padded frames never reach the pooled embedding (ShadowNet.encode_audio).
+    """
+    lengths = [int(n) for n in lengths]
+    if not lengths or max(lengths) == 0:
+        return 0.0
+    return 1.0 - sum(lengths) / float(max(lengths) * len(lengths))
+
+# --------- Pretrained resources (lazy, shared) ----------
+_resources = {}
+_resources_lock = threading.Lock()
+
+def pretrained_source(hub_id: str, subdir: str):
+    """(path_or_id, kwargs) for from_pretrained: local snapshot when present, else the hub."""
+    local = os.path.join(PRETRAINED_DIR, subdir)
+    if os.path.isdir(local):
+        return local, {"local_files_only": True}
+    return hub_id, {}
+
+def _shared(key, factory):
+    if key not in _resources:
+        with _resources_lock:
+            if key not in _resources:
+                _resources[key] = factory()
+    return _resources[key]
+
+def get_processor():
+    src, kw = pretrained_source(WAV2VEC_MODEL, "wav2vec2")
+    return _shared("processor", lambda: Wav2Vec2Processor.from_pretrained(src, **kw))
+
+def get_tokenizer():
+    src, kw = pretrained_source(TEXT_MODEL, "bert")
+    return _shared("tokenizer", lambda: AutoTokenizer.from_pretrained(src, **kw))
+
+def use_resources(processor=None, tokenizer=None):
+    """Inject processor/tokenizer objects (e.g. offline benchmarks) instead of loading them."""
+    with _resources_lock:
+        if processor is not None:
+            _resources["processor"] = processor
+        if tokenizer is not None:
+            _resources["tokenizer"] = tokenizer
+
+def snapshot_pretrained(out_dir: str = PRETRAINED_DIR):
+    """Download processors + backbones once and save them as local safetensors for offline boots."""
+    for hub_id, subdir, model_cls, proc_cls in [
+        (WAV2VEC_MODEL, "wav2vec2", Wav2Vec2Model, Wav2Vec2Processor),
+        (TEXT_MODEL, "bert", AutoModel, AutoTokenizer),
+    ]:
+        target = os.path.join(out_dir, subdir)
+        proc_cls.from_pretrained(hub_id).save_pretrained(target)
+        model_cls.from_pretrained(hub_id).save_pretrained(target, safe_serialization=True)
+        print("Saved:", target)
+
+def load_state(path: str, map_location=DEVICE, **kwargs):
+    """
+    torch.load with mmap (no extra copy of the weights) when the file format
+    allows it; falls back to a plain load for legacy files (RuntimeError) and
+    torch versions without the `mmap` argument (TypeError).
+    """
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, **kwargs)
+    except (RuntimeError, TypeError):
+        return torch.load(path, map_location=map_location, **kwargs)
 
 # --------- Collate ----------
+def audio_batch(wavs, processor=None) -> dict:
+    """
+    Processor output for 1-D waveforms zero-padded to the longest. Each clip
+    is normalized over its own samples only, and "audio_lengths" (samples)
+    tells encode_audio which frames belong to it, so a clip's embedding does
+    not depend on what it is batched with.
+    """
+    processor = processor or get_processor()
+    inputs = processor(list(wavs), sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True,
+                       return_attention_mask=True)
+    return {"input_values": inputs["input_values"],
+            "audio_lengths": torch.tensor([len(w) for w in wavs], dtype=torch.long)}
+
 def collate_fn(batch):
     audios, texts, scores, errors = zip(*batch)
-    audio_inputs = wav2vec_proc(list(audios), sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True)
-    text_inputs = tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True, max_length=128)
+    audio_inputs = audio_batch(audios)
+    text_inputs = get_tokenizer()(list(texts), return_tensors="pt", padding=True, truncation=True, max_length=128)
     scores = torch.tensor(scores, dtype=torch.float32)
     errors = torch.tensor(np.stack(errors, axis=0), dtype=torch.float32)
     return audio_inputs, text_inputs, scores, errors
 
 # --------- Model ----------
+def _layer_list(backbone: nn.Module):
+    """(parent module, attribute name) of the transformer layer ModuleList of a wav2vec2 / BERT model."""
+    encoder = backbone.encoder
+    return (encoder, "layers") if hasattr(encoder, "layers") else (encoder, "layer")
+
+def layer_selection(backbone: nn.Module) -> str:
+    """
+    Original indices of the transformer layers left by select_layers /
+    truncate_layers, e.g. "0,4,8,11" (evenly spaced) or "0,1,2" (first K).
+    """
+    n = len(getattr(*_layer_list(backbone)))
+    return ",".join(map(str, getattr(backbone, "kept_layer_ids", range(n))))
+
+def _keep_layer_ids(backbone: nn.Module, idx):
+    ids = [int(i) for i in layer_selection(backbone).split(",")]
+    backbone.kept_layer_ids = [ids[i] for i in idx]
+
+def select_layers(backbone: nn.Module, keep: int) -> nn.Module:
+    """
+    Keep `keep` evenly spaced transformer layers (always the first and the
+    last) of a wav2vec2 / BERT backbone, in place. No-op if it already has
+    that many or fewer.
+    """
+    parent, name = _layer_list(backbone)
+    layers = getattr(parent, name)
+    if keep <= 0 or keep >= len(layers):
+        return backbone
+    idx = np.linspace(0, len(layers) - 1, keep).round().astype(int)
+    _keep_layer_ids(backbone, idx)
+    setattr(parent, name, nn.ModuleList([layers[i] for i in idx]))
+    backbone.config.num_hidden_layers = keep
+    return backbone
+
+def truncate_layers(backbone: nn.Module, depth: int) -> nn.Module:
+    """
+    Keep only the first `depth` transformer layers of a wav2vec2 / BERT
+    backbone, in place: the forward pass stops after layer `depth`. No-op if
+    it already has that many or fewer.
+    """
+    parent, name = _layer_list(backbone)
+    layers = getattr(parent, name)
+    if depth <= 0 or depth >= len(layers):
+        return backbone
+    _keep_layer_ids(backbone, range(depth))
+    setattr(parent, name, nn.ModuleList(list(layers)[:depth]))
+    backbone.config.num_hidden_layers = depth
+    return backbone
+
+def state_layer_counts(state: dict) -> dict:
+    """
+    ShadowNet shape kwargs found in a state_dict (fp32 or int8):
+    "audio_layers" / "text_layers", plus "audio_pooling" for weighted-layer checkpoints.
+    """
+    counts = {}
+    for key in state:
+        for arg, prefix in (("audio_layers", "wav2vec.encoder.layers."), ("text_layers", "text_model.encoder.layer.")):
+            if key.startswith(prefix):
+                counts[arg] = max(counts.get(arg, 0), int(key[len(prefix):].split(".", 1)[0]) + 1)
+    if "audio_layer_weights" in state:
+        counts["audio_pooling"] = "weighted"
+    return counts
+
 class ShadowNet(nn.Module):
-    def __init__(self, n_error_classes: int, freeze_pretrained: bool = True):
+    def __init__(self, n_error_classes: int, freeze_pretrained: bool = True, pretrained: bool = True,
+                 audio_config=None, text_config=None, audio_layers: int = None, text_layers: int = None,
+                 audio_depth: int = None, audio_pooling: str = "last"):
+        """
+        `audio_layers` / `text_layers` keep only that many transformer layers
+        (distilled students, see shadowDistill.py); checkpoints record them
+        implicitly, use `state_layer_counts(state)` to rebuild the right shape.
+
+        `audio_depth` keeps the first K wav2vec2 layers (encoding stops after
+        layer K, see shadowDepth.py). `audio_pooling` is "last" (output of the
+        last kept layer) or "weighted" (learned softmax-weighted sum of the
+        embedding output and every kept layer).
+        """
+        if audio_pooling not in ("last", "weighted"):
+            raise ValueError(f"audio_pooling must be 'last' or 'weighted', got {audio_pooling!r}")
         super().__init__()
-        self.wav2vec = Wav2Vec2Model.from_pretrained(WAV2VEC_MODEL)
-        self.text_model = AutoModel.from_pretrained(TEXT_MODEL)
+        audio_src, audio_kw = pretrained_source(WAV2VEC_MODEL, "wav2vec2")
+        text_src, text_kw = pretrained_source(TEXT_MODEL, "bert")
+        if audio_config is not None and text_config is not None:
+            # random init from explicit configs (benchmarks, students)
+            self.wav2vec = Wav2Vec2Model(audio_config)
+            self.text_model = AutoModel.from_config(text_config)
+        elif pretrained:
+            self.wav2vec = Wav2Vec2Model.from_pretrained(audio_src, **audio_kw)
+            self.text_model = AutoModel.from_pretrained(text_src, **text_kw)
+        else:
+            # weights come from a ShadowNet checkpoint right after; skip loading them twice
+            audio_cfg = AutoConfig.from_pretrained(audio_src, **audio_kw)
+            text_cfg = AutoConfig.from_pretrained(text_src, **text_kw)
+            # build truncated students at their final size instead of allocating every layer
+            for n in (audio_layers, audio_depth):
+                if n:
+                    audio_cfg.num_hidden_layers = min(n, audio_cfg.num_hidden_layers)
+            if text_layers:
+                text_cfg.num_hidden_layers = min(text_layers, text_cfg.num_hidden_layers)
+            self.wav2vec = Wav2Vec2Model(audio_cfg)
+            self.text_model = AutoModel.from_config(text_cfg)
+        if audio_layers:
+            select_layers(self.wav2vec, audio_layers)
+        if text_layers:
+            select_layers(self.text_model, text_layers)
+        if audio_depth:
+            truncate_layers(self.wav2vec, audio_depth)
+
+        self.audio_pooling = audio_pooling
+        if audio_pooling == "weighted":
+            # one logit per hidden state: embedding output + each kept layer (uniform at init)
+            n_states = len(getattr(*_layer_list(self.wav2vec))) + 1
+            self.audio_layer_weights = nn.Parameter(torch.zeros(n_states))
+            # a layer skipped by layerdrop yields no hidden state: keep every layer in training
+            self.wav2vec.config.layerdrop = 0.0
 
         audio_hidden = self.wav2vec.config.hidden_size
         text_hidden = self.text_model.config.hidden_size
@@ -174,33 +620,533 @@ class ShadowNet(nn.Module):
         self.score_head = nn.Linear(256, 1)
         self.error_head = nn.Linear(256, n_error_classes)
 
+        # 0 / None disables chunking (whole clip in one wav2vec2 pass)
+        self.chunk_seconds = CHUNK_SECONDS
+        self.chunk_overlap_seconds = CHUNK_OVERLAP_SECONDS
+
         if freeze_pretrained:
             for p in self.wav2vec.parameters():
                 p.requires_grad = False
             for p in self.text_model.parameters():
                 p.requires_grad = False
 
-    def forward(self, audio_inputs, text_inputs):
+    def layer_counts(self) -> dict:
+        return {"audio_layers": len(getattr(*_layer_list(self.wav2vec))),
+                "text_layers": len(getattr(*_layer_list(self.text_model)))}
+
+    def audio_hidden_states(self, input_values, attention_mask=None):
+        """Per-frame wav2vec2 features (batch, frames, audio_hidden) used for pooling."""
+        weighted = self.audio_pooling == "weighted"
+        out = self.wav2vec(input_values, attention_mask=attention_mask, output_hidden_states=weighted,
+                           return_dict=True)
+        if not weighted:
+            return out.last_hidden_state
+        w = torch.softmax(self.audio_layer_weights, dim=0)
+        return (torch.stack(out.hidden_states) * w.view(-1, 1, 1, 1).to(out.last_hidden_state.dtype)).sum(dim=0)
+
+    def encode_audio(self, audio_inputs):
+        """
+        Mean-pooled wav2vec2 embedding, shape (batch, audio_hidden). Each clip
+        is pooled over its own frames only ("audio_lengths" in samples, or the
+        attention mask), see audio_batch / encode_audio_padded.
+        """
         device = next(self.parameters()).device
         input_values = audio_inputs["input_values"].to(device)
-        attention_mask_audio = audio_inputs.get("attention_mask", None)
-        if attention_mask_audio is not None:
-            attention_mask_audio = attention_mask_audio.to(device)
+        lengths = audio_inputs.get("audio_lengths", None)
+        if lengths is None and audio_inputs.get("attention_mask", None) is not None:
+            lengths = audio_inputs["attention_mask"].sum(dim=1)
+
+        window = int((self.chunk_seconds or 0) * SAMPLE_RATE)
+        with metrics.span("wav2vec_forward"):
+            if window and input_values.shape[1] > window:
+                return self.encode_audio_chunked(input_values, lengths)
+            if lengths is None or bool((lengths == input_values.shape[1]).all()):
+                return self.audio_hidden_states(input_values).mean(dim=1)
+            return self.encode_audio_padded(input_values, lengths.to(device))
+
+    def encode_audio_padded(self, input_values, lengths):
+        """
+        encode_audio for a zero-padded batch with `lengths` valid samples per
+        clip. Checkpoints with layer-norm conv features (feat_extract_norm
+        "layer") take an attention mask and the mean skips padded frames.
+        Group-norm checkpoints (wav2vec2-base-960h) normalize each conv channel
+        over the whole padded input, so padding would leak into every frame:
+        there clips of the same length share one unpadded forward instead.
+        """
+        if self.wav2vec.config.feat_extract_norm == "layer":
+            positions = torch.arange(input_values.shape[1], device=input_values.device)
+            mask = (positions[None, :] < lengths[:, None]).long()
+            hidden = self.audio_hidden_states(input_values, mask)
+            frames = self.wav2vec._get_feat_extract_output_lengths(lengths)
+            keep = torch.arange(hidden.shape[1], device=hidden.device)[None, :] < frames[:, None]
+            summed = (hidden * keep.unsqueeze(-1).to(hidden.dtype)).sum(dim=1)
+            return summed / frames.clamp(min=1).unsqueeze(1).to(hidden.dtype)
 
-        audio_out = self.wav2vec(input_values, attention_mask=attention_mask_audio, return_dict=True)
-        audio_emb = audio_out.last_hidden_state.mean(dim=1)
+        pooled = [None] * input_values.shape[0]
+        for n in lengths.unique().tolist():
+            idx = (lengths == n).nonzero(as_tuple=True)[0]
+            emb = self.audio_hidden_states(input_values[idx, :n]).mean(dim=1)
+            for j, i in enumerate(idx.tolist()):
+                pooled[i] = emb[j]
+        return torch.stack(pooled)
 
+    def encode_audio_chunked(self, input_values, lengths=None, window_s: float = None,
+                             overlap_s: float = None):
+        """
+        Mean-pooled wav2vec2 embedding computed window by window (see
+        StreamingAudioEncoder). Peak activation memory depends only on the
+        window size. Padding beyond `lengths[i]` (samples) is ignored.
+        """
+        pooled = []
+        for i in range(input_values.shape[0]):
+            n = int(lengths[i]) if lengths is not None else input_values.shape[1]
+            encoder = StreamingAudioEncoder(self, window_s, overlap_s)
+            encoder.feed(input_values[i, :n])
+            pooled.append(encoder.finish()[0])
+        return torch.stack(pooled)
+
+    def encode_text(self, text_inputs):
+        """Pooled BERT embedding, shape (batch, text_hidden)."""
+        device = next(self.parameters()).device
         text_inputs = {k: v.to(device) for k, v in text_inputs.items()}
-        text_out = self.text_model(**text_inputs, return_dict=True)
-        text_emb = getattr(text_out, "pooler_output", None)
+        with metrics.span("bert_forward"):
+            text_out = self.text_model(**text_inputs, return_dict=True)
+            text_emb = getattr(text_out, "pooler_output", None)
+            if text_emb is None:
+                text_emb = text_out.last_hidden_state.mean(dim=1)
+            return text_emb
+
+    def head(self, audio_emb, text_emb):
+        with metrics.span("heads"):
+            x = torch.cat([audio_emb, text_emb], dim=1)
+            x = self.proj(x)
+            score = self.score_head(x).squeeze(1)
+            errors_logits = self.error_head(x)
+            return score, errors_logits
+
+    def forward(self, audio_inputs, text_inputs=None, text_emb=None):
+        """Pass `text_emb` (e.g. from TextEmbeddingCache) to skip the BERT forward."""
+        audio_emb = self.encode_audio(audio_inputs)
         if text_emb is None:
-            text_emb = text_out.last_hidden_state.mean(dim=1)
+            text_emb = self.encode_text(text_inputs)
+        else:
+            text_emb = text_emb.to(audio_emb.device)
+        return self.head(audio_emb, text_emb)
+
+# --------- Incremental audio encoding ----------
+class StreamingAudioEncoder:
+    """
+    Running mean-pooled wav2vec2 embedding for audio that arrives in pieces
+    (live shadowing) or is too long for one pass (ShadowNet.encode_audio_chunked).
+
+    Samples are buffered until a full window is available and each window
+    runs through wav2vec2 once. Windows start at multiples of the conv stride,
+    so frame j of a window starting at sample `offset` is frame
+    offset // stride + j of a full pass. Frames are counted by that global
+    index: each window skips frames already counted and (except the last)
+    leaves the frames in the second half of the overlap to the next window,
+    so every full-pass frame is counted exactly once and frame sums go into a
+    running total, giving a length-weighted mean. `finish()` only encodes the
+    remaining tail, so the final embedding is ready one window's compute after
+    the last piece. A tail shorter than the conv receptive field has no frames
+    of its own (the previous window already counted everything before it) and
+    is skipped.
+
+    `normalize=True` is for raw PCM: samples are normalized with the running
+    mean/variance of everything received so far, approximating the
+    processor's whole-clip zero-mean/unit-variance normalization.
+    """
+    def __init__(self, model: "ShadowNet", window_s: float = None, overlap_s: float = None,
+                 normalize: bool = False):
+        self.model = model
+        self.wav2vec = model.wav2vec
+        self.device = next(model.parameters()).device
+        config = self.wav2vec.config
+        self.stride = stride = int(np.prod(config.conv_stride))  # samples per output frame
+        # samples needed for one output frame (400 for wav2vec2-base)
+        self.field, jump = 1, 1
+        for kernel, conv_stride in zip(config.conv_kernel, config.conv_stride):
+            self.field += (kernel - 1) * jump
+            jump *= conv_stride
+        window_s = window_s or model.chunk_seconds or CHUNK_SECONDS
+        if overlap_s is None:
+            overlap_s = model.chunk_overlap_seconds or 0.0
+        self.window = max(2, int(window_s * SAMPLE_RATE) // stride) * stride
+        self.overlap = min(int(overlap_s * SAMPLE_RATE) // stride * stride, self.window // 2)
+        self.step = self.window - self.overlap
+        # frames at the end of a non-final window left for the next window (right context)
+        self.margin = self.overlap // 2 // stride
+        self.normalize = normalize
+
+        self.buffer = None
+        self.offset = 0   # global sample index of buffer[0], multiple of stride
+        self.emitted = 0  # global frames counted so far
+        self.total = None
+        self.count = 0
+        self.n_samples = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+
+    def feed(self, samples) -> int:
+        """Append samples (1-D array/tensor at SAMPLE_RATE); returns the number of windows encoded."""
+        x = torch.as_tensor(samples, dtype=torch.float32).reshape(-1).to(self.device)
+        if x.numel() == 0:
+            return 0
+        if self.normalize:
+            self.n_samples += x.numel()
+            self._sum += float(x.double().sum())
+            self._sumsq += float(x.double().square().sum())
+        self.buffer = x if self.buffer is None else torch.cat([self.buffer, x])
+
+        windows = 0
+        while self.buffer.shape[0] >= self.window:
+            self._encode(self.buffer[:self.window], last=False)
+            self.buffer = self.buffer[self.step:]
+            self.offset += self.step
+            windows += 1
+        return windows
+
+    def finish(self):
+        """
+        Encode the tail; returns the pooled embedding (1, hidden), or None if
+        fewer samples than one receptive field were fed in total.
+        """
+        if self.buffer is not None and self.buffer.shape[0] >= self.field:
+            self._encode(self.buffer, last=True)
+        self.buffer = None
+        return self.pooled()
+
+    def pooled(self):
+        if self.total is None:
+            return None
+        return (self.total / max(1, self.count)).unsqueeze(0)
+
+    def _encode(self, x, last: bool):
+        if self.normalize:
+            mean = self._sum / self.n_samples
+            var = max(0.0, self._sumsq / self.n_samples - mean * mean)
+            x = (x - mean) / np.sqrt(var + 1e-7)
+        hidden = self.model.audio_hidden_states(x.unsqueeze(0))[0]
+        first = self.offset // self.stride  # global index of hidden[0]
+        n_frames = int(self.wav2vec._get_feat_extract_output_lengths(x.shape[0]))
+        lo = max(0, self.emitted - first)
+        hi = n_frames if last else max(lo, n_frames - self.margin)
+        if hi > lo:
+            part = hidden[lo:hi].sum(dim=0)
+            self.total = part if self.total is None else self.total + part
+            self.count += hi - lo
+            self.emitted = first + hi
+
+# --------- Text embedding cache (inference) ----------
+class TextEmbeddingCache:
+    """
+    Bounded LRU of pooled text embeddings keyed by normalized sentence.
+
+    `namespace` should identify the weights (e.g. file_checksum of the
+    checkpoint) so a persisted cache is discarded when the model changes.
+    Thread-safe: the LRU is guarded by a lock, BERT itself runs outside it.
+    """
+    def __init__(self, max_size: int = 4096, namespace: str = "", path: str = None):
+        self.max_size = max(1, int(max_size))
+        self.namespace = namespace
+        self.path = path
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(clean_text(text).split())
+
+    def get(self, text: str):
+        key = self.normalize(text)
+        with self._lock:
+            emb = self._items.get(key)
+            if emb is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return emb
+
+    def put(self, text: str, emb: torch.Tensor):
+        key = self.normalize(text)
+        emb = emb.detach().cpu()
+        with self._lock:
+            self._items[key] = emb
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def encode(self, model: "ShadowNet", texts: List[str]) -> torch.Tensor:
+        """Embeddings for `texts`, running BERT only for the cache misses."""
+        embs = [self.get(t) for t in texts]
+        miss_texts = list(dict.fromkeys(self.normalize(t) for t, e in zip(texts, embs) if e is None))
+        if miss_texts:
+            with metrics.span("tokenize"):
+                text_inputs = get_tokenizer()(miss_texts, return_tensors="pt", padding=True, truncation=True, max_length=128)
+            with torch.no_grad():
+                new_embs = model.encode_text(text_inputs).cpu()
+            fresh = dict(zip(miss_texts, new_embs))
+            for t, e in fresh.items():
+                self.put(t, e)
+            embs = [e if e is not None else fresh[self.normalize(t)] for t, e in zip(texts, embs)]
+        return torch.stack(embs, dim=0)
 
-        x = torch.cat([audio_emb, text_emb], dim=1)
-        x = self.proj(x)
-        score = self.score_head(x).squeeze(1)
-        errors_logits = self.error_head(x)
-        return score, errors_logits
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._items), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+    def save(self, path: str = None):
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            items = list(self._items.items())
+        torch.save({"namespace": self.namespace, "items": items}, path)
+
+    def load(self, path: str):
+        try:
+            data = torch.load(path, map_location="cpu")
+        except Exception as e:
+            print(f"⚠ Could not load text cache {path}: {e}")
+            return
+        if data.get("namespace") != self.namespace:
+            print(f"⚠ Text cache {path} belongs to another model, ignoring")
+            return
+        with self._lock:
+            for key, emb in data["items"][-self.max_size:]:
+                self._items[key] = emb
+
+# --------- Result cache (inference, shared across processes) ----------
+class ResultCache:
+    """
+    Content-addressed (score, errors) cache in a SQLite file, so retried or
+    duplicate submissions skip both backbones. Every server / worker process
+    opening the same `path` shares it (WAL mode, one connection per thread).
+
+    Keys hash the decoded PCM, the normalized text, the threshold and
+    `namespace` (model checksum + anything else that changes results).
+    Entries expire after `ttl_s`; the table is pruned to `max_entries`,
+    oldest first.
+    """
+    PRUNE_EVERY = 256  # puts between prune passes
+
+    def __init__(self, path: str, ttl_s: float = 86400.0, max_entries: int = 100000, namespace: str = ""):
+        self.path = path
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self.namespace = namespace
+        self._local = threading.local()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, score REAL NOT NULL, errors TEXT NOT NULL, created REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_created ON results(created)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def key(self, wav: np.ndarray, text: str, threshold: float) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.namespace.encode("utf-8"))
+        h.update(f"|{float(threshold):.6f}|".encode("utf-8"))
+        h.update(TextEmbeddingCache.normalize(text).encode("utf-8"))
+        h.update(b"|")
+        h.update(np.ascontiguousarray(wav, dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        """(score, errors) or None."""
+        try:
+            row = self._conn().execute("SELECT score, errors FROM results WHERE key = ? AND created > ?",
+                                       (key, time.time() - self.ttl_s)).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠ Result cache read failed: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return float(row[0]), json.loads(row[1])
+
+    def put(self, key: str, score: float, errors: List[str]):
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO results (key, score, errors, created) VALUES (?, ?, ?, ?)",
+                         (key, float(score), json.dumps(list(errors), ensure_ascii=False), time.time()))
+            self._puts += 1
+            if self._puts % self.PRUNE_EVERY == 0:
+                self.prune()
+        except sqlite3.Error as e:
+            print(f"⚠ Result cache write failed: {e}")
+
+    def prune(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM results WHERE created <= ?", (time.time() - self.ttl_s,))
+        conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created DESC "
+                     "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self) -> dict:
+        try:
+            size = self._conn().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        except sqlite3.Error:
+            size = -1
+        total = self.hits + self.misses
+        return {"size": size, "max_size": self.max_entries, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        """Close this thread's connection (call before fork: SQLite handles must not cross it)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+def _worker_init(worker_id):
+    # each DataLoader worker decodes on its own core; avoid torch thread oversubscription
+    torch.set_num_threads(1)
+
+def _loader_kwargs(num_workers: int) -> dict:
+    kwargs = {"num_workers": num_workers, "pin_memory": (DEVICE == "cuda")}
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=PREFETCH_FACTOR, persistent_workers=True,
+                      worker_init_fn=_worker_init)
+    return kwargs
+
+# --------- Frozen embedding cache ----------
+class EmbeddingCache:
+    """
+    On-disk cache of frozen-backbone embeddings, one row per sample.
+
+    Rows are keyed by a content hash of (wav bytes, script, backbone names,
+    kept layers and weight checksum), so
+    editing a transcript or replacing a recording invalidates only that row.
+    Layout in `cache_dir`:
+      index.json  - {"keys": [...]} row order
+      audio.npy   - float32 (N, audio_hidden), loaded memory-mapped
+      text.npy    - float32 (N, text_hidden), loaded memory-mapped
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.audio_path = os.path.join(cache_dir, "audio.npy")
+        self.text_path = os.path.join(cache_dir, "text.npy")
+        self.keys = []
+        self.audio = None
+        self.text = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.keys = json.load(f)["keys"]
+            self.audio = np.load(self.audio_path, mmap_mode="r")
+            self.text = np.load(self.text_path, mmap_mode="r")
+        self.row_of = {k: i for i, k in enumerate(self.keys)}
+
+    @staticmethod
+    def sample_key(audio_path: str, text: str, variant: str = "") -> str:
+        h = hashlib.sha1()
+        h.update(f"{WAV2VEC_MODEL}|{TEXT_MODEL}|{variant}|".encode("utf-8"))
+        if os.path.exists(audio_path):
+            with open(audio_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        h.update(b"|" + text.encode("utf-8"))
+        return h.hexdigest()
+
+    def append(self, keys: List[str], audio_emb: np.ndarray, text_emb: np.ndarray):
+        audio_emb = audio_emb.astype(np.float32)
+        text_emb = text_emb.astype(np.float32)
+        if self.audio is not None and len(self.keys) > 0:
+            audio_emb = np.concatenate([np.asarray(self.audio), audio_emb], axis=0)
+            text_emb = np.concatenate([np.asarray(self.text), text_emb], axis=0)
+        self.audio = self.text = None  # release mmap before overwrite
+        np.save(self.audio_path, audio_emb)
+        np.save(self.text_path, text_emb)
+        self.keys = self.keys + list(keys)
+        with open(self.index_path, "w", encoding="utf-8") as f:
+            json.dump({"keys": self.keys}, f)
+        self.audio = np.load(self.audio_path, mmap_mode="r")
+        self.text = np.load(self.text_path, mmap_mode="r")
+        self.row_of = {k: i for i, k in enumerate(self.keys)}
+
+
+def build_embedding_cache(dataset: "ShadowDataset", model: "ShadowNet", cache_dir: str,
+                          batch_size: int = DEFAULT_BATCH) -> List[int]:
+    """
+    Fill the cache for every row of `dataset`, running the frozen backbones
+    only for rows that are not cached yet. Returns the cache row of each sample.
+    """
+    cache = EmbeddingCache(cache_dir)
+    # truncated / distilled / retrained backbones produce different embeddings for the same clip:
+    # key by which layers were kept (spaced vs first K), chunking and the backbone weights
+    variant = "a{}|t{}|chunk={}|{}".format(layer_selection(model.wav2vec), layer_selection(model.text_model),
+                                          model.chunk_seconds, state_checksum(model.wav2vec, model.text_model))
+    keys = [EmbeddingCache.sample_key(os.path.join(dataset.audio_folder, str(file_id) + ".wav"), text, variant)
+            for file_id, text in zip(dataset.manifest.ids(), map(dataset.manifest.text, range(len(dataset))))]
+    missing, seen = [], set()
+    for i, k in enumerate(keys):
+        if k not in cache.row_of and k not in seen:  # duplicates share one row
+            seen.add(k)
+            missing.append(i)
+
+    if missing:
+        print(f"Building embedding cache: {len(missing)}/{len(keys)} samples to encode")
+        lengths = dataset.audio_lengths()
+        missing.sort(key=lambda i: lengths[i])  # similar lengths per batch
+        was_training = model.training
+        model.eval()
+        audio_chunks, text_chunks = [], []
+        with torch.no_grad():
+            for start in range(0, len(missing), batch_size):
+                idx = missing[start:start + batch_size]
+                audio_inputs, text_inputs, _, _ = collate_fn([dataset[i] for i in idx])
+                audio_chunks.append(model.encode_audio(audio_inputs).cpu().numpy())
+                text_chunks.append(model.encode_text(text_inputs).cpu().numpy())
+                print(f"  encoded {min(start + batch_size, len(missing))}/{len(missing)}")
+        model.train(was_training)
+        cache.append([keys[i] for i in missing],
+                     np.concatenate(audio_chunks, axis=0), np.concatenate(text_chunks, axis=0))
+    else:
+        print(f"Embedding cache hit for all {len(keys)} samples")
+
+    dataset.embedding_cache = cache
+    return [cache.row_of[k] for k in keys]
+
+
+class CachedEmbeddingDataset(Dataset):
+    """Serves (audio_emb, text_emb, score, error_vec) from an EmbeddingCache."""
+    def __init__(self, dataset: "ShadowDataset", cache: EmbeddingCache, rows: List[int]):
+        self.scores = (np.asarray(dataset.manifest.arrays["scores"]) / 100.0).astype(np.float32)
+        self.error_vecs = dataset.manifest.label_matrix().astype(np.float32)
+        self.cache = cache
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        return (torch.from_numpy(np.array(self.cache.audio[row])),
+                torch.from_numpy(np.array(self.cache.text[row])),
+                torch.tensor(self.scores[idx]),
+                torch.from_numpy(self.error_vecs[idx]))
 
 # --------- Train function ----------
 def train_model(csv_path: str, audio_folder: str,
@@ -210,12 +1156,44 @@ def train_model(csv_path: str, audio_folder: str,
                 batch_size: int = DEFAULT_BATCH,
                 lr: float = DEFAULT_LR,
                 freeze_pretrained: bool = FREEZE_PRETRAINED,
-                num_workers: int = NUM_WORKERS):
-    dataset = ShadowDataset(csv_path, audio_folder)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
-                            collate_fn=collate_fn, num_workers=num_workers, pin_memory=(DEVICE=="cuda"))
+                num_workers: int = NUM_WORKERS,
+                bucket_by_length: bool = BUCKET_BY_LENGTH,
+                cache_dir: str = EMBED_CACHE_DIR,
+                audio_pack: str = AUDIO_PACK,
+                audio_depth: int = None,
+                audio_pooling: str = "last",
+                model: nn.Module = None):
+    """
+    Pass `model` to train an already built ShadowNet (e.g. random-init for benchmarks).
+    `audio_depth` / `audio_pooling` select the audio branch (see ShadowNet).
+    """
+    set_seed(SEED)
+    if audio_pack and not AudioPack.exists(audio_pack):
+        build_audio_pack(audio_folder, audio_pack)
+    dataset = ShadowDataset(csv_path, audio_folder, audio_pack=audio_pack)
+    if model is None:
+        model = ShadowNet(n_error_classes=len(dataset.mlb.classes_), freeze_pretrained=freeze_pretrained,
+                          audio_depth=audio_depth, audio_pooling=audio_pooling)
+    model = model.to(DEVICE)
+
+    # frozen backbones -> encode once, then train heads from the cache only
+    use_cache = cache_dir is not None and freeze_pretrained and model.audio_pooling == "last"
+    if cache_dir is not None and not freeze_pretrained:
+        print("⚠ cache_dir ignored: embedding cache requires freeze_pretrained=True")
+    elif cache_dir is not None and not use_cache:
+        print("⚠ cache_dir ignored: weighted audio pooling trains the layer weights through the backbone")
+    if use_cache:
+        rows = build_embedding_cache(dataset, model, cache_dir, batch_size=batch_size)
+        dataloader = DataLoader(CachedEmbeddingDataset(dataset, dataset.embedding_cache, rows),
+                                batch_size=batch_size, shuffle=True, num_workers=0)
+    elif bucket_by_length:
+        sampler = LengthBucketSampler(dataset.audio_lengths(), batch_size, shuffle=True)
+        dataloader = DataLoader(dataset, batch_sampler=sampler,
+                                collate_fn=collate_fn, **_loader_kwargs(num_workers))
+    else:
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                                collate_fn=collate_fn, **_loader_kwargs(num_workers))
 
-    model = ShadowNet(n_error_classes=len(dataset.mlb.classes_), freeze_pretrained=freeze_pretrained).to(DEVICE)
     optimizer = optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, weight_decay=1e-6)
     loss_score = nn.MSELoss()
     # use dataset-computed pos_weight (move to device)
@@ -225,12 +1203,20 @@ def train_model(csv_path: str, audio_folder: str,
     model.train()
     for epoch in range(epochs):
         epoch_loss = 0.0
+        epoch_pad = 0.0
         for batch_idx, (audio_inputs, text_inputs, scores, errors) in enumerate(dataloader):
             scores = scores.to(DEVICE)
             errors = errors.to(DEVICE)
 
             optimizer.zero_grad()
-            pred_score, pred_error_logits = model(audio_inputs, text_inputs)
+            if use_cache:
+                # audio_inputs / text_inputs are cached embeddings here
+                pad = 0.0
+                pred_score, pred_error_logits = model.head(audio_inputs.to(DEVICE), text_inputs.to(DEVICE))
+            else:
+                pad = padding_ratio(audio_inputs["audio_lengths"].tolist())
+                pred_score, pred_error_logits = model(audio_inputs, text_inputs)
+            epoch_pad += pad
 
             l_score = loss_score(pred_score, scores)
             l_error = loss_error(pred_error_logits, errors)
@@ -252,11 +1238,13 @@ def train_model(csv_path: str, audio_folder: str,
                     names = dataset.mlb.classes_
                     pred_names = [names[i] for i, v in enumerate(sample_pred) if v == 1]
                     print(f"[Epoch {epoch+1}/{epochs}] Batch {batch_idx+1}/{len(dataloader)} "
-                          f"loss={loss.item():.4f} score_loss={l_score.item():.4f} err_loss={l_error.item():.4f}")
+                          f"loss={loss.item():.4f} score_loss={l_score.item():.4f} err_loss={l_error.item():.4f} "
+                          f"pad_ratio={pad:.3f}")
                     print(" Example predicted error labels (sample 0):", pred_names)
 
         avg_loss = epoch_loss / max(1, len(dataloader))
-        print(f"Epoch {epoch+1} finished. Avg loss: {avg_loss:.4f}")
+        avg_pad = epoch_pad / max(1, len(dataloader))
+        print(f"Epoch {epoch+1} finished. Avg loss: {avg_loss:.4f} Avg pad ratio: {avg_pad:.3f}")
 
     torch.save(model.state_dict(), save_model)
     with open(save_label, "wb") as f:
@@ -268,23 +1256,44 @@ def train_model(csv_path: str, audio_folder: str,
 def load_model(model_path: str, label_path: str, freeze_pretrained: bool = True):
     with open(label_path, "rb") as f:
         mlb = pickle.load(f)
-    model = ShadowNet(n_error_classes=len(mlb.classes_), freeze_pretrained=freeze_pretrained)
-    model.load_state_dict(torch.load(model_path, map_location=DEVICE))
+    state = load_state(model_path, map_location=DEVICE)
+    model = ShadowNet(n_error_classes=len(mlb.classes_), freeze_pretrained=freeze_pretrained, pretrained=False,
+                      **state_layer_counts(state))
+    model.load_state_dict(state)
     model.to(DEVICE)
     model.eval()
     return model, mlb
 
+def quantize_int8(model: nn.Module) -> nn.Module:
+    """Dynamic int8 quantization of every nn.Linear (wav2vec2, BERT and heads). CPU only."""
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def load_quantized_model(model_path: str, label_path: str):
+    """Load an artifact written by `shadowExport.py export` (int8 state_dict)."""
+    with open(label_path, "rb") as f:
+        mlb = pickle.load(f)
+    state = torch.load(model_path, map_location="cpu", weights_only=False)
+    model = quantize_int8(ShadowNet(n_error_classes=len(mlb.classes_), freeze_pretrained=True, pretrained=False,
+                                    **state_layer_counts(state)))
+    model.load_state_dict(state)
+    model.eval()
+    return model, mlb
+
 def load_audio_tensor(audio_path: str):
     if not os.path.exists(audio_path):
         raise FileNotFoundError(audio_path)
     wav, _ = librosa.load(audio_path, sr=SAMPLE_RATE, mono=True)
     return wav.astype("float32")
 
-def predict(model: nn.Module, mlb: MultiLabelBinarizer, audio_path: str, text: str, threshold: float = 0.5):
+def predict(model: nn.Module, mlb: MultiLabelBinarizer, audio_path: str, text: str, threshold: float = 0.5,
+            trim: bool = True):
     model.eval()
     wav = load_audio_tensor(audio_path)
-    audio_inputs = wav2vec_proc([wav], sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True)
-    text_inputs = tokenizer([text], return_tensors="pt", padding=True, truncation=True, max_length=128)
+    if trim:
+        wav = trim_silence(wav)
+    audio_inputs = audio_batch([wav])
+    text_inputs = get_tokenizer()([text], return_tensors="pt", padding=True, truncation=True, max_length=128)
     with torch.no_grad():
         score, err_logits = model(audio_inputs, text_inputs)
         probs = torch.sigmoid(err_logits).cpu().numpy()[0]
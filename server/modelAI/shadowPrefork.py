@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# shadowPrefork.py
+# Chạy nhiều worker shadowAI_server dùng chung 1 bản weights (pre-fork).
+#
+#   python shadowPrefork.py serve --workers 4 --threads 2 --pin --port 8000
+#   python shadowPrefork.py bench --workers 4 --threads 1 --mode both --out prefork.json
+#
+# Process cha load ShadowNet 1 lần (tham số trỏ vào mmap của shadow_model.pt,
+# xem SHADOW_MMAP_WEIGHTS), freeze GC rồi fork N worker: trang weights chỉ đọc
+# nên được chia sẻ copy-on-write, RAM không nhân theo số worker. Mỗi worker chạy
+# uvicorn trên socket lắng nghe chung (kernel chia connection), tự đặt
+# torch.set_num_threads và (--pin) ghim vào nhóm core riêng để không tranh thread.
+#
+# bench: chạy predict_batch liên tục trên 1..N worker, báo throughput và tổng
+# RSS / PSS / USS. RSS cộng dồn đếm trùng trang dùng chung; PSS là RAM thật.
+# --mode spawn để so sánh với N process độc lập, mỗi process tự load model.
+#
+# server.js chạy `serve` khi SHADOW_PREFORK_WORKERS > 1 (khác SHADOW_AI_WORKERS
+# là số process của pool JSON-lines, mỗi process 1 bản model).
+import os
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")  # tokenizers không an toàn khi fork
+
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import platform
+import multiprocessing
+from contextlib import redirect_stdout
+
+import numpy as np
+import torch
+
+import shadowAI_api as engine
+from shadowAudio import SAMPLE_RATE
+from shadowMetrics import process_memory
+
+BENCH_TEXT = "今日はいい天気ですね"
+
+
+def _log(msg: str):
+    print(f"[prefork] {msg}", file=sys.stderr, flush=True)
+
+
+def core_groups(workers: int, threads: int):
+    """Chia các core được phép chạy thành `workers` nhóm `threads` core (quay vòng nếu thiếu)."""
+    cores = sorted(os.sched_getaffinity(0))
+    return [sorted({cores[(i * threads + j) % len(cores)] for j in range(threads)}) for i in range(workers)]
+
+
+def setup_worker(threads: int, cores=None):
+    """Chạy đầu mỗi worker sau fork: ghim core rồi đặt số thread intra-op của torch."""
+    if cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, threads))
+
+
+def load_parent():
+    """Load model trong process cha với 1 thread: chưa tạo thread pool OpenMP nào trước khi fork."""
+    torch.set_num_threads(1)
+    engine.load_resources()
+    engine.prepare_fork()
+
+
+# --------- Serve ----------
+def serve(workers: int, threads: int, pin: bool = False, host: str = "0.0.0.0", port: int = 8000):
+    import uvicorn
+
+    load_parent()
+    import shadowAI_server  # app + batcher; thread của batcher chỉ tạo khi có request (sau fork)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    groups = core_groups(workers, threads) if pin else [None] * workers
+
+    children = {}  # pid -> (index, start time)
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                setup_worker(threads, groups[index])
+                server = uvicorn.Server(uvicorn.Config(shadowAI_server.app, log_level="info"))
+                server.run(sockets=[sock])
+            except BaseException as e:
+                print(f"Worker {index} lỗi: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (index, time.monotonic())
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for i in range(workers):
+        spawn(i)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    mem = process_memory()
+    _log(f"{workers} worker x {threads} thread trên http://{host}:{port} "
+         f"(cha: RSS {mem['rss'] / 1e6:.0f} MB, pin={'on' if pin else 'off'})")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid, (None, 0.0))
+        if index is None or stopping:
+            continue
+        _log(f"Worker {index} (pid {pid}) thoát với mã {os.waitstatus_to_exitcode(status)}, khởi động lại")
+        if time.monotonic() - started < 5.0:
+            time.sleep(1.0)  # tránh vòng lặp crash liên tục
+        spawn(index)
+    sock.close()
+
+
+# --------- Bench ----------
+def _bench_worker(index, threads, cores, seconds, clip_seconds, batch, load, barrier, conn, stop):
+    setup_worker(threads, cores)
+    if load:
+        engine.load_resources()  # mode spawn: mỗi process tự load
+    rng = np.random.default_rng(index)
+    wavs = [(0.1 * rng.standard_normal(int(clip_seconds * SAMPLE_RATE))).astype(np.float32)
+            for _ in range(batch)]
+    texts = [BENCH_TEXT] * batch
+    engine.predict_batch(wavs, texts)  # warmup
+
+    barrier.wait()
+    latencies = []
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        t1 = time.perf_counter()
+        engine.predict_batch(wavs, texts)
+        latencies.append(time.perf_counter() - t1)
+    conn.send({"clips": len(latencies) * batch, "seconds": time.perf_counter() - t0,
+               "p50_ms": float(np.percentile(latencies, 50) * 1000.0),
+               "p95_ms": float(np.percentile(latencies, 95) * 1000.0)})
+    stop.wait()  # còn sống để cha đo RAM của tất cả worker cùng lúc
+
+
+def bench_mode(mode: str, max_workers: int, threads: int, pin: bool, seconds: float,
+               clip_seconds: float, batch: int):
+    ctx = multiprocessing.get_context("fork" if mode == "fork" else "spawn")
+    if mode == "fork":
+        load_parent()
+    rows = []
+    for n in range(1, max_workers + 1):
+        _log(f"{mode}: {n} worker")
+        groups = core_groups(n, threads) if pin else [None] * n
+        barrier, stop = ctx.Barrier(n + 1), ctx.Event()
+        procs, recvs = [], []
+        for i in range(n):
+            recv, send = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_bench_worker, daemon=True,
+                            args=(i, threads, groups[i], seconds, clip_seconds, batch, mode != "fork",
+                                  barrier, send, stop))
+            p.start()
+            procs.append(p)
+            recvs.append(recv)
+        barrier.wait(timeout=1800)  # tất cả đã load + warmup xong
+        t0 = time.perf_counter()
+        stats = [r.recv() for r in recvs]
+        wall = time.perf_counter() - t0
+
+        parent = process_memory()
+        workers = [process_memory(p.pid) for p in procs]
+        stop.set()
+        for p in procs:
+            p.join()
+
+        clips = sum(s["clips"] for s in stats)
+        total = {k: (parent[k] + sum(w[k] for w in workers)) / 1e6 for k in ("rss", "pss", "uss")}
+        rows.append({
+            "workers": n,
+            "clips_per_s": clips / wall,
+            "audio_s_per_s": clips * clip_seconds / wall,
+            "p50_ms": float(np.median([s["p50_ms"] for s in stats])),
+            "p95_ms": float(max(s["p95_ms"] for s in stats)),
+            "rss_total_mb": total["rss"],
+            "pss_total_mb": total["pss"],
+            "uss_total_mb": total["uss"],
+            "parent_pss_mb": parent["pss"] / 1e6,
+            "worker_pss_mb": float(np.mean([w["pss"] for w in workers])) / 1e6,
+        })
+        _log(f"  {rows[-1]['clips_per_s']:.2f} clip/s, PSS {total['pss']:.0f} MB, RSS {total['rss']:.0f} MB")
+    return rows
+
+
+def bench(max_workers: int, threads: int = 1, pin: bool = False, seconds: float = 10.0,
+          clip_seconds: float = 5.0, batch: int = 1, modes=("fork",)):
+    report = {
+        "meta": {
+            "model_variant": engine.MODEL_VARIANT,
+            "mmap_weights": engine.MMAP_WEIGHTS,
+            "threads_per_worker": threads,
+            "pin": pin,
+            "seconds": seconds,
+            "clip_seconds": clip_seconds,
+            "batch": batch,
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+        },
+    }
+    # spawn trước: process cha chưa load model nên không làm lệch số RAM
+    for mode in sorted(modes, reverse=True):
+        report[mode] = bench_mode(mode, max_workers, threads, pin, seconds, clip_seconds, batch)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-fork serving cho Shadow AI")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name in ("serve", "bench"):
+        p = sub.add_parser(name)
+        p.add_argument("--workers", type=int,
+                       default=int(os.environ.get("SHADOW_PREFORK_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 2))
+        p.add_argument("--threads", type=int, default=int(os.environ.get("SHADOW_WORKER_THREADS", "1")),
+                       help="torch.set_num_threads mỗi worker")
+        p.add_argument("--pin", action="store_true", help="ghim mỗi worker vào `threads` core riêng")
+    p_serve = sub.choices["serve"]
+    p_serve.add_argument("--host", default="0.0.0.0")
+    p_serve.add_argument("--port", type=int, default=8000)
+    p_bench = sub.choices["bench"]
+    p_bench.add_argument("--seconds", type=float, default=10.0, help="thời gian đo mỗi cấu hình")
+    p_bench.add_argument("--clip-seconds", type=float, default=5.0)
+    p_bench.add_argument("--batch", type=int, default=1)
+    p_bench.add_argument("--mode", choices=["fork", "spawn", "both"], default="fork")
+    p_bench.add_argument("--out", default=None, help="ghi JSON (mặc định: stdout)")
+    args = parser.parse_args()
+
+    if args.cmd == "serve":
+        serve(max(1, args.workers), max(1, args.threads), pin=args.pin, host=args.host, port=args.port)
+        sys.exit(0)
+
+    with redirect_stdout(sys.stderr):
+        result = bench(max(1, args.workers), max(1, args.threads), pin=args.pin, seconds=args.seconds,
+                       clip_seconds=args.clip_seconds, batch=max(1, args.batch),
+                       modes=("fork", "spawn") if args.mode == "both" else (args.mode,))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        _log(f"Saved: {args.out}")
+    else:
+        print(text)
@@ -2,21 +2,17 @@ import os
 import torch
 import librosa
 import pickle
-from shadowModel import ShadowNet
-from transformers import AutoTokenizer, Wav2Vec2Processor
+from shadowModel import ShadowNet, get_processor, get_tokenizer, load_state, state_layer_counts
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 SAMPLE_RATE = 16000
 
-# Processor & tokenizer
-wav2vec_proc = Wav2Vec2Processor.from_pretrained("facebook/wav2vec2-base-960h")
-tokenizer = AutoTokenizer.from_pretrained("cl-tohoku/bert-base-japanese")
-
 def load_model(model_path, label_path):
     with open(label_path, "rb") as f:
         mlb = pickle.load(f)
-    model = ShadowNet(n_error_classes=len(mlb.classes_))
-    model.load_state_dict(torch.load(model_path, map_location=DEVICE))
+    state = load_state(model_path, map_location=DEVICE)
+    model = ShadowNet(n_error_classes=len(mlb.classes_), pretrained=False, **state_layer_counts(state))
+    model.load_state_dict(state)
     model.to(DEVICE)
     model.eval()
     return model, mlb
@@ -28,11 +24,11 @@ def load_audio(audio_path):
 def predict(model, mlb, audio_path, text, threshold=0.5):
     model.eval()
     wav = load_audio(audio_path)
-    audio_inputs = wav2vec_proc([wav], sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True)
+    audio_inputs = get_processor()([wav], sampling_rate=SAMPLE_RATE, return_tensors="pt", padding=True)
     for k in audio_inputs:
         audio_inputs[k] = audio_inputs[k].to(DEVICE)
 
-    text_inputs = tokenizer([text], return_tensors="pt", truncation=True, padding=True, max_length=128)
+    text_inputs = get_tokenizer()([text], return_tensors="pt", truncation=True, padding=True, max_length=128)
     for k in text_inputs:
         text_inputs[k] = text_inputs[k].to(DEVICE)
 
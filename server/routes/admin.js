@@ -218,4 +218,85 @@ router.get('/flashcard-sets', protect, admin, async (req, res) => {
   }
 });
 
+// ==================== IMPORT CHƯƠNG (scripts/import_books.py) ====================
+// Upsert theo (bookId, chapterNumber) trong 1 transaction: gửi lại cùng request (retry sau
+// timeout, chạy lại script) chỉ ghi đè đúng các chương đó, không tạo chương trùng.
+const parseImportChapter = (chap) => {
+  const chapterNumber = parseInt(chap?.chapterNumber, 10);
+  if (!Number.isInteger(chapterNumber) || chapterNumber < 1 || !Array.isArray(chap.content) || chap.content.length === 0) {
+    return null;
+  }
+  return {
+    chapterNumber,
+    title: String(chap.title || `Chương ${chapterNumber}`).trim(),
+    illustration: chap.illustration || '',
+    content: JSON.stringify(chap.content)
+  };
+};
+
+const importChapters = async (res, bookId, rawChapters) => {
+  const chapters = rawChapters.map(parseImportChapter);
+  if (!bookId || chapters.length === 0 || chapters.some(c => !c)) {
+    return res.status(400).json({ message: 'Thiếu hoặc sai định dạng: bookId, chapterNumber, content (phải là mảng)' });
+  }
+
+  const conn = await db.getConnection();
+  await conn.beginTransaction();
+
+  try {
+    const [books] = await conn.query('SELECT id FROM books WHERE id = ?', [bookId]);
+    if (books.length === 0) {
+      await conn.rollback();
+      return res.status(404).json({ message: 'Không tìm thấy sách với bookId này!' });
+    }
+
+    let created = 0;
+    let updated = 0;
+    for (const chap of chapters) {
+      const [existing] = await conn.query(
+        'SELECT id FROM chapters WHERE bookId = ? AND chapterNumber = ? FOR UPDATE',
+        [bookId, chap.chapterNumber]
+      );
+      if (existing.length > 0) {
+        // giữ illustration đã có (import không gửi ảnh)
+        await conn.query(
+          'UPDATE chapters SET title = ?, content = ?, updatedAt = NOW() WHERE id = ?',
+          [chap.title, chap.content, existing[0].id]
+        );
+        updated++;
+      } else {
+        await conn.query(
+          `INSERT INTO chapters 
+           (bookId, chapterNumber, title, illustration, content, createdAt) 
+           VALUES (?, ?, ?, ?, ?, NOW())`,
+          [bookId, chap.chapterNumber, chap.title, chap.illustration, chap.content]
+        );
+        created++;
+      }
+    }
+
+    await conn.commit();
+    res.status(201).json({
+      message: 'Import chương thành công!',
+      chapters: chapters.map(c => c.chapterNumber),
+      created,
+      updated
+    });
+  } catch (err) {
+    await conn.rollback();
+    console.error('Lỗi import chương:', err);
+    res.status(500).json({ message: 'Lỗi server khi import chương' });
+  } finally {
+    conn.release();
+  }
+};
+
+// 1 chương: { bookId, chapterNumber, title, content: [{ text, ruby, meaning, tokens }] }
+router.post('/import-chapter', protect, admin, (req, res) =>
+  importChapters(res, req.body.bookId, [req.body]));
+
+// nhiều chương: { bookId, chapters: [...] }
+router.post('/import-chapters', protect, admin, (req, res) =>
+  importChapters(res, req.body.bookId, Array.isArray(req.body.chapters) ? req.body.chapters : []));
+
 module.exports = router;
\ No newline at end of file
@@ -3,10 +3,10 @@ const express = require('express');
 const router = express.Router();
 const path = require('path');
 const fs = require('fs').promises;
-const { spawn } = require('child_process');
 const multer = require('multer');
 const db = require('../db');
 const { protect, admin } = require('../middleware/authMiddleware');
+const { getShadowPool } = require('../services/shadowWorkerPool');
 
 // ==================== THƯ MỤC UPLOAD ====================
 const uploadDir = path.join(__dirname, '../uploads/shadow');
@@ -126,54 +126,31 @@ router.post('/predict', upload.single('audio'), async (req, res) => {
   console.log(`Text: ${text}`);
   console.log(`Audio: ${audioPath}`);
 
-  const py = spawn('python', [scriptPath, audioPath, text]);
-
-  let stdout = '';
-  let stderr = '';
-
-  py.stdout.on('data', (data) => {
-    stdout += data.toString();
-    process.stdout.write('PY: ' + data.toString());
-  });
-
-  py.stderr.on('data', (data) => {
-    stderr += data.toString();
-    console.error('PY ERR:', data.toString());
-  });
-
-  py.on('close', async (code) => {
-    await fs.unlink(audioPath).catch(() => {});
-    console.log(`Python exit code: ${code}`);
-
-    if (code !== 0) {
-      return res.status(500).json({ message: 'AI xử lý thất bại', detail: stderr || 'No stderr' });
-    }
-
-    try {
-      const result = JSON.parse(stdout);
-      res.json({
-        success: true,
-        score: result.score || 0,
-        accuracy: result.accuracy || 0,
-        fluency: result.fluency || 0,
-        pronunciation: result.pronunciation || 0,
-        feedback: result.feedback || 'Tốt!',
-        words: result.words || []
-      });
-    } catch (e) {
-      console.error('Không parse được JSON từ Python:', stdout);
-      res.status(500).json({ message: 'Kết quả AI không đúng định dạng', raw: stdout });
+  try {
+    // Worker Python đã load sẵn model, không spawn lại mỗi request
+    const result = await getShadowPool().predict(audioPath, text, { timeoutMs: 15000 });
+    res.json({
+      success: true,
+      score: result.score || 0,
+      accuracy: result.accuracy || 0,
+      fluency: result.fluency || 0,
+      pronunciation: result.pronunciation || 0,
+      feedback: result.feedback || 'Tốt!',
+      words: result.words || [],
+      cacheHit: result.cacheHit || false
+    });
+  } catch (err) {
+    if (err.code === 'ETIMEDOUT') {
+      return res.status(504).json({ message: 'AI xử lý quá thời gian (timeout 15s)' });
     }
-  });
-
-  // Timeout 15 giây
-  setTimeout(() => {
-    if (!py.killed) {
-      py.kill();
-      fs.unlink(audioPath).catch(() => {});
-      res.status(504).json({ message: 'AI xử lý quá thời gian (timeout 15s)' });
+    if (err.code === 'EUNAVAILABLE') {
+      return res.status(503).json({ message: 'AI tạm thời không khả dụng', detail: err.message });
     }
-  }, 15000);
+    console.error('Shadow AI worker lỗi:', err.message);
+    res.status(500).json({ message: 'AI xử lý thất bại', detail: err.message });
+  } finally {
+    await fs.unlink(audioPath).catch(() => {});
+  }
 });
 
 // ==================== ADMIN: TẠO TOPIC MỚI ====================
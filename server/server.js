@@ -64,7 +64,19 @@ app.get('/api/jishoApi/audio', async (req, res) => {
 
 // ==================== Spawn Python FastAPI Server ====================
 const PYTHON_PORT = 8000;
-const pythonProcess = spawn('python', [path.join(__dirname, 'modelAI', 'shadowAI_server.py')]);
+// Cấu hình phía Python:
+//   SHADOW_PREFORK_WORKERS > 1: pre-fork N worker uvicorn dùng chung weights (shadowPrefork.py)
+//   SHADOW_WORKER_THREADS: torch thread mỗi worker pre-fork (mặc định 1)
+//   SHADOW_WORKER_PIN=1: ghim mỗi worker pre-fork vào nhóm core riêng
+//   SHADOW_AI_WORKERS: số process của pool JSON-lines (services/shadowWorkerPool.js, mặc định 2),
+//     mỗi process tự load 1 bản model -> không dùng để tăng worker pre-fork
+const PREFORK_WORKERS = parseInt(process.env.SHADOW_PREFORK_WORKERS || '1', 10);
+const pythonArgs = PREFORK_WORKERS > 1
+  ? [path.join(__dirname, 'modelAI', 'shadowPrefork.py'), 'serve', '--workers', String(PREFORK_WORKERS),
+     '--threads', process.env.SHADOW_WORKER_THREADS || '1', '--port', String(PYTHON_PORT),
+     ...(process.env.SHADOW_WORKER_PIN === '1' ? ['--pin'] : [])]
+  : [path.join(__dirname, 'modelAI', 'shadowAI_server.py')];
+const pythonProcess = spawn('python', pythonArgs);
 
 pythonProcess.stdout.on('data', d => console.log('PY:', d.toString().trim()));
 pythonProcess.stderr.on('data', d => console.error('PY ERR:', d.toString().trim()));
@@ -97,17 +109,26 @@ app.post('/api/shadow/predict', upload.single('audio'), async (req, res) => {
       await fs.unlink(inputPath).catch(() => {});
 
       try {
+        // Python đọc thẳng file WAV đã convert, không cần upload lại bytes
         const form = new FormData();
-        form.append('file', await fs.readFile(wavPath), { filename: 'audio.wav' });
+        form.append('audio_path', wavPath);
         form.append('text', req.body.text);
 
         const aiRes = await axios.post(`http://127.0.0.1:${PYTHON_PORT}/predict`, form, {
-          headers: form.getHeaders(),
+          // giới hạn đồng thời theo client được tính ở phía Python
+          headers: { ...form.getHeaders(), 'X-Client-Id': req.ip },
           timeout: 60000
         });
 
         res.json(aiRes.data);
       } catch (err) {
+        const status = err.response?.status;
+        if (status === 429 || status === 503) {
+          // quá tải: chuyển tiếp Retry-After để client tự thử lại
+          const retryAfter = err.response.headers['retry-after'];
+          if (retryAfter) res.set('Retry-After', retryAfter);
+          return res.status(status).json({ error: 'AI đang quá tải, thử lại sau', retryAfter: Number(retryAfter) || null });
+        }
         console.error('AI server error:', err.message);
         res.status(500).json({ error: 'AI xử lý thất bại', detail: err.message });
       } finally {
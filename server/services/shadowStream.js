@@ -0,0 +1,83 @@
+// services/shadowStream.js – CHẤM ĐIỂM SHADOWING TRỰC TIẾP QUA SOCKET.IO
+// Client gửi PCM từng đoạn trong lúc nói, Node chuyển tiếp sang WebSocket
+// /stream của shadowAI_server.py và đẩy điểm tạm thời / điểm cuối về client.
+//
+//   client -> 'shadow:start' { text, sampleRate = 16000, threshold, provisional = true }
+//   client -> 'shadow:chunk' <Buffer|ArrayBuffer PCM 16-bit LE mono>
+//   client -> 'shadow:end'
+//   server -> 'shadow:provisional' { score, errors, seconds }
+//   server -> 'shadow:final'       { score, errors, seconds, finalize_ms }
+//   server -> 'shadow:error'       { error }
+const WebSocket = require('ws');
+
+const STREAM_URL = process.env.SHADOW_AI_WS_URL || 'ws://127.0.0.1:8000/stream';
+const MAX_PENDING_CHUNKS = 500; // đoạn chờ trong lúc WebSocket đang kết nối
+
+function attachShadowStream(socket) {
+  let ws = null;
+  let pending = [];
+
+  const close = () => {
+    if (ws) {
+      ws.removeAllListeners();
+      ws.on('error', () => {});
+      ws.terminate();
+    }
+    ws = null;
+    pending = [];
+  };
+
+  const send = (data) => {
+    if (!ws) return;
+    if (ws.readyState === WebSocket.OPEN) ws.send(data);
+    else if (ws.readyState === WebSocket.CONNECTING && pending.length < MAX_PENDING_CHUNKS) pending.push(data);
+  };
+
+  socket.on('shadow:start', ({ text, sampleRate = 16000, threshold = 0.5, provisional = true } = {}) => {
+    if (!text?.trim()) return socket.emit('shadow:error', { error: 'Thiếu text' });
+    close(); // mỗi socket chỉ 1 lượt nói tại 1 thời điểm
+
+    const current = new WebSocket(STREAM_URL);
+    ws = current;
+    current.on('open', () => {
+      current.send(JSON.stringify({ type: 'start', text, sample_rate: sampleRate, threshold, provisional }));
+      pending.forEach(data => current.send(data));
+      pending = [];
+    });
+    current.on('message', (raw) => {
+      let msg;
+      try {
+        msg = JSON.parse(raw.toString());
+      } catch {
+        return;
+      }
+      if (msg.type === 'provisional') {
+        socket.emit('shadow:provisional', { score: msg.score, errors: msg.errors, seconds: msg.seconds });
+      } else if (msg.type === 'final') {
+        socket.emit('shadow:final', {
+          score: msg.score, errors: msg.errors, seconds: msg.seconds, finalize_ms: msg.finalize_ms
+        });
+      } else if (msg.type === 'error') {
+        socket.emit('shadow:error', { error: msg.detail });
+      }
+    });
+    current.on('error', (err) => {
+      console.error('Shadow stream error:', err.message);
+      if (ws === current) socket.emit('shadow:error', { error: 'AI stream thất bại' });
+    });
+    current.on('close', () => {
+      if (ws === current) ws = null;
+    });
+  });
+
+  socket.on('shadow:chunk', (chunk) => {
+    if (!chunk) return;
+    send(Buffer.isBuffer(chunk) ? chunk : Buffer.from(chunk));
+  });
+
+  socket.on('shadow:end', () => send(JSON.stringify({ type: 'end' })));
+
+  socket.on('disconnect', close);
+}
+
+module.exports = { attachShadowStream };
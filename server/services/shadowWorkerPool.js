@@ -0,0 +1,190 @@
+// services/shadowWorkerPool.js – POOL PYTHON WORKER GIỮ MODEL TRONG RAM
+// Mỗi worker chạy `shadowAI_api.py --worker` (JSON-lines qua stdin/stdout),
+// load model 1 lần rồi phục vụ nhiều request thay vì spawn lại mỗi lần.
+const path = require('path');
+const readline = require('readline');
+const { spawn } = require('child_process');
+
+const SCRIPT_PATH = path.join(__dirname, '../modelAI/shadowAI_api.py');
+const PYTHON_BIN = process.env.SHADOW_AI_PYTHON || 'python';
+const POOL_SIZE = Math.max(1, parseInt(process.env.SHADOW_AI_WORKERS || '2', 10));
+const RESTART_DELAY_MS = 2000;
+// số lần worker chết liên tiếp trước khi sẵn sàng (vd. thiếu file model) thì bỏ, không restart nữa
+const MAX_RESTARTS = Math.max(0, parseInt(process.env.SHADOW_AI_MAX_RESTARTS || '5', 10));
+// 1 job chạy quá lâu mới coi worker là treo và kill; tách khỏi timeout của caller để
+// job chờ lâu trong hàng đợi không làm kill (và load lại model) 1 worker đang khỏe
+const HANG_TIMEOUT_MS = Math.max(1000, parseInt(process.env.SHADOW_AI_HANG_MS || '60000', 10));
+
+const timeoutError = () => Object.assign(new Error('AI xử lý quá thời gian'), { code: 'ETIMEDOUT' });
+
+class ShadowWorker {
+  constructor(index, onIdle, onGiveUp) {
+    this.index = index;
+    this.onIdle = onIdle;
+    this.onGiveUp = onGiveUp;
+    this.ready = false;
+    this.dead = false;
+    this.restarts = 0; // số lần chết liên tiếp kể từ lần ready gần nhất
+    this.current = null; // { id, resolve, reject, timer, hangTimer, settled }
+    this.nextId = 1;
+    this.start();
+  }
+
+  start() {
+    this.ready = false;
+    this.proc = spawn(PYTHON_BIN, [SCRIPT_PATH, '--worker'], { cwd: path.dirname(SCRIPT_PATH) });
+
+    const rl = readline.createInterface({ input: this.proc.stdout });
+    rl.on('line', line => this.handleLine(line));
+
+    this.proc.stderr.on('data', d => console.error(`PY[${this.index}] ERR:`, d.toString().trim()));
+    this.proc.on('close', code => {
+      console.log(`Shadow AI worker ${this.index} exited: ${code}`);
+      const wasReady = this.ready;
+      this.ready = false;
+      this.fail(new Error(`Worker thoát với code ${code}`));
+      this.restarts = wasReady ? 0 : this.restarts + 1;
+      if (this.restarts > MAX_RESTARTS) {
+        this.dead = true;
+        console.error(`Shadow AI worker ${this.index} chết ${this.restarts} lần liên tiếp, không restart nữa`);
+        this.onGiveUp();
+        return;
+      }
+      setTimeout(() => this.start(), RESTART_DELAY_MS);
+    });
+  }
+
+  handleLine(line) {
+    let msg;
+    try {
+      msg = JSON.parse(line);
+    } catch {
+      console.log(`PY[${this.index}]:`, line);
+      return;
+    }
+
+    if (msg.ready) {
+      this.ready = true;
+      this.restarts = 0;
+      console.log(`Shadow AI worker ${this.index} sẵn sàng`);
+      this.onIdle();
+      return;
+    }
+
+    const job = this.current;
+    if (!job || msg.id !== job.id) return;
+    this.current = null;
+    clearTimeout(job.hangTimer);
+
+    // caller đã hết hạn thì settle() bỏ qua kết quả đến muộn
+    if (msg.error) this.settle(job, new Error(msg.error));
+    else this.settle(job, null, { score: msg.score, errors: msg.errors || [], cacheHit: !!msg.cache_hit });
+    this.onIdle();
+  }
+
+  // trả kết quả cho caller đúng 1 lần
+  settle(job, err, result) {
+    if (job.settled) return;
+    job.settled = true;
+    clearTimeout(job.timer);
+    if (err) job.reject(err);
+    else job.resolve(result);
+  }
+
+  fail(err) {
+    const job = this.current;
+    if (!job) return;
+    this.current = null;
+    clearTimeout(job.hangTimer);
+    this.settle(job, err);
+  }
+
+  isIdle() {
+    return this.ready && !this.current;
+  }
+
+  run({ audioPath, text, threshold, deadline }, resolve, reject) {
+    const id = this.nextId++;
+    const job = { id, resolve, reject, settled: false };
+    // hết hạn của caller: trả lỗi ngay nhưng để worker chạy xong, reply muộn bị bỏ theo id
+    job.timer = setTimeout(() => this.settle(job, timeoutError()), Math.max(0, deadline - Date.now()));
+    job.hangTimer = setTimeout(() => {
+      // worker bị treo -> kill, close handler sẽ restart
+      console.error(`Shadow AI worker ${this.index} treo quá ${HANG_TIMEOUT_MS}ms, kill`);
+      this.fail(timeoutError());
+      this.proc.kill();
+    }, HANG_TIMEOUT_MS);
+
+    this.current = job;
+    this.proc.stdin.write(JSON.stringify({ id, audio_path: audioPath, text, threshold }) + '\n');
+  }
+}
+
+class ShadowWorkerPool {
+  constructor(size = POOL_SIZE) {
+    this.queue = [];
+    this.workers = [];
+    for (let i = 0; i < size; i++) {
+      this.workers.push(new ShadowWorker(i, () => this.dispatch(), () => this.checkAlive()));
+    }
+  }
+
+  isAlive() {
+    return this.workers.some(w => !w.dead);
+  }
+
+  unavailableError() {
+    return Object.assign(new Error('AI không khả dụng (mọi worker đều lỗi khi khởi động)'), { code: 'EUNAVAILABLE' });
+  }
+
+  // mọi worker đã bỏ cuộc -> trả lỗi cho các job còn chờ thay vì để treo
+  checkAlive() {
+    if (this.isAlive()) return;
+    const queued = this.queue.splice(0);
+    for (const entry of queued) {
+      clearTimeout(entry.timer);
+      entry.reject(this.unavailableError());
+    }
+  }
+
+  dispatch() {
+    while (this.queue.length > 0) {
+      const worker = this.workers.find(w => w.isIdle());
+      if (!worker) return;
+      const { job, deadline, timer, resolve, reject } = this.queue.shift();
+      clearTimeout(timer);
+      // thời gian chờ trong hàng đợi đã tính vào timeout; hết giờ thì không gửi cho worker nữa
+      if (deadline - Date.now() <= 0) {
+        reject(timeoutError());
+        continue;
+      }
+      worker.run({ ...job, deadline }, resolve, reject);
+    }
+  }
+
+  predict(audioPath, text, { threshold = 0.5, timeoutMs = 15000 } = {}) {
+    return new Promise((resolve, reject) => {
+      if (!this.isAlive()) return reject(this.unavailableError());
+      const entry = { job: { audioPath, text, threshold }, deadline: Date.now() + timeoutMs, resolve, reject };
+      // deadline tính từ lúc vào hàng đợi: worker đang restart / crash-loop không làm job chờ mãi
+      entry.timer = setTimeout(() => {
+        const i = this.queue.indexOf(entry);
+        if (i === -1) return;
+        this.queue.splice(i, 1);
+        reject(timeoutError());
+      }, timeoutMs);
+      this.queue.push(entry);
+      this.dispatch();
+    });
+  }
+}
+
+let pool = null;
+
+// Khởi tạo lười để require() file này không spawn Python ngay
+function getShadowPool() {
+  if (!pool) pool = new ShadowWorkerPool();
+  return pool;
+}
+
+module.exports = { getShadowPool, ShadowWorkerPool };
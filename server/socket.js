@@ -1,6 +1,7 @@
 // socket.js – MySQL2 + REALTIME CHAT & NOTIFICATION 2025
 const { Server } = require('socket.io');
 const jwt = require('jsonwebtoken');
+const { attachShadowStream } = require('./services/shadowStream');
 
 function formatTimeAgo(date) {
   const diff = (Date.now() - new Date(date)) / 1000;
@@ -71,6 +72,9 @@ function initSocket(httpServer, db) {
     loadRecentChats();
     socket.on('getRecentChats', loadRecentChats);
 
+    // Chấm điểm shadowing trực tiếp (PCM từng đoạn -> shadowAI_server /stream)
+    attachShadowStream(socket);
+
     // Send message
     socket.on('sendMessage', async ({ receiverId, message }) => {
       if (!message?.trim()) return;